@@ -15,6 +15,15 @@ MAXIMUM_WINDOW = 100
 """default timeout to use for resending packets."""
 INITIAL_TIMEOUT = 100
 
+"""in 'sliding-window' mode, only ACK every ACK_EVERY-th in-order packet (1 ACKs every packet)"""
+ACK_EVERY = 1
+
+"""in 'sliding-window' mode, maximum time to hold back a delayed ACK"""
+ACK_DELAY = 0.5
+
+"""file for a binary trace of link events (see event_trace.py); empty to disable"""
+EVENT_TRACE = ''
+
 """types of events to output trace info for.
 
 'all' matches all event, otherwise, name listed much last type passed as first arg to trace() function."""
@@ -1,3 +1,5 @@
+from dataclasses import replace
+
 import config
 from util import Packet, Message, cancel_timer, create_timer, now, trace
 
@@ -18,8 +20,50 @@ def debug(msg: str | None) -> None:
     if msg:
         trace('debug', msg)
 
+def seq_add(seq_num: int, n: int) -> int:
+    """Sequence number `n` after `seq_num`, taking into account wraparound."""
+    return (seq_num + n) % config.MAXIMUM_SEQUENCE
+
+def seq_delta(first: int, later: int) -> int:
+    """How far sequence number `later` is after `first`, taking into account wraparound.
+    Always returns a number in [0, MAXIMUM_SEQUENCE).
+    """
+    return (later - first) % config.MAXIMUM_SEQUENCE
+
 # Class Implementations
 
+class ReorderBuffer:
+    """Fixed-size circular buffer of packets received ahead of the next expected one.
+
+    Slot `head` holds the next expected packet; slot `head + offset` holds the packet `offset`
+    sequence numbers after it.
+
+    Each slot also records when the packet last stored there was delivered. The sender can only
+    send the packet `size` sequence numbers later after hearing that it was, so a packet for
+    the slot sent before then is an old copy whose sequence number has wrapped around.
+    """
+    def __init__(self, size: int):
+        self.slots = [None] * size
+        self.delivered_times = [0.0] * size
+        self.head = 0
+
+    def store(self, offset: int, packet: Packet) -> bool:
+        """Store `packet`, unless it was sent too early to be the one expected at `offset`."""
+        index = (self.head + offset) % len(self.slots)
+        if packet.timestamp < self.delivered_times[index]:
+            return False
+        self.slots[index] = packet
+        return True
+
+    def pop_next(self) -> Packet | None:
+        """Remove and return the next expected packet, if it has been received."""
+        packet = self.slots[self.head]
+        if packet is not None:
+            self.slots[self.head] = None
+            self.delivered_times[self.head] = now()
+            self.head = (self.head + 1) % len(self.slots)
+        return packet
+
 class MySender:
     def __init__(self):
         self.seq_num = INITIAL_SEQ_NUM  # seq num of current packet
@@ -29,6 +73,7 @@ class MySender:
         self.last_acked = INITIAL_LAST_SEQ_NUM  # LAR
         self.last_sent = INITIAL_LAST_SEQ_NUM # LFS
         self.timers = {}  # for resending packets not ACKed
+        self.first_sent = {}  # when each packet not ACKed was first sent
         # Window = [LAR + 1, LAR + SWS]
 
     # Network Functions
@@ -61,6 +106,7 @@ class MySender:
                     return False
 
             self.send_packet(packet, f"sender sent {seq_num} {message.data}")
+            self.first_sent[seq_num] = now()
             self.last_sent = seq_num
         return True
 
@@ -88,9 +134,21 @@ class MySender:
             ack_num = packet.ack_num
             debug(f"sender got ACK {ack_num}")
 
+            # Ignore old ACKs. An ACK echoes the send time of the packet that triggered it, so
+            # one for a packet sent before the current use of its sequence number is old too,
+            # even though after wraparound it looks like it acknowledges packets in the window.
+            acked_count = seq_delta(self.last_acked, ack_num)
+            if acked_count > seq_delta(self.last_acked, self.last_sent):
+                debug(f"sender ignored old ACK {ack_num}")
+                return
+            if acked_count > 0 and packet.timestamp < self.first_sent[ack_num]:
+                debug(f"sender ignored ACK {ack_num} from before wraparound")
+                return
+
             # Cancel timers
-            for i in range(self.last_acked + 1, ack_num + 1):
-                self.cancel_timer(i)
+            for i in range(1, acked_count + 1):
+                self.cancel_timer(seq_add(self.last_acked, i))
+                self.first_sent.pop(seq_add(self.last_acked, i), None)
 
             # Update window
             self.last_acked = packet.ack_num
@@ -131,8 +189,8 @@ class MySender:
         self.send_packet(packet, f"sender resent {packet.seq_num} {packet.data}")
 
     def send_packet(self, packet: Packet, msg: str=None, timer: bool=True) -> None:
-        packet.timestamp = now()
-        self.to_network(packet)
+        # Send a copy, so copies still in flight keep the time they were sent
+        self.to_network(replace(packet, timestamp=now()))
         debug(msg)
 
         # Start/reset wait timer
@@ -159,7 +217,10 @@ class MyReceiver:
         self.last_seq_num = None  # seq num of last received packet
         self.last_received = INITIAL_LAST_SEQ_NUM  # LFR
         self.last_accepted = self.last_received + config.INITIAL_WINDOW  # LAF
-        self.recent_packets = {}  # packets received out-of-order
+        self.reorder_buffer = ReorderBuffer(config.INITIAL_WINDOW)  # packets received out-of-order
+        self.unacked_count = 0  # in-order packets not yet ACKed
+        self.ack_packet = None  # last in-order packet, to ACK later
+        self.ack_timer = None  # timer to send delayed ACK
         # Window = [LFR + 1, LAF]
 
     # Network Functions
@@ -189,59 +250,74 @@ class MyReceiver:
         elif config.MODE == SLIDING_WINDOW_MODE:
             window_start, window_end = self.get_receive_window()
             seq_num = packet.seq_num
-
-            # Ignore packet if out of window
-            if window_start <= window_end:  # if window is normal
-                if seq_num > window_end:
+            offset = seq_delta(window_start, seq_num)
+
+            # Resend missing ACKs for packets already received
+            if offset >= config.INITIAL_WINDOW:
+                if seq_delta(seq_num, window_start) <= config.INITIAL_WINDOW:
+                    if self.ack_packet:
+                        self.flush_ack()
+                    else:
+                        self.send_ack(packet, f"receiver resent ACK {self.last_received}", ack_num=self.last_received)
+                else:
                     debug(f"receiver got {seq_num} outside window {window_start}-{window_end}")
-                    return
-                # Resend missing ACKs even if packet out of window
-                elif seq_num < window_start:
-                    self.send_ack(packet, f"receiver resent ACK {self.last_received}")
-            else:
-                if window_start < packet.seq_num < window_end:
-                    debug(f"receiver got {packet.seq_num} outside window {self.last_received + 1}-{config.MAXIMUM_SEQUENCE - 1}, {0}-{self.last_accepted}")
-                    return
-
-            # Reply if packet is next in sequence
-            if seq_num == window_start:
-                self.to_application(message)
-                debug(f"receiver got {seq_num} {message.data}")
+                return
 
-                # Find last in-order packet stored
-                for i in range(seq_num + 1, self.last_accepted + 1):
-                    if i not in self.recent_packets.keys():
-                        break
+            if not self.reorder_buffer.store(offset, packet):
+                debug(f"receiver got {seq_num} sent before wraparound")
+                return
 
-                    # Send packet to application
-                    packet = self.recent_packets.pop(i)
+            # Reply if packet is next in sequence
+            if offset == 0:
+                # Send all in-order packets stored to application
+                while (next_packet := self.reorder_buffer.pop_next()) is not None:
+                    packet = next_packet
                     message = Message(data=packet.data, is_end=packet.is_end)
                     self.to_application(message)
-                    debug(f"receiver popped {packet.seq_num} {message.data}")
+                    debug(f"receiver got {packet.seq_num} {message.data}")
 
-                # Send latest ACK and update window
-                self.send_ack(packet, f"receiver sent ACK {packet.seq_num}")
+                # Send latest ACK (or delay it) and update window
+                self.delay_ack(packet)
                 self.last_received = packet.seq_num
-                self.last_accepted = (self.last_received + config.INITIAL_WINDOW) % config.MAXIMUM_SEQUENCE
+                self.last_accepted = seq_add(self.last_received, config.INITIAL_WINDOW)
 
                 window_start, window_end = self.get_receive_window()
-                if window_start <= window_end:  # if window is normal
-                    debug(f"receiver window {window_start}-{window_end}")
-                else:  # if window is split
-                    debug(f"receiver window {window_start}-{config.MAXIMUM_SEQUENCE - 1}, {0}-{window_end}")
+                debug(f"receiver window {window_start}-{window_end}")
             # Store packet if out-of-order
-            elif seq_num > window_start:
-                self.recent_packets[seq_num] = packet
+            else:
                 debug(f"receiver got out-of-order {seq_num}, window {window_start}-{window_end}")
 
+                # Don't hold back ACKs when packets are missing
+                self.flush_ack()
+
     # Helper Functions
 
     def get_receive_window(self) -> tuple:
-        window_start = (self.last_received + 1) % config.MAXIMUM_SEQUENCE
+        window_start = seq_add(self.last_received, 1)
         window_end = self.last_accepted
         return window_start, window_end
 
-    def send_ack(self, packet:Packet, msg: str=None):
-        ack_packet = Packet(data=ACK_PACKET_DATA, is_end=packet.is_end, ack_num=packet.seq_num, timestamp=packet.timestamp)
+    def delay_ack(self, packet: Packet) -> None:
+        self.unacked_count += 1
+        self.ack_packet = packet
+
+        if self.unacked_count >= config.ACK_EVERY or packet.is_end:
+            self.flush_ack()
+        elif self.ack_timer is None:
+            self.ack_timer = create_timer(config.ACK_DELAY, lambda: self.flush_ack(), "delayed ACK")
+
+    def flush_ack(self) -> None:
+        if self.ack_timer:
+            cancel_timer(self.ack_timer)
+            self.ack_timer = None
+        if self.ack_packet:
+            self.send_ack(self.ack_packet, f"receiver sent ACK {self.ack_packet.seq_num} for {self.unacked_count} packets")
+            self.ack_packet = None
+            self.unacked_count = 0
+
+    def send_ack(self, packet:Packet, msg: str=None, ack_num: int=None):
+        if ack_num is None:
+            ack_num = packet.seq_num
+        ack_packet = Packet(data=ACK_PACKET_DATA, is_end=packet.is_end, ack_num=ack_num, timestamp=packet.timestamp)
         self.to_network(ack_packet)
         debug(msg)
@@ -3,13 +3,14 @@ import config
 import ends
 import json
 import re
+import replications
 import util
 import sys
 
 from util import Message
 from simulator import Simulator, Event
 
-def run(args, messages):
+def setup(args, messages):
     sender = ends.MySender()
     receiver = ends.MyReceiver()
     _simulator = util._simulator = Simulator(args)
@@ -43,23 +44,63 @@ def run(args, messages):
             description='initial data send'
         ),
     )
+    return _simulator
+
+def json_results(_simulator):
+    connection = _simulator._connections['main']
+    return {
+        'corrupt_message_count': connection._corrupt_message_count,
+        'skip_message_count': connection._skip_message_count,
+        'pending_messages_at_end': len(connection._pending_messages),
+        'in_flight_messages_at_end': len(connection._in_flight_messages),
+        'sent_messages': connection._total_sent,
+        'messages': connection._total_received,
+        'mode': config.MODE,
+        'initial_window': config.INITIAL_WINDOW,
+        'initial_timeout': config.INITIAL_TIMEOUT,
+        'time': _simulator.time(),
+        'events': _simulator._next_index,
+        'receiver_link': _simulator._links['forward'].json_info(),
+        'sender_link': _simulator._links['backward'].json_info(),
+    }
+
+def generate_messages(count):
+    messages = []
+    for i in range(count):
+        messages.append(Message(
+            data=f'M{i:#019x}'.encode('utf-8'),
+            is_end = (i == count - 1)
+        ))
+    return messages
+
+def run_replication(args):
+    _simulator = setup(args, generate_messages(args.generate_input))
     _simulator.run()
+    return json_results(_simulator)
+
+def run_replications(args):
+    seeds, summary = replications.run_replications(
+        run_replication, args, args.replications,
+        ci_metric=args.ci_metric, ci_target=args.ci_target,
+    )
     if args.json:
         json.dump({
-            'corrupt_message_count': connection._corrupt_message_count,
-            'skip_message_count': connection._skip_message_count,
-            'pending_messages_at_end': len(connection._pending_messages),
-            'in_flight_messages_at_end': len(connection._in_flight_messages),
-            'sent_messages': connection._total_sent,
-            'messages': connection._total_received,
+            'replications': len(seeds),
+            'seeds': seeds,
             'mode': config.MODE,
-            'initial_window': config.INITIAL_WINDOW,
-            'initial_timeout': config.INITIAL_TIMEOUT,
-            'time': _simulator.time(),
-            'receiver_link': _simulator._links['forward'].json_info(),
-            'sender_link': _simulator._links['backward'].json_info(),
+            'metrics': summary,
         }, fp=sys.stdout, indent=2)
         sys.stdout.write('\n')
+    else:
+        replications.print_summary(seeds, summary)
+
+def run(args, messages):
+    _simulator = setup(args, messages)
+    connection = _simulator._connections['main']
+    _simulator.run()
+    if args.json:
+        json.dump(json_results(_simulator), fp=sys.stdout, indent=2)
+        sys.stdout.write('\n')
     else:
         if connection._skip_message_count > 0 or connection._corrupt_message_count > 0:
             print(f'ERROR --- one or more messages corrupted or missing')
@@ -122,6 +163,15 @@ if __name__ == '__main__':
 
     input_group = parser.add_argument_group('simulated input settings')
     input_group.add_argument('--generate-input', type=int, help='generate input of this number of messages', metavar='COUNT', required=True)
+    input_group.add_argument('--seed', type=int, help='random seed (default: 42)', default=42)
+    input_group.add_argument('--replications', metavar='N', type=int,
+        help='run up to N replications with seeds --seed, --seed + 1, ... in parallel and report '
+             'the mean and 95%% confidence interval of each statistic', default=None)
+    input_group.add_argument('--ci-target', metavar='FRACTION', type=float,
+        help='stop --replications early once the 95%% confidence interval half-width of --ci-metric '
+             'is at most FRACTION of its mean', default=None)
+    input_group.add_argument('--ci-metric', metavar='NAME', type=str,
+        help='statistic checked by --ci-target (default: time)', default='time')
 
     sim_group = parser.add_argument_group('simulated link settings')
     sim_group.add_argument('--drop', metavar='DROP-RATE',
@@ -147,10 +197,10 @@ if __name__ == '__main__':
     args = parser.parse_args()
     for item in config_items:
         config.__dict__[item] = args.__dict__[item]
-    messages = []
-    for i in range(args.generate_input):
-        messages.append(Message(
-            data=f'M{i:#019x}'.encode('utf-8'),
-            is_end = (i == args.generate_input - 1)
-        ))
-    run(args,  messages)
+    if args.replications != None and config.EVENT_TRACE:
+        print("--replications cannot be used with --event-trace")
+        sys.exit(1)
+    if args.replications != None:
+        run_replications(args)
+    else:
+        run(args, generate_messages(args.generate_input))
@@ -0,0 +1,88 @@
+import config
+
+import copy
+import math
+import os
+import re
+from concurrent.futures import ProcessPoolExecutor
+
+"""Two-sided 95% critical values of Student's t distribution for 1 to 30 degrees of freedom."""
+T_975 = [
+    12.706, 4.303, 3.182, 2.776, 2.571, 2.447, 2.365, 2.306, 2.262, 2.228,
+    2.201, 2.179, 2.160, 2.145, 2.131, 2.120, 2.110, 2.101, 2.093, 2.086,
+    2.080, 2.074, 2.069, 2.064, 2.060, 2.056, 2.052, 2.048, 2.045, 2.042,
+]
+
+def t_975(degrees_of_freedom: int) -> float:
+    if degrees_of_freedom <= len(T_975):
+        return T_975[degrees_of_freedom - 1]
+    return 1.96
+
+def flatten(data, prefix='') -> dict[str, float]:
+    """Collect the numeric values in nested JSON-style data, naming them like 'c1.latency_mean'."""
+    result = {}
+    if isinstance(data, dict):
+        for key, value in data.items():
+            result.update(flatten(value, f'{prefix}{key}.'))
+    elif isinstance(data, (int, float)) and not isinstance(data, bool):
+        result[prefix[:-1]] = float(data)
+    return result
+
+def summarize(samples: list[dict[str, float]]) -> dict[str, dict[str, float]]:
+    """Mean, standard deviation and 95% confidence interval half-width of each metric."""
+    result = {}
+    for name in samples[0]:
+        values = [sample[name] for sample in samples if name in sample and not math.isnan(sample[name])]
+        if len(values) == 0:
+            continue
+        mean = sum(values) / len(values)
+        if len(values) > 1:
+            sd = math.sqrt(sum((value - mean) ** 2 for value in values) / (len(values) - 1))
+            ci95 = t_975(len(values) - 1) * sd / math.sqrt(len(values))
+        else:
+            sd = float('nan')
+            ci95 = float('nan')
+        result[name] = {'mean': mean, 'sd': sd, 'ci95': ci95, 'count': len(values)}
+    return result
+
+def _run_one(run_function, args, seed):
+    # Worker processes may not inherit the config.py settings from the command line
+    for item in dir(config):
+        if re.match(r'[A-Z]+', item) and hasattr(args, item):
+            config.__dict__[item] = getattr(args, item)
+    args = copy.copy(args)
+    args.seed = seed
+    return flatten(run_function(args))
+
+def run_replications(run_function, args, count, ci_metric=None, ci_target=None, workers=None):
+    """Call run_function(args) with args.seed set to args.seed, args.seed + 1, ..., in parallel worker
+    processes, and summarize the numeric values in the dicts it returns.
+
+    If ci_target is set, stop before `count` replications once the 95% confidence interval
+    half-width of ci_metric is at most ci_target times its mean.
+
+    Returns (seeds used, summary).
+    """
+    if workers == None:
+        workers = min(count, os.cpu_count() or 1)
+    seeds = []
+    samples = []
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        while len(seeds) < count:
+            batch = [args.seed + i for i in range(len(seeds), min(count, len(seeds) + workers))]
+            samples.extend(executor.map(_run_one, [run_function] * len(batch), [args] * len(batch), batch))
+            seeds.extend(batch)
+            if ci_target != None and len(samples) > 1:
+                summary = summarize(samples)
+                if ci_metric not in summary:
+                    raise ValueError(f'unknown metric {ci_metric!r}; expected one of {", ".join(summary)}')
+                metric = summary[ci_metric]
+                if metric['ci95'] <= ci_target * abs(metric['mean']):
+                    break
+    return seeds, summarize(samples)
+
+def print_summary(seeds, summary):
+    print(f'{len(seeds)} replications (seeds {seeds[0]} to {seeds[-1]}):')
+    width = max(len(name) for name in summary)
+    for name, metric in summary.items():
+        print(f'  {name:{width}s}  {metric["mean"]:12.4g} +/- {metric["ci95"]:.4g} (95% CI)')
@@ -0,0 +1,86 @@
+import argparse
+import re
+import sys
+
+import config
+
+from main import generate_messages, setup
+
+def run_sliding_window(seed, count, drop=0.0, delay_variance=0.0, bandwidth=float('inf'), ack_every=1):
+    """Send `count` generated messages with sequence numbers 0-7 and a window of 4, so they wrap
+    around many times, and return (the data of the messages delivered, the connection)."""
+    config.MODE = 'sliding-window'
+    config.MAXIMUM_SEQUENCE = 8
+    config.INITIAL_WINDOW = 4
+    config.ACK_EVERY = ack_every
+    config.TRACE = set()
+    args = argparse.Namespace(
+        seed=seed,
+        drop_forward=drop,
+        drop_backward=drop,
+        delay=1.0,
+        delay_variance=delay_variance,
+        bandwidth_forward=bandwidth,
+        bandwidth_backward=bandwidth,
+        buffer=1000000,
+    )
+    _simulator = setup(args, generate_messages(count))
+    connection = _simulator._connections['main']
+    receiver = connection._receiver
+    delivered = []
+    record_received = receiver.to_application
+    def to_application(message):
+        delivered.append(message.data)
+        record_received(message)
+    receiver.to_application = to_application
+    _simulator.run()
+    return delivered, connection
+
+def check_delivered(delivered, connection, count):
+    expected = [message.data for message in generate_messages(count)]
+    assert connection._corrupt_message_count == 0 and connection._skip_message_count == 0, \
+        (connection._corrupt_message_count, connection._skip_message_count)
+    assert len(delivered) == count, f'delivered {len(delivered)} of {count} messages'
+    assert b''.join(delivered) == b''.join(expected), 'delivered byte stream differs from the one sent'
+
+def test_sliding_window_wraparound_drop_reorder():
+    """Old copies and old ACKs delayed past a whole cycle of sequence numbers are not mistaken for new ones."""
+    for seed in (1, 2, 3):
+        delivered, connection = run_sliding_window(seed, 1000, drop=0.2, delay_variance=0.5)
+        check_delivered(delivered, connection, 1000)
+
+def test_sliding_window_wraparound_delayed_acks():
+    for seed in (1, 2):
+        delivered, connection = run_sliding_window(seed, 1000, drop=0.3, delay_variance=0.2, bandwidth=10, ack_every=3)
+        check_delivered(delivered, connection, 1000)
+
+TESTS = [
+    ('sliding-window-wraparound-drop-reorder', test_sliding_window_wraparound_drop_reorder),
+    ('sliding-window-wraparound-delayed-acks', test_sliding_window_wraparound_delayed_acks),
+]
+
+def main():
+    parser = argparse.ArgumentParser(description='Run tests of the hw2 reliable transfer protocols.')
+    parser.add_argument('--only-test', metavar='REGEX', default=None, help='only run tests whose label matches REGEX')
+    parser.add_argument('--keep-going', action='store_true', default=False, help='keep going after a failed test')
+    args = parser.parse_args()
+    failed = False
+    for label, function in TESTS:
+        if args.only_test and not re.match(args.only_test, label):
+            continue
+        try:
+            function()
+            print(f'{label}: passed')
+        except AssertionError as e:
+            print(f'{label}: FAILED: {e}')
+            failed = True
+            if not args.keep_going:
+                break
+    if failed:
+        print('*** Failed at least one test')
+        sys.exit(1)
+    else:
+        print('*** All tests passed')
+
+if __name__ == '__main__':
+    main()
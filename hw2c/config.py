@@ -12,9 +12,27 @@ MAXIMUM_SEQUENCE = 1000000
 """maximum window size for `variable-sliding` mode."""
 MAXIMUM_WINDOW = 100
 
+"""congestion control algorithm for `variable-sliding` mode; one of 'reno', 'cubic', 'vegas'"""
+CC = 'reno'
+
+"""in `variable-sliding` mode, space out new packets at the estimated bottleneck rate instead of sending a window at once"""
+PACING = False
+
 """default timeout to use for resending packets."""
 INITIAL_TIMEOUT = 100
 
+"""file name prefix for window/RTT/queue depth telemetry output; empty to disable telemetry"""
+TELEMETRY = 'last-telemetry'
+
+"""format of telemetry output; one of 'csv' (one file per connection/link and series) or 'binary' (columnar, one file per connection/link)"""
+TELEMETRY_FORMAT = 'csv'
+
+"""number of telemetry samples to keep in memory per series before writing them out"""
+TELEMETRY_BATCH = 4096
+
+"""file for a binary trace of link events (see event_trace.py); empty to disable"""
+EVENT_TRACE = ''
+
 """types of events to output trace info for.
 
 'all' matches all event, otherwise, name listed much last type passed as first arg to trace() function."""
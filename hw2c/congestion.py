@@ -0,0 +1,196 @@
+import config
+from abc import ABC, abstractmethod
+from collections import deque
+from util import now, trace
+
+class CongestionControl(ABC):
+    """Base class for the congestion control algorithms used by MySender in 'variable-sliding' mode.
+
+    Subclasses keep a (possibly fractional) congestion window in `self.window` and
+    update it from ACK and loss events. The sender only looks at `window_size`.
+    """
+    def __init__(self):
+        self.window = float(config.INITIAL_WINDOW)
+        self.srtt = None
+        self.rttvar = None
+        self.min_rtt = float('inf')
+
+    @property
+    def window_size(self) -> int:
+        """Current window in packets, bounded to [1, config.MAXIMUM_WINDOW]."""
+        return max(1, min(int(self.window), config.MAXIMUM_WINDOW))
+
+    def _clamp(self):
+        self.window = max(1.0, min(self.window, float(config.MAXIMUM_WINDOW)))
+
+    @property
+    def rto(self) -> float:
+        """Retransmission timeout (RFC 6298), or config.INITIAL_TIMEOUT before any RTT sample.
+
+        Simulated RTTs can be almost constant, so this is at least twice the smoothed RTT
+        (playing the role of RFC 6298's 1 second minimum).
+        """
+        if self.srtt is None:
+            return config.INITIAL_TIMEOUT
+        return max(self.srtt + 4 * self.rttvar, 2 * self.srtt)
+
+    def on_rtt_sample(self, rtt: float):
+        self.min_rtt = min(self.min_rtt, rtt)
+        if self.srtt is None:
+            self.srtt = rtt
+            self.rttvar = rtt / 2
+        else:
+            self.rttvar = 0.75 * self.rttvar + 0.25 * abs(self.srtt - rtt)
+            self.srtt = 0.875 * self.srtt + 0.125 * rtt
+
+    @abstractmethod
+    def on_ack(self, acked_count: int):
+        """Called when a cumulative ACK newly acknowledges `acked_count` packets."""
+
+    @abstractmethod
+    def on_loss(self):
+        """Called once per loss episode (timeout or triple duplicate ACK)."""
+
+
+class RenoCongestionControl(CongestionControl):
+    """Reno-style AIMD: slow start up to ssthresh, then +1 packet per window of ACKs; halve on loss."""
+    def __init__(self):
+        super().__init__()
+        self.ssthresh = float(config.MAXIMUM_WINDOW)
+
+    def on_ack(self, acked_count: int):
+        for _ in range(acked_count):
+            if self.window < self.ssthresh:
+                self.window += 1.0
+            else:
+                self.window += 1.0 / self.window
+        self._clamp()
+
+    def on_loss(self):
+        self.ssthresh = max(self.window / 2, 2.0)
+        self.window = self.ssthresh
+        self._clamp()
+
+
+class CubicCongestionControl(CongestionControl):
+    """CUBIC window growth (RFC 8312), with time measured in smoothed round trips."""
+    C = 0.4
+    BETA = 0.7
+
+    def __init__(self):
+        super().__init__()
+        self.ssthresh = float(config.MAXIMUM_WINDOW)
+        self.w_max = 0.0
+        self.epoch_start = None
+        self.k = 0.0
+        self.w_est = 0.0
+
+    def on_ack(self, acked_count: int):
+        if self.window < self.ssthresh:
+            self.window += acked_count
+            self._clamp()
+            return
+        rtt = self.srtt or 1.0
+        if self.epoch_start is None:
+            self.epoch_start = now()
+            if self.window < self.w_max:
+                self.k = ((self.w_max - self.window) / self.C) ** (1 / 3)
+            else:
+                self.k = 0.0
+                self.w_max = self.window
+            self.w_est = self.window
+        t = (now() - self.epoch_start) / rtt
+        target = self.C * (t - self.k) ** 3 + self.w_max
+        # TCP-friendly region: never grow slower than Reno would
+        self.w_est += acked_count * 3 * (1 - self.BETA) / (1 + self.BETA) / self.window
+        target = max(target, self.w_est)
+        if target > self.window:
+            self.window += acked_count * (target - self.window) / self.window
+        self._clamp()
+
+    def on_loss(self):
+        self.epoch_start = None
+        self.w_max = self.window
+        self.window = max(self.window * self.BETA, 2.0)
+        self.ssthresh = self.window
+        self._clamp()
+
+
+class VegasCongestionControl(CongestionControl):
+    """Delay-based (Vegas-style) control: keep between ALPHA and BETA packets queued at the bottleneck."""
+    ALPHA = 2
+    BETA = 4
+    GAMMA = 1
+
+    def __init__(self):
+        super().__init__()
+        self.slow_start = True
+        self.round_end = 0.0
+        self.round_min_rtt = float('inf')
+
+    def on_rtt_sample(self, rtt: float):
+        super().on_rtt_sample(rtt)
+        # Like Vegas, use the smallest RTT seen in each round to filter out delay noise
+        self.round_min_rtt = min(self.round_min_rtt, rtt)
+
+    def on_ack(self, acked_count: int):
+        if self.round_min_rtt == float('inf') or now() < self.round_end:
+            return
+        # Adjust at most once per round trip
+        rtt = self.round_min_rtt
+        self.round_end = now() + self.srtt
+        self.round_min_rtt = float('inf')
+        queued = self.window * (1 - self.min_rtt / rtt)
+        trace('cc', f'vegas: window={self.window:.1f} rtt={rtt:.2f} base={self.min_rtt:.2f} queued={queued:.2f}')
+        if self.slow_start:
+            if queued > self.GAMMA:
+                self.slow_start = False
+                self.window -= queued
+            else:
+                self.window *= 2
+        elif queued < self.ALPHA:
+            self.window += 1
+        elif queued > self.BETA:
+            self.window -= 1
+        self._clamp()
+
+    def on_loss(self):
+        self.slow_start = False
+        self.window = max(self.window * 3 / 4, 2.0)
+        self._clamp()
+
+
+CONGESTION_CONTROLS = {
+    'reno': RenoCongestionControl,
+    'cubic': CubicCongestionControl,
+    'vegas': VegasCongestionControl,
+}
+
+def new_congestion_control(name: str) -> CongestionControl:
+    """Create the congestion control algorithm called `name` (see config.CC)."""
+    if name not in CONGESTION_CONTROLS:
+        raise ValueError(f'unknown congestion control {name!r}; expected one of {", ".join(CONGESTION_CONTROLS)}')
+    return CONGESTION_CONTROLS[name]()
+
+
+class BottleneckBandwidthFilter:
+    """BBR-style bottleneck bandwidth estimate: windowed maximum of delivery rate samples.
+
+    Uses a monotonic deque so each sample costs O(1) amortized.
+    """
+    def __init__(self, window: float):
+        self.window = window
+        self.samples = deque()  # (time, rate), rates decreasing
+
+    def update(self, time: float, rate: float):
+        while len(self.samples) > 0 and self.samples[-1][1] <= rate:
+            self.samples.pop()
+        self.samples.append((time, rate))
+        while self.samples[0][0] < time - self.window:
+            self.samples.popleft()
+
+    @property
+    def rate(self) -> float | None:
+        if len(self.samples) == 0:
+            return None
+        return self.samples[0][1]
@@ -1,5 +1,7 @@
 import config
-from util import Packet, Message, trace, now, create_timer, cancel_timer
+import copy
+from congestion import BottleneckBandwidthFilter, new_congestion_control
+from util import Packet, Message, trace, now, create_timer, cancel_timer, record
 from collections import deque
 from dataclasses import dataclass
 from typing import Any
@@ -17,49 +19,138 @@ def _delta(i, j) -> int:
     """
     return (j - i + config.MAXIMUM_SEQUENCE + 1) % (config.MAXIMUM_SEQUENCE + 1)
 
+"""Multipliers applied to the bottleneck rate estimate in successive round trips when pacing."""
+PACING_GAIN_CYCLE = [1.25, 0.75, 1, 1, 1, 1, 1, 1]
+
 @dataclass
 class SendPacketInfo:
     packet: Packet
     timer: Any
+    send_time: float = 0.0
+    retransmitted: bool = False
+    # for delivery rate samples: packets delivered and time of last delivery when sent
+    delivered: int = 0
+    delivered_time: float = 0.0
 
 class MySender:
     def __init__(self):
-        self.window_size = config.INITIAL_WINDOW
+        self.cc = new_congestion_control(config.CC)
+        self.window_size = self.cc.window_size
         self.last_adjust_time = 0
         self.last_frame_sent = config.MAXIMUM_SEQUENCE
         self.last_ack_received = config.MAXIMUM_SEQUENCE
         self.queue = {}
+        self.duplicate_acks = 0
+        self.duplicate_ack_threshold = 3
+        # Congestion control state before the last loss, in case it turns out to be spurious
+        self.undo_cc = None
+        self.undo_fast_retransmit = False
+        # Doubled on each timeout, reset by new ACKs
+        self.rto_backoff = 1
+        # While recovering from a loss, don't reduce the window again until this is ACKed
+        self.recovery_point = None
 
-        # Create output file
-        self.output_file = open('last-window-sizes.csv', 'w')
-        self.output_file.write('time,window\n')
+        # Delivery rate estimation and pacing
+        self.delivered = 0
+        self.delivered_time = 0.0
+        self.bottleneck = BottleneckBandwidthFilter(window=config.INITIAL_TIMEOUT)
+        self.next_send_time = 0.0
+        self.pacing_timer = None
+        self.pacing_phase = 0
+        self.pacing_phase_start = 0.0
 
     def _do_adjust_window(self, window_size: int):
+        if window_size == self.window_size:
+            return
         self.window_size = window_size
         self.last_adjust_time = now()
-        self.output_file.write(f'{self.last_adjust_time},{window_size}\n')
+        record(self._label, 'window', window_size)
         trace('sender', f'set window size to {self.window_size}')
 
+    def _do_loss(self, fast_retransmit: bool = False):
+        if self.recovery_point is not None:
+            # Already reduced for this loss episode
+            return
+        self.recovery_point = self.last_frame_sent
+        # Snapshot the state from before the first reduction of the episode, which is what an
+        # undo restores. The congestion controls only hold numbers, so a shallow copy is enough.
+        self.undo_cc = copy.copy(self.cc)
+        self.undo_fast_retransmit = fast_retransmit
+        self.cc.on_loss()
+        self._do_adjust_window(self.cc.window_size)
+
     def _do_resend_packet(self, packet: Packet):
         trace('sender', f'timeout for packet {packet.seq_num}')
-        # Decrease window size
-        new_window_size = max(self.window_size // 2, 1)
-        if self.window_size > 1:
-            self._do_adjust_window(new_window_size)
-
-        # TODO don't decrease again until recovering
-        # TODO don't resend if outside window
-        self._do_send_packet(packet)
+        item = self.queue.get(packet.seq_num)
+        if item is None:
+            # Already ACKed
+            return
+        if packet.seq_num != _next(self.last_ack_received):
+            # Only the oldest packet is resent; later ones are probably waiting behind it at the receiver
+            item.timer = create_timer(self.cc.rto * self.rto_backoff, lambda: self._do_resend_packet(packet))
+            return
+        self._do_loss()
+        self.rto_backoff = min(self.rto_backoff * 2, 64)
+        self._do_send_packet(packet, retransmitted=True)
 
-    def _do_send_packet(self, packet: Packet):
+    def _do_send_packet(self, packet: Packet, retransmitted: bool = False):
+        old_item = self.queue.get(packet.seq_num)
+        if old_item is not None and old_item.timer is not None:
+            cancel_timer(old_item.timer)
         self.to_network(packet)
         self.queue[packet.seq_num] = \
             SendPacketInfo(
                 packet=packet,
-                timer=create_timer(config.INITIAL_TIMEOUT, lambda: self._do_resend_packet(packet)),
+                timer=create_timer(self.cc.rto * self.rto_backoff, lambda: self._do_resend_packet(packet)),
+                send_time=now(),
+                retransmitted=retransmitted,
+                delivered=self.delivered,
+                delivered_time=self.delivered_time,
             )
         trace('sender', f'sent packet {packet.seq_num}')
 
+    def _pacing_rate(self) -> float | None:
+        rate = self.bottleneck.rate
+        if rate is None and self.cc.srtt:
+            # No delivery rate samples yet; spread one window over a round trip
+            rate = self.window_size / self.cc.srtt
+        if rate is None:
+            return None
+        # Like BBR's ProbeBW state, cycle the gain each round trip so that a higher rate is
+        # probed for and then any queue built up is drained
+        if self.cc.srtt and now() - self.pacing_phase_start >= self.cc.srtt:
+            self.pacing_phase = (self.pacing_phase + 1) % len(PACING_GAIN_CYCLE)
+            self.pacing_phase_start = now()
+        return rate * PACING_GAIN_CYCLE[self.pacing_phase]
+
+    def _do_pacing_timeout(self):
+        self.pacing_timer = None
+        self.ready_for_more_from_application()
+
+    def _check_pacing(self) -> bool:
+        """Returns whether a new packet may be sent now; if not, arranges to ask for more later."""
+        current_time = now()
+        if current_time + 1e-9 >= self.next_send_time:
+            return True
+        if self.pacing_timer is None:
+            self.pacing_timer = create_timer(
+                self.next_send_time - current_time,
+                lambda: self._do_pacing_timeout(),
+                f'pacing for {self._label}',
+            )
+        return False
+
+    def _do_sample_delivery_rate(self, item: SendPacketInfo):
+        interval = now() - item.delivered_time
+        if interval <= 0:
+            return
+        rate = (self.delivered - item.delivered) / interval
+        if self.cc.srtt:
+            # Like BBR, take the maximum over about 10 round trips
+            self.bottleneck.window = 10 * self.cc.srtt
+        self.bottleneck.update(now(), rate)
+        record(self._label, 'bottleneck', self.bottleneck.rate)
+
     def from_application(self, message: Message) -> bool:
         missing_count = _delta(self.last_ack_received, self.last_frame_sent)
         trace('sender', f'missing_count = {missing_count}')
@@ -67,6 +158,8 @@ class MySender:
         if missing_count >= self.window_size:
             # Packet not window
             return False
+        elif config.PACING and not self._check_pacing():
+            return False
         else:
             # Send packet
             packet = Packet()
@@ -75,6 +168,10 @@ class MySender:
             self.last_frame_sent = packet.seq_num = _next(self.last_frame_sent)
             assert packet.seq_num <= config.MAXIMUM_SEQUENCE
             self._do_send_packet(packet)
+            if config.PACING:
+                rate = self._pacing_rate()
+                if rate:
+                    self.next_send_time = max(self.next_send_time, now()) + 1.0 / rate
             return True
 
     def from_network(self, packet: Packet):
@@ -84,21 +181,72 @@ class MySender:
         # So we'll get a big positive _delta is packet.ack_num is before LAR
         if _delta(self.last_ack_received, packet.ack_num) > config.MAXIMUM_WINDOW:
             trace('sender', f'ignoring ACK {packet.ack_num} that appears to be old')
+        elif packet.ack_num == self.last_ack_received:
+            self.duplicate_acks += 1
+            if self.duplicate_acks == self.duplicate_ack_threshold and self.recovery_point is None:
+                # Fast retransmit the first missing packet
+                item = self.queue.get(_next(self.last_ack_received))
+                if item is not None:
+                    trace('sender', f'fast retransmit of packet {item.packet.seq_num}')
+                    self._do_loss(fast_retransmit=True)
+                    self._do_send_packet(item.packet, retransmitted=True)
         else:
             # Mark all sequence numbers covered by new ACK as done
+            self.duplicate_acks = 0
+            self.rto_backoff = 1
+            acked_count = 0
+            last_item = None
+            # Karn's algorithm: only sample RTT if nothing covered by this ACK was resent
+            sample_rtt = self.recovery_point is None
             while self.last_ack_received != packet.ack_num:
                 trace('sender', f'marking {self.last_ack_received} as done for {packet.ack_num}')
                 self.last_ack_received = _next(self.last_ack_received)
                 item = self.queue.pop(self.last_ack_received, None)
-                if item is not None and item.timer is not None:
-                    cancel_timer(item.timer)
+                if item is not None:
+                    acked_count += 1
+                    self.delivered += 1
+                    last_item = item
+                    if item.timer is not None:
+                        cancel_timer(item.timer)
+                    if item.retransmitted:
+                        sample_rtt = False
+                    if item.retransmitted and self.undo_cc is not None and \
+                            now() - item.send_time < self.cc.min_rtt:
+                        # ACK came back too soon to be for the retransmission, so the original
+                        # was just reordered or delayed: undo the window reduction.
+                        # This is intentionally a heuristic. item.send_time is the time of the
+                        # retransmission (_do_send_packet replaced the original's entry), and an
+                        # ACK for it cannot arrive before a whole minimum RTT has passed. A
+                        # spurious retransmission whose ACK is slower than that is not undone,
+                        # and a min_rtt estimate above the true minimum could undo a real loss.
+                        trace('sender', f'retransmission of packet {self.last_ack_received} was spurious')
+                        self.cc = self.undo_cc
+                        self.undo_cc = None
+                        self.recovery_point = None
+                        if self.undo_fast_retransmit:
+                            # Tolerate more reordering before the next fast retransmit
+                            self.duplicate_ack_threshold = min(self.duplicate_ack_threshold + 1, config.MAXIMUM_WINDOW)
+                if self.last_ack_received == self.recovery_point:
+                    self.recovery_point = None
+            if last_item is not None:
+                self.delivered_time = now()
+                if sample_rtt:
+                    rtt = now() - last_item.send_time
+                    record(self._label, 'rtt', rtt)
+                    self.cc.on_rtt_sample(rtt)
+                if not last_item.retransmitted:
+                    self._do_sample_delivery_rate(last_item)
 
-        # Increase window size
-        current_time = now()
-        if current_time - self.last_adjust_time >= config.INITIAL_TIMEOUT:
-            new_window_size = self.window_size + 1
-            if new_window_size <= config.MAXIMUM_WINDOW:
-                self._do_adjust_window(new_window_size)
+            if self.recovery_point is not None:
+                # Partial ACK during recovery: the next packet was probably lost too
+                item = self.queue.get(_next(self.last_ack_received))
+                if item is not None:
+                    trace('sender', f'partial ACK; retransmitting packet {item.packet.seq_num}')
+                    self._do_send_packet(item.packet, retransmitted=True)
+            else:
+                # Only grow the window once recovered
+                self.cc.on_ack(acked_count)
+                self._do_adjust_window(self.cc.window_size)
 
         # Check for new packets
         missing_count = _delta(self.last_ack_received, self.last_frame_sent)
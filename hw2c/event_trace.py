@@ -0,0 +1,179 @@
+"""Binary event traces of link events.
+
+This file is the same in hw2, hw2c and hw4; each homework directory is run on its own, so a
+change here should be copied to the others.
+"""
+
+import config
+
+import argparse
+import contextlib
+import csv
+import json
+import mmap
+import os
+import struct
+from typing import Iterator
+
+"""Magic number at the start of binary event trace files."""
+EVENT_TRACE_MAGIC = b'EVT1'
+
+"""File header: magic number, number of records."""
+HEADER = struct.Struct('<4sQ')
+
+"""One record: time, kind, connection, link, seq_num, ack_num, buffer depth.
+
+seq_num and ack_num are -1 if the packet did not have one. Kinds, connections and links
+are indices into the name tables in the JSON footer after the last record.
+"""
+RECORD = struct.Struct('<dBBBxiiI')
+
+"""Kinds of recorded events, and the codes passed to EventTraceRecorder.record() for them."""
+KINDS = ['enqueue', 'buffer-drop', 'send', 'random-drop', 'deliver', 'evict']
+ENQUEUE, BUFFER_DROP, SEND, RANDOM_DROP, DELIVER, EVICT = range(len(KINDS))
+
+class _Codes(dict):
+    """Maps names to the codes recorded for them, numbering new names as they are seen."""
+    def __missing__(self, name):
+        code = self[name] = len(self)
+        return code
+
+class EventTraceRecorder:
+    """Records link events as fixed-width binary records in a memory-mapped file.
+
+    The file grows by `chunk_records` records at a time. close() trims it and appends a JSON
+    footer with the connection and link names, so read_event_trace() can decode it later.
+    """
+    def __init__(self, path, chunk_records=65536):
+        self._path = path
+        self._chunk_size = chunk_records * RECORD.size
+        self._file = open(path, 'w+b')
+        self._file.truncate(HEADER.size + self._chunk_size)
+        self._map = mmap.mmap(self._file.fileno(), 0)
+        self._offset = HEADER.size
+        self._end = HEADER.size + self._chunk_size
+        self._connections = _Codes()
+        self._links = _Codes()
+        self._pack_into = RECORD.pack_into
+
+    def link_code(self, link) -> int:
+        """The code to pass to record() for the link or buffer labelled `link`."""
+        return self._links[link]
+
+    def record(self, time, kind, connection, link, packet, depth):
+        """Record an event of kind `kind` (ENQUEUE, ...) for `packet` of connection `connection`
+        on the link with code `link` (from link_code()), with `depth` packets buffered."""
+        offset = self._offset
+        if offset == self._end:
+            self._end += self._chunk_size
+            self._map.resize(self._end)
+        seq_num = packet.seq_num
+        ack_num = packet.ack_num
+        self._pack_into(
+            self._map, offset, time, kind, self._connections[connection], link,
+            -1 if seq_num is None else seq_num,
+            -1 if ack_num is None else ack_num,
+            depth,
+        )
+        self._offset = offset + RECORD.size
+
+    def close(self):
+        count = (self._offset - HEADER.size) // RECORD.size
+        HEADER.pack_into(self._map, 0, EVENT_TRACE_MAGIC, count)
+        self._map.flush()
+        self._map.close()
+        self._file.truncate(self._offset)
+        self._file.seek(self._offset)
+        self._file.write(json.dumps({
+            'kinds': KINDS,
+            'connections': list(self._connections),
+            'links': list(self._links),
+        }).encode('UTF-8'))
+        self._file.close()
+
+def new_event_trace_recorder() -> EventTraceRecorder | None:
+    """Create an EventTraceRecorder writing to config.EVENT_TRACE, or None if it is empty."""
+    if config.EVENT_TRACE:
+        return EventTraceRecorder(config.EVENT_TRACE)
+    return None
+
+def read_event_trace(path) -> tuple[dict, Iterator[tuple]]:
+    """Read a binary event trace. Returns the name tables and an iterator over the records
+    (time, kind, connection, link, seq_num, ack_num, depth) with names instead of indices.
+
+    The records are decoded one at a time from a memory map of the file as they are iterated
+    over, so memory use does not depend on the length of the trace.
+    """
+    with open(path, 'rb') as f:
+        data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+    magic, count = HEADER.unpack_from(data, 0)
+    if magic != EVENT_TRACE_MAGIC:
+        data.close()
+        raise ValueError(f'{path} is not a binary event trace')
+    end = HEADER.size + count * RECORD.size
+    names = json.loads(data[end:].decode('UTF-8'))
+    return names, _iter_records(data, end, names)
+
+def _iter_records(data, end, names):
+    kinds, connections, links = names['kinds'], names['connections'], names['links']
+    view = memoryview(data)[HEADER.size:end]
+    records = RECORD.iter_unpack(view)
+    try:
+        for time, kind, connection, link, seq_num, ack_num, depth in records:
+            yield time, kinds[kind], connections[connection], links[link], seq_num, ack_num, depth
+    finally:
+        # The map cannot be closed while the iterator and view still refer to it
+        del records
+        view.release()
+        data.close()
+
+def _file_name(name) -> str:
+    return name.replace('/', '-')
+
+def _open_csv(stack, path, header):
+    writer = csv.writer(stack.enter_context(open(path, 'w', newline='')))
+    writer.writerow(header)
+    return writer
+
+def analyze(path, prefix):
+    """Write, for each connection, the sequence numbers sent and ACK numbers delivered over time,
+    and for each link, its buffer depth over time, as CSV files starting with `prefix`.
+
+    The trace is read in a single pass, writing each record to the files it belongs in.
+    """
+    names, records = read_event_trace(path)
+    counts = dict.fromkeys(names['kinds'], 0)
+    with contextlib.ExitStack() as stack:
+        seq_writers = {
+            connection: _open_csv(stack, f'{prefix}-{_file_name(connection)}-seq.csv', ['time', 'seq_num', 'link'])
+            for connection in names['connections']
+        }
+        ack_writers = {
+            connection: _open_csv(stack, f'{prefix}-{_file_name(connection)}-ack.csv', ['time', 'ack_num', 'link'])
+            for connection in names['connections']
+        }
+        queue_writers = {
+            link: _open_csv(stack, f'{prefix}-{_file_name(link)}-queue.csv', ['time', 'depth'])
+            for link in names['links']
+        }
+        for time, kind, connection, link, seq_num, ack_num, depth in records:
+            counts[kind] += 1
+            if kind == 'send':
+                if seq_num >= 0:
+                    seq_writers[connection].writerow((time, seq_num, link))
+                queue_writers[link].writerow((time, depth))
+            elif kind == 'enqueue' or kind == 'evict':
+                queue_writers[link].writerow((time, depth))
+            elif kind == 'deliver' and ack_num >= 0:
+                ack_writers[connection].writerow((time, ack_num, link))
+    print(f'{sum(counts.values())} records from {os.path.getsize(path)} bytes')
+    for kind, count in counts.items():
+        if count > 0:
+            print(f'  {kind}: {count}')
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Reconstruct sequence number and queue depth plots from a binary event trace.')
+    parser.add_argument('trace', help='event trace file written with --event-trace')
+    parser.add_argument('--prefix', default=None, help='prefix of output CSV files (default: the trace file name)')
+    args = parser.parse_args()
+    analyze(args.trace, args.prefix or args.trace)
@@ -9,7 +9,7 @@ import sys
 from util import Message
 from simulator import Simulator, Event
 
-def run(args, messages):
+def setup(args, messages):
     sender = ends.MySender()
     receiver = ends.MyReceiver()
     _simulator = util._simulator = Simulator(args)
@@ -43,6 +43,20 @@ def run(args, messages):
             description='initial data send'
         ),
     )
+    return _simulator
+
+def generate_messages(count):
+    messages = []
+    for i in range(count):
+        messages.append(Message(
+            data=f'M{i:#019x}'.encode('utf-8'),
+            is_end = (i == count - 1)
+        ))
+    return messages
+
+def run(args, messages):
+    _simulator = setup(args, messages)
+    connection = _simulator._connections['main']
     _simulator.run()
     if args.json:
         json.dump({
@@ -147,10 +161,4 @@ if __name__ == '__main__':
     args = parser.parse_args()
     for item in config_items:
         config.__dict__[item] = args.__dict__[item]
-    messages = []
-    for i in range(args.generate_input):
-        messages.append(Message(
-            data=f'M{i:#019x}'.encode('utf-8'),
-            is_end = (i == args.generate_input - 1)
-        ))
-    run(args,  messages)
+    run(args, generate_messages(args.generate_input))
@@ -2,6 +2,8 @@ import config
 import copy
 from util import Packet, Message, create_timer, cancel_timer, now, trace, error
 from buffer import DropTailBuffer
+from telemetry import new_telemetry_sink
+from event_trace import new_event_trace_recorder, ENQUEUE, BUFFER_DROP, SEND, RANDOM_DROP, DELIVER
 import util
 
 import argparse
@@ -39,6 +41,12 @@ class Link:
         self._drop = drop
         self._pending_transmit = None
         self._label = label
+        # the link's event trace code is looked up once here, not for every record
+        self._event_trace = simulator.event_trace
+        if self._event_trace != None:
+            if not hasattr(buffer_obj, 'get_current_used_count') or not hasattr(buffer_obj, '_drop_count'):
+                raise ValueError(f'--event-trace needs a buffer with get_current_used_count() and _drop_count, not {type(buffer_obj).__name__}')
+            self._trace_link = self._event_trace.link_code(label)
         self._total_sent = 0
         self._maximum_buffer = 0
         self._last_buffer_measure_time = 0.0
@@ -48,23 +56,36 @@ class Link:
     def get_rng(self):
         return self._simulator.get_rng()
 
+    def _record_event(self, kind, packet):
+        self._event_trace.record(self._simulator._time, kind, packet.label, self._trace_link, packet, self._buffer.get_current_used_count())
+
     def _transmit(self, packet):
         if self.get_rng().uniform(0.0, 1.0) > self._drop:
             delay = self._delay
             if self._delay_variance > 0:
                 delay += self.get_rng().expovariate(self._delay_variance)
             self._simulator.trace('link', f'sending {packet} on {self._label} link [{delay} transmission time]')
+            if self._event_trace != None:
+                self._record_event(SEND, packet)
             self._simulator.create_timer(
                 delay,
-                lambda: packet._hidden_destination.from_network(packet),
+                lambda: self._deliver(packet),
                 f'receiving {packet} on {self._label} link'
             )
         else:
             self._simulator.trace('link', f'sending {packet} on {self._label} link [randomly dropped]')
+            if self._event_trace != None:
+                self._record_event(RANDOM_DROP, packet)
+
+    def _deliver(self, packet):
+        if self._event_trace != None:
+            self._record_event(DELIVER, packet)
+        packet._hidden_destination.from_network(packet)
 
     def transmit_next(self):
         packet = self._buffer.dequeue()
         if packet != None:
+            self._simulator.telemetry.record(self._label, 'queue', now(), self._buffer.get_current_used_count())
             self._transmit(packet)
             self._pending_transmit = self._simulator.create_timer(
                 1.0 / self._bandwidth,
@@ -81,9 +102,15 @@ class Link:
         if packet.seq_num != None and packet.seq_num > config.MAXIMUM_SEQUENCE:
             error(f'packet had seq_num {packet.seq_num} > MAXIMUM_SEQUENCE = {config.MAXIMUM_SEQUENCE}')
             self._wrong_seq_num += 1
-        self._buffer.enqueue(packet)
+        if self._event_trace != None:
+            drop_count = self._buffer._drop_count
+            self._buffer.enqueue(packet)
+            self._record_event(BUFFER_DROP if self._buffer._drop_count > drop_count else ENQUEUE, packet)
+        else:
+            self._buffer.enqueue(packet)
         try:
             used = self._buffer.get_current_used_count()
+            self._simulator.telemetry.record(self._label, 'queue', now(), used)
             self._maximum_buffer = max(used, self._maximum_buffer)
             time_delta = now() - self._last_buffer_measure_time
             self._buffer_time_occ += time_delta * used
@@ -272,11 +299,16 @@ class Simulator:
         self._args = args
         self._rng = random.Random(42)
         self._event_list = []
+        # Events for the current time, in index order; all have larger indices than any
+        # event for the current time in _event_list, so they can bypass the heap.
+        self._now_events = deque()
         self._connections = {}
         self._links = {}
         self._next_index = 0
         self._time = 0.0
         self._in_run_event = False
+        self.telemetry = new_telemetry_sink()
+        self.event_trace = new_event_trace_recorder()
         self.done = False
 
     def get_rng(self):
@@ -288,11 +320,16 @@ class Simulator:
     def add_event(self, event: Event) -> None:
         event.index = self._next_index
         self._next_index += 1
-        heappush(self._event_list, event)
+        if event.time == self._time:
+            self._now_events.append(event)
+        else:
+            heappush(self._event_list, event)
 
     def _pop_event(self) -> Optional[Event]:
-        if len(self._event_list) > 0:
+        if len(self._event_list) > 0 and (len(self._now_events) == 0 or self._event_list[0].time <= self._time):
             return heappop(self._event_list)
+        elif len(self._now_events) > 0:
+            return self._now_events.popleft()
         else:
             return None
  
@@ -353,6 +390,9 @@ class Simulator:
         while not self.done and self._run_next():
             if time_limit != None and self._time > time_limit:
                 self.done = True
+        self.telemetry.flush()
+        if self.event_trace != None:
+            self.event_trace.close()
 
     def _finish_send_back(self, to, destination, packet):
         destination.from_network(packet)
@@ -0,0 +1,112 @@
+import config
+
+import struct
+import sys
+from array import array
+
+"""Magic number at the start of binary telemetry files."""
+BINARY_MAGIC = b'TLM1'
+
+class _Series:
+    def __init__(self):
+        self.times = array('d')
+        self.values = array('d')
+
+class TelemetrySink:
+    """Collects (time, value) samples per owner (connection or link label) and series name.
+
+    Samples are appended to in-memory arrays and only written out in batches of
+    config.TELEMETRY_BATCH samples, or when flush() is called at the end of the simulation.
+    Each owner gets its own output file, so connections no longer clobber each other.
+
+    In 'csv' format, each owner and series is written to `{prefix}-{owner}-{series}.csv`.
+    In 'binary' format, each owner is written to `{prefix}-{owner}.bin`, which is
+    a sequence of chunks, each a series name followed by a column of times and
+    a column of values as little-endian doubles (see read_binary()).
+    """
+    def __init__(self, prefix, format='csv', batch_size=4096):
+        if format not in ('csv', 'binary'):
+            raise ValueError(f'unknown telemetry format {format!r}')
+        self._prefix = prefix
+        self._format = format
+        self._batch_size = batch_size
+        self._series = {}
+        self._files = {}
+        self.enabled = bool(prefix)
+
+    def record(self, owner, name, time, value):
+        if not self.enabled:
+            return
+        series = self._series.get((owner, name))
+        if series is None:
+            series = self._series[owner, name] = _Series()
+        series.times.append(time)
+        series.values.append(value)
+        if len(series.times) >= self._batch_size:
+            self._write(owner, name, series)
+
+    def _open(self, owner, name):
+        if self._format == 'csv':
+            key = (owner, name)
+            if key not in self._files:
+                f = self._files[key] = open(f'{self._prefix}-{owner}-{name}.csv', 'w')
+                f.write(f'time,{name}\n')
+        else:
+            key = owner
+            if key not in self._files:
+                f = self._files[key] = open(f'{self._prefix}-{owner}.bin', 'wb')
+                f.write(BINARY_MAGIC)
+        return self._files[key]
+
+    def _write(self, owner, name, series):
+        f = self._open(owner, name)
+        if self._format == 'csv':
+            f.write(''.join(f'{t},{v}\n' for t, v in zip(series.times, series.values)))
+        else:
+            encoded_name = name.encode('UTF-8')
+            f.write(struct.pack('<HI', len(encoded_name), len(series.times)))
+            f.write(encoded_name)
+            if sys.byteorder == 'big':
+                series.times.byteswap()
+                series.values.byteswap()
+            series.times.tofile(f)
+            series.values.tofile(f)
+        del series.times[:]
+        del series.values[:]
+
+    def flush(self):
+        """Write out all pending samples and close the output files."""
+        for (owner, name), series in self._series.items():
+            if len(series.times) > 0:
+                self._write(owner, name, series)
+        for f in self._files.values():
+            f.close()
+        self._files = {}
+
+def new_telemetry_sink() -> TelemetrySink:
+    """Create a TelemetrySink using the settings in config.py."""
+    return TelemetrySink(config.TELEMETRY, config.TELEMETRY_FORMAT, config.TELEMETRY_BATCH)
+
+def read_binary(path) -> dict[str, tuple[array, array]]:
+    """Read a binary telemetry file into a dict of series name to (times, values)."""
+    result = {}
+    with open(path, 'rb') as f:
+        if f.read(len(BINARY_MAGIC)) != BINARY_MAGIC:
+            raise ValueError(f'{path} is not a binary telemetry file')
+        while True:
+            header = f.read(struct.calcsize('<HI'))
+            if len(header) == 0:
+                break
+            name_length, count = struct.unpack('<HI', header)
+            name = f.read(name_length).decode('UTF-8')
+            times, values = result.setdefault(name, (array('d'), array('d')))
+            chunk_times = array('d')
+            chunk_times.fromfile(f, count)
+            chunk_values = array('d')
+            chunk_values.fromfile(f, count)
+            if sys.byteorder == 'big':
+                chunk_times.byteswap()
+                chunk_values.byteswap()
+            times.extend(chunk_times)
+            values.extend(chunk_values)
+    return result
@@ -0,0 +1,104 @@
+import argparse
+import re
+import sys
+
+import config
+
+from main import generate_messages, setup
+
+def run_variable_sliding(count, drop_forward=0.0, delay_variance=0.0):
+    """Send `count` generated messages in 'variable-sliding' mode with Reno and return (the data
+    of the messages delivered, the connection, the number of loss episodes, the number of window
+    reductions undone as spurious)."""
+    config.MODE = 'variable-sliding'
+    config.CC = 'reno'
+    config.TRACE = set()
+    config.TELEMETRY = ''
+    config.EVENT_TRACE = ''
+    args = argparse.Namespace(
+        drop_forward=drop_forward,
+        drop_backward=0.0,
+        delay=1.0,
+        delay_variance=delay_variance,
+        bandwidth_forward=float('inf'),
+        bandwidth_backward=float('inf'),
+        buffer=1000000,
+    )
+    _simulator = setup(args, generate_messages(count))
+    connection = _simulator._connections['main']
+    sender = connection._sender
+    receiver = connection._receiver
+    delivered = []
+    record_received = receiver.to_application
+    def to_application(message):
+        delivered.append(message.data)
+        record_received(message)
+    receiver.to_application = to_application
+    losses = [0]
+    do_loss = sender._do_loss
+    def _do_loss(fast_retransmit=False):
+        if sender.recovery_point is None:
+            losses[0] += 1
+        do_loss(fast_retransmit=fast_retransmit)
+    sender._do_loss = _do_loss
+    undos = [0]
+    def trace(label, description):
+        if label == 'sender' and description.endswith('was spurious'):
+            undos[0] += 1
+    _simulator.trace = trace
+    _simulator.run()
+    return delivered, connection, losses[0], undos[0]
+
+def check_delivered(delivered, connection, count):
+    expected = [message.data for message in generate_messages(count)]
+    assert connection._corrupt_message_count == 0 and connection._skip_message_count == 0, \
+        (connection._corrupt_message_count, connection._skip_message_count)
+    assert len(delivered) == count, f'delivered {len(delivered)} of {count} messages'
+    assert b''.join(delivered) == b''.join(expected), 'delivered byte stream differs from the one sent'
+
+def test_undo_after_reordering():
+    """With no drops, every loss episode comes from a reordered packet; most get undone (not all,
+    since an ACK delayed by more than the minimum RTT after the retransmission is not caught)."""
+    delivered, connection, losses, undos = run_variable_sliding(2000, delay_variance=0.5)
+    check_delivered(delivered, connection, 2000)
+    assert losses > 0, 'delay variance never caused a spurious retransmission'
+    assert undos > losses // 2, f'only {undos} of {losses} spurious loss episodes were undone'
+
+def test_no_undo_after_drop():
+    """With no delay variance, every loss is a real drop of data, and no window reduction gets undone.
+    (ACKs are not dropped: the retransmission after a lost ACK really is spurious.)"""
+    delivered, connection, losses, undos = run_variable_sliding(2000, drop_forward=0.05)
+    check_delivered(delivered, connection, 2000)
+    assert losses > 0, 'drops never caused a retransmission'
+    assert undos == 0, f'{undos} of {losses} loss episodes from real drops were undone'
+
+TESTS = [
+    ('undo-after-reordering', test_undo_after_reordering),
+    ('no-undo-after-drop', test_no_undo_after_drop),
+]
+
+def main():
+    parser = argparse.ArgumentParser(description='Run tests of the hw2c congestion-controlled sender.')
+    parser.add_argument('--only-test', metavar='REGEX', default=None, help='only run tests whose label matches REGEX')
+    parser.add_argument('--keep-going', action='store_true', default=False, help='keep going after a failed test')
+    args = parser.parse_args()
+    failed = False
+    for label, function in TESTS:
+        if args.only_test and not re.match(args.only_test, label):
+            continue
+        try:
+            function()
+            print(f'{label}: passed')
+        except AssertionError as e:
+            print(f'{label}: FAILED: {e}')
+            failed = True
+            if not args.keep_going:
+                break
+    if failed:
+        print('*** Failed at least one test')
+        sys.exit(1)
+    else:
+        print('*** All tests passed')
+
+if __name__ == '__main__':
+    main()
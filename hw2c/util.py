@@ -19,6 +19,10 @@ def trace(label, message):
 def error(message):
     _simulator.error(message)
 
+"""Record a telemetry sample of series 'name' for 'owner' (a connection or link label) at the current time."""
+def record(owner, name, value):
+    _simulator.telemetry.record(owner, name, _simulator.time(), value)
+
 """Represents a packet."""
 @dataclass
 class Packet:
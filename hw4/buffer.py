@@ -1,70 +1,227 @@
-from collections import deque
+import math
+from abc import ABC, abstractmethod
+from collections import OrderedDict, deque
+from heapq import heapify, heappop, heappush
+from itertools import islice
 
+import util
+from event_trace import ENQUEUE, BUFFER_DROP, EVICT
 from simulator import Packet
-from util import trace
+from util import now, trace
 
-class DropTailBuffer:
-    """A drop-tail, FIFO buffer."""
-    def __init__(self, capacity, bandwidth, label):
-        self._queue = deque()
+class Buffer(ABC):
+    """Base class for link buffers.
+
+    Keeps the number and total size of queued packets, and counts per connection label the
+    packets enqueued, dropped on arrival and evicted after being queued (pushed out by another
+    packet, or dropped by active queue management). Subclasses check for space with
+    _has_room() and call _enqueued(), _dropped(), _evicted() or _dequeued() for every packet
+    they add, turn away or remove, so all of these stay exact and O(1). The same calls keep the
+    time integral of each label's queued packets, for the link's per-class mean occupancy.
+    With --event-trace, they also record each packet enqueued, dropped or evicted, including
+    drops made inside dequeue() like CoDel's.
+
+    dequeue() returns None if no packet may be sent now. Buffers that may hold packets back
+    (shapers and pacers) override next_ready_time(), which Link uses to set a single timer for
+    when to try again instead of waiting for the next enqueue.
+    """
+    def __init__(self, capacity, bandwidth, label, byte_capacity=None):
         self._capacity = capacity
+        self._byte_capacity = byte_capacity
+        self._bandwidth = bandwidth
         self._label = label
         self._size_in_buffer = 0
+        self._bytes_in_buffer = 0
+        self._enqueue_count = 0
+        self._drop_count = 0
+        self._evict_count = 0
+        # label -> [enqueued, dropped, evicted]
+        self._class_counts = {}
+        # label -> [queued packets, time of the last change, integral of queued packets over time]
+        self._class_occupancy = {}
+        self._event_trace = getattr(util._simulator, 'event_trace', None)
+        if self._event_trace != None:
+            self._trace_link = self._event_trace.link_code(label)
+
+    def __len__(self) -> int:
+        return self._size_in_buffer
+
+    @property
+    def bytes_in_buffer(self) -> int:
+        """Total size of the queued packets."""
+        return self._bytes_in_buffer
+
+    def _has_room(self, size) -> bool:
+        """Whether a packet of `size` fits: within byte_capacity (in size units) if set,
+        otherwise within capacity packets."""
+        if self._byte_capacity != None:
+            return self._bytes_in_buffer + size <= self._byte_capacity
+        return self._size_in_buffer < self._capacity
+
+    def _counts(self, label) -> list[int]:
+        counts = self._class_counts.get(label)
+        if counts == None:
+            counts = self._class_counts[label] = [0, 0, 0]
+            self._class_occupancy[label] = [0, now(), 0.0]
+        return counts
+
+    def _change_occupancy(self, label, change):
+        occupancy = self._class_occupancy[label]
+        current_time = now()
+        occupancy[2] += (current_time - occupancy[1]) * occupancy[0]
+        occupancy[0] += change
+        occupancy[1] = current_time
+
+    def _enqueued(self, packet: Packet, note=''):
+        self._size_in_buffer += 1
+        self._bytes_in_buffer += packet.size
+        self._enqueue_count += 1
+        self._counts(packet.label)[0] += 1
+        self._change_occupancy(packet.label, 1)
+        if self._event_trace != None:
+            self._event_trace.record(now(), ENQUEUE, packet.label, self._trace_link, packet, self._size_in_buffer)
+        trace('buffer-enqueue', f'buffering packet{note} from {packet.label} to {self._label} (buffer size {self._size_in_buffer}/{self._capacity})')
+
+    def _dropped(self, packet: Packet, reason='due to full buffer'):
+        self._drop_count += 1
+        self._counts(packet.label)[1] += 1
+        if self._event_trace != None:
+            self._event_trace.record(now(), BUFFER_DROP, packet.label, self._trace_link, packet, self._size_in_buffer)
+        trace('buffer-drop', f'dropping packet from {packet.label} to {self._label} {reason}')
+
+    def _evicted(self, packet: Packet, reason='due to full buffer', note=''):
+        self._size_in_buffer -= 1
+        self._bytes_in_buffer -= packet.size
+        self._evict_count += 1
+        self._counts(packet.label)[2] += 1
+        self._change_occupancy(packet.label, -1)
+        if self._event_trace != None:
+            self._event_trace.record(now(), EVICT, packet.label, self._trace_link, packet, self._size_in_buffer)
+        trace('buffer-drop', f'replacing packet{note} from {packet.label} to {self._label} {reason}')
+
+    def _dequeued(self, packet: Packet, note=''):
+        self._size_in_buffer -= 1
+        self._bytes_in_buffer -= packet.size
+        self._change_occupancy(packet.label, -1)
+        trace('buffer-dequeue', f'unbuffering packet{note} from {packet.label} for {self._label} (buffer size {self._size_in_buffer}/{self._capacity})')
+
+    def counters(self) -> dict:
+        """Packets enqueued, dropped on arrival and evicted, in total and per connection label."""
+        return {
+            'enqueued': self._enqueue_count,
+            'dropped': self._drop_count,
+            'evicted': self._evict_count,
+            'by_class': {
+                label: {'enqueued': enqueued, 'dropped': dropped, 'evicted': evicted}
+                for label, (enqueued, dropped, evicted) in self._class_counts.items()
+            },
+        }
+
+    def reset_class_occupancy(self):
+        """Start the integrals returned by class_occupancy_integrals() over from now."""
+        current_time = now()
+        for occupancy in self._class_occupancy.values():
+            occupancy[1] = current_time
+            occupancy[2] = 0.0
+
+    def class_occupancy_integrals(self) -> dict[str, float]:
+        """The integral over time of the number of queued packets of each label, since the last
+        reset_class_occupancy() (or since the label's first packet)."""
+        current_time = now()
+        return {
+            label: integral + (current_time - last_change_time) * queued
+            for label, (queued, last_change_time, integral) in self._class_occupancy.items()
+        }
+
+    def next_ready_time(self) -> float | None:
+        """The earliest time dequeue() will return a packet if nothing else is queued first,
+        or None if the buffer is empty."""
+        return now() if self._size_in_buffer > 0 else None
+
+    def weight(self, label) -> float:
+        """The share of the link configured for connection `label`, relative to the other labels."""
+        return 1.0
+
+    @abstractmethod
+    def enqueue(self, packet: Packet):
+        """Queue `packet`, or turn it away with _dropped() if there is no room."""
+
+    @abstractmethod
+    def dequeue(self) -> Packet | None:
+        """Remove and return the next packet to send, or None if none may be sent now."""
+
+
+class DropTailBuffer(Buffer):
+    """A drop-tail, FIFO buffer."""
+    def __init__(self, capacity, bandwidth, label, byte_capacity=None):
+        super().__init__(capacity, bandwidth, label, byte_capacity)
+        self._queue = deque()
 
     def enqueue(self, packet: Packet):
-        if len(self._queue) < self._capacity:
-            trace('buffer-enqueue', f'buffering packet from {packet.label} to {self._label} (buffer size {self._size_in_buffer}/{self._capacity})')
+        if self._has_room(packet.size):
             self._queue.append(packet)
-            self._size_in_buffer += 1
+            self._enqueued(packet)
         else:
-            trace('buffer-drop', f'dropping packet from {packet.label} to {self._label} due to full buffer')
+            self._dropped(packet)
 
     def dequeue(self) -> Packet | None:
         if len(self._queue) == 0:
             return None
         else:
             packet = self._queue.popleft()
-            self._size_in_buffer -= 1
-            trace('buffer-dequeue', f'unbuffering packet from {packet.label} for {self._label} (buffer size {self._size_in_buffer}/{self._capacity})')
+            self._dequeued(packet)
             return packet
 
 
-class PriorityQueueBuffer:
+class PriorityQueueBuffer(Buffer):
     """A strict priority buffer that prefers c1 over c2."""
-    def __init__(self, capacity, bandwidth, label):
+    def __init__(self, capacity, bandwidth, label, byte_capacity=None):
+        super().__init__(capacity, bandwidth, label, byte_capacity)
         self._queue1 = deque()  # queue for c1
         self._queue2 = deque()  # queue for c2
-        self._capacity = capacity
-        self._label = label
-        self._size_in_buffer = 0
+        self._queue2_bytes = 0
 
     def _queue_length(self) -> int:
         return len(self._queue1) + len(self._queue2)
 
+    def _can_make_room(self, size) -> bool:
+        """Whether dropping c2 packets would make room for a packet of `size`."""
+        if self._byte_capacity == None:
+            return True
+        return self._bytes_in_buffer - self._queue2_bytes + size <= self._byte_capacity
+
+    def occupancy_by_class(self) -> dict[str, int]:
+        return {'c1': len(self._queue1), 'c2': len(self._queue2)}
+
     def enqueue(self, packet: Packet):
         # Queue has room
-        if self._queue_length() < self._capacity:
+        if self._has_room(packet.size):
             # Packet from c1
             if packet.label == 'c1':
                 self._queue1.append(packet)
             # Packet from c2
             else:
                 self._queue2.append(packet)
+                self._queue2_bytes += packet.size
 
-            self._size_in_buffer += 1
-            trace('buffer-enqueue', f'buffering packet from {packet.label} to {self._label} (buffer size {self._size_in_buffer}/{self._capacity})')
+            self._enqueued(packet)
         # Queue is full
         else:
-            # Replace last from c2 with last from c1
-            if len(self._queue2) > 0 and packet.label == 'c1':
-                packet_replace = self._queue2.pop()
-                trace('buffer-drop', f'replacing packet from {packet_replace.label} to {self._label} due to full buffer')
+            # Replace packets from the end of c2 with the packet from c1, if that makes enough room
+            if packet.label == 'c1' and len(self._queue2) > 0 and self._can_make_room(packet.size):
+                # With a capacity in packets, one always makes room; in bytes, it may take several
+                while True:
+                    packet_replace = self._queue2.pop()
+                    self._queue2_bytes -= packet_replace.size
+                    self._evicted(packet_replace)
+                    if self._has_room(packet.size):
+                        break
 
                 self._queue1.append(packet)
-                trace('buffer-enqueue',f'buffering packet from {packet.label} to {self._label} (buffer size {self._size_in_buffer}/{self._capacity})')
+                self._enqueued(packet)
             # Drop last from c1/c2
             else:
-                trace('buffer-drop', f'dropping packet from {packet.label} to {self._label} due to full buffer')
+                self._dropped(packet)
 
     def dequeue(self) -> Packet | None:
         # Queue is empty
@@ -78,105 +235,642 @@ class PriorityQueueBuffer:
             # Pop from c2
             else:
                 packet = self._queue2.popleft()
+                self._queue2_bytes -= packet.size
 
-            self._size_in_buffer -= 1
-            trace('buffer-dequeue', f'unbuffering packet from {packet.label} for {self._label} (buffer size {self._size_in_buffer}/{self._capacity})')
+            self._dequeued(packet)
             return packet
 
 
-class WeightedFairQueuingBuffer:
-    """A weighted fair queuing buffer that gives c1 twice as much bandwidth as c2."""
+class WeightedFairQueuingBuffer(Buffer):
+    """A WF2Q+ weighted fair queuing buffer with one class per connection label.
+
+    Each packet gets a virtual start and finish time when it is queued; the buffer sends the
+    packet with the earliest finish time among those that have started according to the
+    system virtual time, which keeps newly active classes from jumping ahead. Classes are
+    kept in heaps, so dequeue takes amortized O(log n) time for n classes, and enqueue the
+    same plus O(log n) for each packet it evicts.
+
+    By default, c1 gets twice the bandwidth of c2, and any other label gets weight 1.
+    When the buffer is full, a packet replaces the last packet of the class with the latest
+    finish time if it would finish earlier. With a byte_capacity, it keeps replacing packets
+    that would finish later until it fits, so it may push out several smaller packets; if
+    they are not enough, it is dropped and they are put back, after the same O(log n) work
+    for each of them.
+    """
+    DEFAULT_WEIGHTS = {'c1': 2, 'c2': 1}
+
     class SubQueue:
-        def __init__(self, weight: int):
-            self.queue = deque()  # store packets with virtual times
-            self.last_finish_time = 0
+        def __init__(self, label: str, weight: float):
+            self.label = label
+            self.queue = deque()  # (packet, start, finish)
+            self.last_finish_time = 0.0
             self.weight = weight
 
         def __len__(self):
             return len(self.queue)
 
-        def append(self, item: tuple):
-            self.queue.append(item)
+    def __init__(self, capacity, bandwidth, label, weights=None, byte_capacity=None):
+        super().__init__(capacity, bandwidth, label, byte_capacity)
+        self._weights = dict(self.DEFAULT_WEIGHTS if weights == None else weights)
+        self._total_weight = sum(self._weights.values())
+        self._sub_queues = {}
+        self._virtual_time = 0.0
+        self._counter = 0
+        # heads of backlogged classes, as (finish, counter, sub_queue, packet) for classes
+        # that may be sent now and (start, counter, sub_queue, packet) for ones that may not
+        self._eligible = []
+        self._waiting = []
+        # tails of backlogged classes as (-finish, counter, sub_queue, packet); may be out of date
+        self._tails = []
 
-        def popleft(self) -> tuple:
-            return self.queue.popleft()
+    def _sub_queue(self, label) -> 'WeightedFairQueuingBuffer.SubQueue':
+        sub_queue = self._sub_queues.get(label)
+        if sub_queue == None:
+            if label not in self._weights:
+                self._weights[label] = 1
+                self._total_weight += 1
+            sub_queue = self._sub_queues[label] = self.SubQueue(label, self._weights[label])
+        return sub_queue
 
-        def pop(self) -> tuple:
-            return self.queue.pop()
+    def occupancy_by_class(self) -> dict[str, int]:
+        return {label: len(sub_queue) for label, sub_queue in self._sub_queues.items()}
 
-        def get_first_finish(self) -> int | float:
-            if len(self.queue) > 0:
-                _, finish = self.queue[0]
-                return finish
-            # nothing in queue
-            else:
-                return float('inf')
+    def weight(self, label) -> float:
+        return self._weights.get(label, 1)
 
-    def __init__(self, capacity, bandwidth, label):
-        self._queue1 = self.SubQueue(weight=2)  # queue for c1
-        self._queue2 = self.SubQueue(weight=1)  # queue for c2
-        self._capacity = capacity
-        self._label = label
-        self._size_in_buffer = 0
+    def _push_head(self, sub_queue):
+        packet, start, finish = sub_queue.queue[0]
+        self._counter += 1
+        if start <= self._virtual_time:
+            heappush(self._eligible, (finish, self._counter, sub_queue, packet))
+        else:
+            heappush(self._waiting, (start, self._counter, sub_queue, packet))
 
-    def _queue_length(self) -> int:
-        return len(self._queue1) + len(self._queue2)
+    def _push_tail(self, sub_queue):
+        packet, _, finish = sub_queue.queue[-1]
+        self._counter += 1
+        heappush(self._tails, (-finish, self._counter, sub_queue, packet))
+        if len(self._tails) > 2 * (len(self._sub_queues) + self._capacity):
+            self._tails = [item for item in self._tails if len(item[2]) > 0 and item[2].queue[-1][0] is item[3]]
+            heapify(self._tails)
+
+    def _latest_tail(self) -> 'WeightedFairQueuingBuffer.SubQueue | None':
+        while len(self._tails) > 0:
+            _, _, sub_queue, packet = self._tails[0]
+            if len(sub_queue) > 0 and sub_queue.queue[-1][0] is packet:
+                return sub_queue
+            heappop(self._tails)
+        return None
+
+    def _make_room(self, sub_queue, size, finish) -> bool:
+        """Evict the packets of other classes that would finish last, as long as they would
+        finish after `finish`, until a packet of `size` fits; returns whether it does.
+
+        Packets are taken off their classes first and only evicted once there are enough of
+        them, so if there are not, they are put back and nothing is evicted.
+        """
+        by_bytes = self._byte_capacity != None
+        needed = self._bytes_in_buffer + size - self._byte_capacity if by_bytes else 1
+        removed = []  # (sub_queue, (packet, start, finish))
+        while needed > 0:
+            other_queue = self._latest_tail()
+            if other_queue == None or other_queue is sub_queue or finish >= other_queue.last_finish_time:
+                # Their head entries were left in the heaps, so they are valid again once put back
+                for other_queue, entry in reversed(removed):
+                    other_queue.queue.append(entry)
+                    other_queue.last_finish_time = entry[2]
+                    self._push_tail(other_queue)
+                return False
+            entry = other_queue.queue.pop()
+            # Only tails are evicted, so this is exactly the finish time of the packet before it
+            other_queue.last_finish_time = entry[1]
+            if len(other_queue) > 0:
+                self._push_tail(other_queue)
+            removed.append((other_queue, entry))
+            needed -= entry[0].size if by_bytes else 1
+        for _, (packet_replace, _, other_finish) in removed:
+            self._evicted(packet_replace, note=f' ({other_finish})')
+        return True
+
+    def _append(self, sub_queue, packet, start, finish):
+        sub_queue.queue.append((packet, start, finish))
+        sub_queue.last_finish_time = finish
+        if len(sub_queue) == 1:
+            self._push_head(sub_queue)
+        self._push_tail(sub_queue)
 
     def enqueue(self, packet: Packet):
-        # Packet from c1
-        if packet.label == 'c1':
-            own_queue = self._queue1
-            other_queue = self._queue2
-        # Packet from c2
+        sub_queue = self._sub_queue(packet.label)
+        if len(sub_queue) > 0:
+            start = sub_queue.last_finish_time
         else:
-            own_queue = self._queue2
-            other_queue = self._queue1
+            start = max(sub_queue.last_finish_time, self._virtual_time)
+        finish = start + packet.size * self._total_weight / sub_queue.weight
+        # If the queue is full, replace the packets that would finish last, if they are not from this class
+        if (self._byte_capacity != None and packet.size > self._byte_capacity) or \
+                (not self._has_room(packet.size) and not self._make_room(sub_queue, packet.size, finish)):
+            self._dropped(packet)
+            return
+        self._append(sub_queue, packet, start, finish)
+        self._enqueued(packet, note=f' ({finish})')
 
-        # Queue has room
-        if self._queue_length() < self._capacity:
-            sub_queue = own_queue
+    def _pop_head(self, heap) -> 'tuple | None':
+        """Pop the first up-to-date entry (whose packet is still at the head of its class) from heap."""
+        while len(heap) > 0:
+            entry = heappop(heap)
+            sub_queue, packet = entry[2], entry[3]
+            if len(sub_queue) > 0 and sub_queue.queue[0][0] is packet:
+                return entry
+        return None
 
-            # Calculate next finish time
-            current_finish = sub_queue.last_finish_time + packet.size / sub_queue.weight
-            sub_queue.append((packet, current_finish))
+    def dequeue(self) -> Packet | None:
+        # Queue is empty
+        if self._size_in_buffer == 0:
+            return None
+        if self._pop_stale_eligible():
+            # Nothing may be sent yet: advance virtual time to the earliest start time
+            entry = self._pop_head(self._waiting)
+            self._virtual_time = max(self._virtual_time, entry[0])
+            heappush(self._waiting, entry)
+        while len(self._waiting) > 0 and self._waiting[0][0] <= self._virtual_time:
+            start, counter, sub_queue, packet = heappop(self._waiting)
+            if len(sub_queue) > 0 and sub_queue.queue[0][0] is packet:
+                heappush(self._eligible, (sub_queue.queue[0][2], counter, sub_queue, packet))
+        _, _, sub_queue, _ = self._pop_head(self._eligible)
+        packet, _, current_finish = sub_queue.queue.popleft()
+        if len(sub_queue) > 0:
+            self._push_head(sub_queue)
+        self._virtual_time += packet.size
+        self._dequeued(packet, note=f' ({current_finish})')
+        return packet
 
-            self._size_in_buffer += 1
-            trace('buffer-enqueue', f'buffering packet ({current_finish}) from {packet.label} to {self._label} (buffer size {self._size_in_buffer}/{self._capacity})')
-            sub_queue.last_finish_time = current_finish
-        # Queue is full
+    def _pop_stale_eligible(self) -> bool:
+        """Drop out-of-date entries from the top of the eligible heap; returns True if it is then empty."""
+        while len(self._eligible) > 0:
+            _, _, sub_queue, packet = self._eligible[0]
+            if len(sub_queue) > 0 and sub_queue.queue[0][0] is packet:
+                return False
+            heappop(self._eligible)
+        return True
+
+
+class DeficitRoundRobinBuffer(Buffer):
+    """A deficit round robin buffer with one class per connection label.
+
+    Each round, every class with queued packets may send up to its quantum (`quantum` times
+    its weight, in size units) plus whatever it did not use in earlier rounds. As long as
+    the quantum is at least the largest packet size, enqueue and dequeue take O(1) time.
+
+    When the buffer is full, the last packet of the longest class (in packets) is dropped to
+    make room, or with a byte_capacity, as many as it takes.
+    """
+    class SubQueue:
+        def __init__(self, label: str, quantum: float):
+            self.label = label
+            self.queue = deque()
+            self.quantum = quantum
+            self.deficit = 0.0
+            self.new_round = True
+
+        def __len__(self):
+            return len(self.queue)
+
+    def __init__(self, capacity, bandwidth, label, weights=None, quantum=200, byte_capacity=None):
+        super().__init__(capacity, bandwidth, label, byte_capacity)
+        self._weights = dict(WeightedFairQueuingBuffer.DEFAULT_WEIGHTS if weights == None else weights)
+        self._quantum = quantum
+        self._sub_queues = {}
+        # classes with queued packets, in round robin order
+        self._active = OrderedDict()
+        # classes by number of queued packets (label -> class, in the order they reached that
+        # length), to find the longest in O(1) and break ties deterministically
+        self._by_length = {}
+        self._longest = 0
+
+    def occupancy_by_class(self) -> dict[str, int]:
+        return {label: len(sub_queue) for label, sub_queue in self._sub_queues.items()}
+
+    def weight(self, label) -> float:
+        return self._weights.get(label, 1)
+
+    def _sub_queue(self, label) -> 'DeficitRoundRobinBuffer.SubQueue':
+        sub_queue = self._sub_queues.get(label)
+        if sub_queue == None:
+            sub_queue = self._sub_queues[label] = self.SubQueue(label, self._quantum * self._weights.get(label, 1))
+        return sub_queue
+
+    def _move(self, sub_queue, old_length):
+        """Update _by_length after sub_queue changed length from old_length."""
+        new_length = len(sub_queue)
+        if old_length > 0:
+            del self._by_length[old_length][sub_queue.label]
+        if new_length > 0:
+            self._by_length.setdefault(new_length, {})[sub_queue.label] = sub_queue
+        if new_length > self._longest:
+            self._longest = new_length
+        while self._longest > 0 and len(self._by_length.get(self._longest, ())) == 0:
+            self._longest -= 1
+
+    def _can_make_room(self, sub_queue, size) -> bool:
+        """Whether evicting from classes longer than sub_queue, down to its length, makes room
+        for a packet of `size`."""
+        kept = len(sub_queue)
+        if self._byte_capacity == None:
+            return self._longest > kept
+        needed = self._bytes_in_buffer + size - self._byte_capacity
+        for length in range(self._longest, kept, -1):
+            for other_queue in self._by_length.get(length, {}).values():
+                for other_packet in islice(reversed(other_queue.queue), length - kept):
+                    needed -= other_packet.size
+                    if needed <= 0:
+                        return True
+        return needed <= 0
+
+    def _remove_tail(self, sub_queue) -> Packet:
+        packet = sub_queue.queue.pop()
+        self._move(sub_queue, len(sub_queue) + 1)
+        if len(sub_queue) == 0:
+            del self._active[sub_queue.label]
+            sub_queue.deficit = 0.0
+            sub_queue.new_round = True
+        return packet
+
+    def enqueue(self, packet: Packet):
+        sub_queue = self._sub_queue(packet.label)
+        if (self._byte_capacity != None and packet.size > self._byte_capacity) or \
+                (not self._has_room(packet.size) and not self._can_make_room(sub_queue, packet.size)):
+            self._dropped(packet)
+            return
+        while not self._has_room(packet.size):
+            longest = next(iter(self._by_length[self._longest].values()))
+            self._evicted(self._remove_tail(longest))
+        sub_queue.queue.append(packet)
+        self._move(sub_queue, len(sub_queue) - 1)
+        if len(sub_queue) == 1:
+            self._active[sub_queue.label] = sub_queue
+        self._enqueued(packet)
+
+    def dequeue(self) -> Packet | None:
+        if self._size_in_buffer == 0:
+            return None
+        while True:
+            sub_queue = next(iter(self._active.values()))
+            if sub_queue.new_round:
+                sub_queue.deficit += sub_queue.quantum
+                sub_queue.new_round = False
+            if sub_queue.queue[0].size <= sub_queue.deficit:
+                break
+            # Not enough credit left this round; move on to the next class
+            self._active.move_to_end(sub_queue.label)
+            sub_queue.new_round = True
+        packet = sub_queue.queue.popleft()
+        sub_queue.deficit -= packet.size
+        self._move(sub_queue, len(sub_queue) + 1)
+        if len(sub_queue) == 0:
+            del self._active[sub_queue.label]
+            sub_queue.deficit = 0.0
+            sub_queue.new_round = True
+        self._dequeued(packet)
+        return packet
+
+
+class REDBuffer(Buffer):
+    """A random early detection (RED) FIFO buffer.
+
+    Arriving packets are dropped with a probability that grows from 0 to `max_probability`
+    as the average queue length (an exponentially weighted moving average with weight
+    `queue_weight`) grows from `min_threshold` to `max_threshold` packets, and always above
+    that. Like the original RED, the probability is spread out by the number of packets
+    accepted since the last drop, and the average decays while the buffer is idle.
+    """
+    def __init__(self, capacity, bandwidth, label, min_threshold=5, max_threshold=15,
+                 max_probability=0.1, queue_weight=0.002, byte_capacity=None):
+        super().__init__(capacity, bandwidth, label, byte_capacity)
+        self._queue = deque()
+        self._min_threshold = min_threshold
+        self._max_threshold = max_threshold
+        self._max_probability = max_probability
+        self._queue_weight = queue_weight
+        self._average = 0.0
+        # packets accepted since the last early drop, or -1 while below min_threshold
+        self._count = -1
+        self._idle_since = 0.0
+        self._last_size = 0
+        self._rng = util._simulator.new_rng(f'buffer/{label}/red')
+
+    def _update_average(self):
+        if len(self._queue) > 0:
+            self._average += self._queue_weight * (len(self._queue) - self._average)
+            return
+        # Decay as if packets of the last size had arrived to an empty queue while idle, then
+        # count the idle time from now, so an arrival that is dropped and leaves the queue empty
+        # does not make the next one decay the average over the same time again
+        transmit_time = self._last_size / self._bandwidth
+        if transmit_time > 0:
+            idle_packets = (now() - self._idle_since) / transmit_time
+            self._average *= (1 - self._queue_weight) ** idle_packets
         else:
-            # Compare last finish times
-            current_finish = own_queue.last_finish_time + packet.size / own_queue.weight
-            other_finish = other_queue.last_finish_time
-
-            # Replace other with the new packet
-            if current_finish < other_finish and len(other_queue) > 0:
-                packet_replace, _ = other_queue.pop()
-                other_queue.last_finish_time -= packet_replace.size / other_queue.weight
-                trace('buffer-drop', f'replacing ({other_finish}) packet from {packet_replace.label} to {self._label} due to full buffer')
-
-                own_queue.append((packet, current_finish))
-                own_queue.last_finish_time = current_finish
-                trace('buffer-enqueue',f'buffering ({current_finish}) packet from {packet.label} to {self._label} (buffer size {self._size_in_buffer}/{self._capacity})')
-            else:
-                trace('buffer-drop', f'dropping packet from {packet.label} to {self._label} due to full buffer')
+            self._average = 0.0
+        self._idle_since = now()
+
+    def _early_drop(self) -> bool:
+        if self._average < self._min_threshold:
+            self._count = -1
+            return False
+        if self._average >= self._max_threshold:
+            self._count = 0
+            return True
+        self._count += 1
+        probability = self._max_probability * (self._average - self._min_threshold) / (self._max_threshold - self._min_threshold)
+        if self._count * probability < 1 and self._rng.random() * (1 - self._count * probability) >= probability:
+            return False
+        self._count = 0
+        return True
+
+    def enqueue(self, packet: Packet):
+        self._update_average()
+        if not self._has_room(packet.size):
+            self._dropped(packet)
+        elif self._early_drop():
+            self._dropped(packet, f'early (average queue {self._average:.2f})')
+        else:
+            self._queue.append(packet)
+            self._enqueued(packet)
 
     def dequeue(self) -> Packet | None:
-        # Queue is empty
-        if self._queue_length() == 0:
+        if len(self._queue) == 0:
             return None
-        # Queue has packets
+        packet = self._queue.popleft()
+        self._last_size = packet.size
+        if len(self._queue) == 0:
+            self._idle_since = now()
+        self._dequeued(packet)
+        return packet
+
+
+class CoDelBuffer(Buffer):
+    """A CoDel (controlled delay, RFC 8289) FIFO buffer.
+
+    Packets are timestamped when queued. Once every packet dequeued for `interval` time units
+    has waited at least `target` time units, CoDel starts dropping packets at the head of the
+    queue, at intervals shrinking with the square root of the number of drops, until the
+    waiting time falls below `target` again. Arrivals are only dropped when the buffer is full.
+    """
+    def __init__(self, capacity, bandwidth, label, target=0.5, interval=5.0, byte_capacity=None):
+        super().__init__(capacity, bandwidth, label, byte_capacity)
+        self._queue = deque()  # (enqueue time, packet)
+        self._target = target
+        self._interval = interval
+        # time at which the waiting time will have been above target for interval, or 0
+        self._first_above_time = 0.0
+        self._dropping = False
+        self._drop_next = 0.0
+        self._count = 0
+        self._last_count = 0
+
+    def enqueue(self, packet: Packet):
+        if self._has_room(packet.size):
+            self._queue.append((now(), packet))
+            self._enqueued(packet)
         else:
-            # Compare first finish times
-            finish1 = self._queue1.get_first_finish()
-            finish2 = self._queue2.get_first_finish()
+            self._dropped(packet)
 
-            # Pop from c1
-            if finish1 <= finish2:
-                packet, current_finish = self._queue1.popleft()
-            # Pop from c2
+    def _control_law(self, time) -> float:
+        return time + self._interval / math.sqrt(self._count)
+
+    def _pop(self, current_time) -> tuple[Packet | None, bool]:
+        """Remove the head of the queue, without accounting for it yet; returns it and
+        whether CoDel may drop it."""
+        if len(self._queue) == 0:
+            self._first_above_time = 0.0
+            return None, False
+        enqueue_time, packet = self._queue.popleft()
+        if current_time - enqueue_time < self._target or len(self._queue) == 0:
+            self._first_above_time = 0.0
+        elif self._first_above_time == 0.0:
+            self._first_above_time = current_time + self._interval
+        elif current_time >= self._first_above_time:
+            return packet, True
+        return packet, False
+
+    def _drop(self, packet):
+        self._evicted(packet, f'due to waiting over {self._target} for {self._interval}')
+
+    def dequeue(self) -> Packet | None:
+        current_time = now()
+        packet, ok_to_drop = self._pop(current_time)
+        if packet == None:
+            self._dropping = False
+            return None
+        if self._dropping:
+            if not ok_to_drop:
+                self._dropping = False
+            while self._dropping and current_time >= self._drop_next:
+                self._drop(packet)
+                self._count += 1
+                packet, ok_to_drop = self._pop(current_time)
+                if not ok_to_drop:
+                    self._dropping = False
+                else:
+                    self._drop_next = self._control_law(self._drop_next)
+        elif ok_to_drop:
+            self._drop(packet)
+            packet, _ = self._pop(current_time)
+            self._dropping = True
+            # Start near the previous drop rate if we were dropping recently
+            delta = self._count - self._last_count
+            if delta > 1 and current_time - self._drop_next < 16 * self._interval:
+                self._count = delta
             else:
-                packet, current_finish = self._queue2.popleft()
-            self._size_in_buffer -= 1
-            trace('buffer-dequeue', f'unbuffering packet ({current_finish}) from {packet.label} for {self._label} (buffer size {self._size_in_buffer}/{self._capacity})')
-            return packet
\ No newline at end of file
+                self._count = 1
+            self._last_count = self._count
+            self._drop_next = self._control_law(current_time)
+        if packet != None:
+            self._dequeued(packet)
+        return packet
+
+
+class HTBBuffer(Buffer):
+    """A hierarchical token bucket (HTB) shaper with one leaf class per connection label.
+
+    Classes form a tree under 'root', which gets the link bandwidth unless `classes` says
+    otherwise. Each class has a guaranteed `rate` and a `ceil` it may reach by borrowing
+    unused rate from its ancestors, in size units per time unit or as a percentage of the
+    link bandwidth (like '25%'). Tokens are refilled lazily from util.now() whenever a class
+    is looked at, up to `burst` size units, so there are no per-tick timers.
+
+    A leaf may send if it has tokens itself, or if an ancestor does and every class on the
+    way up (including the leaf) is within its ceil. Sending charges every class up to the root.
+    Leaves within their own rate take turns first; after that, leaves borrow in proportion to
+    their rates (the one that has borrowed the least per unit of rate goes next). When none may
+    send yet, dequeue() returns None and next_ready_time() the earliest time one may.
+
+    So that a leaf held back by its ceil cannot fill the buffer and starve the others, a full
+    buffer drops the last packet of the leaf with the most queued packets, or the arriving
+    packet if its own leaf has the most. Labels without a class get a leaf under root with
+    rate 0 and ceil 100%.
+    """
+    DEFAULT_CLASSES = {
+        'c1': {'parent': 'root', 'rate': '50%', 'ceil': '100%'},
+        'c2': {'parent': 'root', 'rate': '50%', 'ceil': '100%'},
+    }
+
+    # tolerance for rounding error when tokens are refilled exactly up to 0
+    EPSILON = 1e-9
+    # share of borrowed rate for leaves with rate 0, relative to a rate of 1
+    MINIMUM_SHARE = 1e-6
+
+    class ShapingClass:
+        def __init__(self, name: str, parent, rate: float, ceil: float, burst: float):
+            self.name = name
+            self.rate = rate
+            self.ceil = ceil
+            self.burst = burst
+            self.tokens = burst
+            self.ctokens = burst
+            self.last_update = 0.0
+            self.queue = deque()
+            # size borrowed from ancestors divided by rate
+            self.borrowed = 0.0
+            # this class and its ancestors, up to the root
+            self.path = [self] + (parent.path if parent != None else [])
+
+        def refill(self, time):
+            elapsed = time - self.last_update
+            if elapsed > 0:
+                self.tokens = min(self.burst, self.tokens + self.rate * elapsed)
+                self.ctokens = min(self.burst, self.ctokens + self.ceil * elapsed)
+                self.last_update = time
+            # Unlimited classes (e.g. on an infinite-bandwidth link) never wait
+            if self.rate == float('inf'):
+                self.tokens = self.burst
+            if self.ceil == float('inf'):
+                self.ctokens = self.burst
+
+        def rate_ready_time(self) -> float:
+            if self.tokens >= 0:
+                return self.last_update
+            return self.last_update - self.tokens / self.rate if self.rate > 0 else float('inf')
+
+        def ceil_ready_time(self) -> float:
+            if self.ctokens >= 0:
+                return self.last_update
+            return self.last_update - self.ctokens / self.ceil if self.ceil > 0 else float('inf')
+
+    def __init__(self, capacity, bandwidth, label, classes=None, burst=500, byte_capacity=None):
+        super().__init__(capacity, bandwidth, label, byte_capacity)
+        classes = dict(self.DEFAULT_CLASSES if classes == None else classes)
+        root = classes.pop('root', {'rate': bandwidth, 'ceil': bandwidth})
+        self._burst = burst
+        self._classes = {}
+        self._classes['root'] = self.ShapingClass(
+            'root', None, self._resolve_rate(root['rate']), self._resolve_rate(root.get('ceil', root['rate'])), burst)
+        pending = dict(classes)
+        while len(pending) > 0:
+            ready = [name for name, spec in pending.items() if spec.get('parent', 'root') in self._classes]
+            if len(ready) == 0:
+                raise ValueError(f'HTB classes {", ".join(pending)} have unknown parents (or form a cycle)')
+            for name in ready:
+                spec = pending.pop(name)
+                rate = self._resolve_rate(spec['rate'])
+                ceil = self._resolve_rate(spec.get('ceil', spec['rate']))
+                self._classes[name] = self.ShapingClass(name, self._classes[spec.get('parent', 'root')], rate, ceil, burst)
+        # leaves with queued packets, in the order they take turns
+        self._active = OrderedDict()
+
+    def _resolve_rate(self, rate) -> float:
+        if isinstance(rate, str) and rate.endswith('%'):
+            return float(rate[:-1]) / 100 * self._bandwidth
+        return float(rate)
+
+    def _leaf(self, label) -> 'HTBBuffer.ShapingClass':
+        leaf = self._classes.get(label)
+        if leaf == None:
+            leaf = self._classes[label] = self.ShapingClass(label, self._classes['root'], 0.0, self._bandwidth, self._burst)
+        return leaf
+
+    def occupancy_by_class(self) -> dict[str, int]:
+        return {name: len(self._classes[name].queue) for name in self._class_counts}
+
+    def weight(self, label) -> float:
+        # Guaranteed rates are the intended split; unconfigured or unlimited leaves count as 1
+        leaf = self._classes.get(label)
+        if leaf == None or leaf.rate <= 0 or leaf.rate == float('inf'):
+            return 1.0
+        return leaf.rate
+
+    def enqueue(self, packet: Packet):
+        leaf = self._leaf(packet.label)
+        while not self._has_room(packet.size):
+            longest = max(self._active.values(), key=lambda item: len(item.queue), default=None)
+            if longest == None or len(leaf.queue) + 1 > len(longest.queue):
+                self._dropped(packet)
+                return
+            self._evicted(longest.queue.pop())
+            if len(longest.queue) == 0:
+                del self._active[longest.name]
+        if len(leaf.queue) == 0 and len(self._active) > 0:
+            # Do not let a leaf that was idle catch up on borrowing it did not need
+            leaf.borrowed = max(leaf.borrowed, min(item.borrowed for item in self._active.values()))
+        leaf.queue.append(packet)
+        self._active[leaf.name] = leaf
+        self._enqueued(packet)
+
+    def _may_send(self, leaf, borrow: bool) -> bool:
+        for item in leaf.path:
+            if item.ctokens < -self.EPSILON:
+                return False
+            if item.tokens >= -self.EPSILON:
+                return True
+            if not borrow:
+                return False
+        return False
+
+    def _ready_time(self, leaf) -> float:
+        """The earliest time at which leaf may send, assuming nothing else is sent first."""
+        ceil_ready = 0.0
+        result = float('inf')
+        for item in leaf.path:
+            ceil_ready = max(ceil_ready, item.ceil_ready_time())
+            result = min(result, max(ceil_ready, item.rate_ready_time()))
+        return result
+
+    def _refill(self, time):
+        for leaf in self._active.values():
+            for item in leaf.path:
+                item.refill(time)
+
+    def next_ready_time(self) -> float | None:
+        if self._size_in_buffer == 0:
+            return None
+        current_time = now()
+        self._refill(current_time)
+        if any(self._may_send(leaf, borrow=True) for leaf in self._active.values()):
+            return current_time
+        return min(self._ready_time(leaf) for leaf in self._active.values())
+
+    def dequeue(self) -> Packet | None:
+        if self._size_in_buffer == 0:
+            return None
+        self._refill(now())
+        chosen = None
+        for leaf in self._active.values():
+            if self._may_send(leaf, borrow=False):
+                chosen = leaf
+                break
+        else:
+            borrowers = [leaf for leaf in self._active.values() if self._may_send(leaf, borrow=True)]
+            if len(borrowers) == 0:
+                return None
+            chosen = min(borrowers, key=lambda leaf: leaf.borrowed)
+            chosen.borrowed += chosen.queue[0].size / max(chosen.rate, self.MINIMUM_SHARE)
+        packet = chosen.queue.popleft()
+        for item in chosen.path:
+            item.tokens -= packet.size
+            item.ctokens -= packet.size
+        if len(chosen.queue) > 0:
+            self._active.move_to_end(chosen.name)
+        else:
+            del self._active[chosen.name]
+        self._dequeued(packet, note=f' ({chosen.name} tokens {chosen.tokens:.0f})')
+        return packet
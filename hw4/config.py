@@ -1,4 +1,7 @@
 ## all the options here can be overriden on the command-line
 
+"""file for a binary trace of link events (see event_trace.py); empty to disable"""
+EVENT_TRACE = ''
+
 """event types to trace, based on first argument to trace() call"""
 TRACE = {'buffer-enqueue', 'buffer-drop', 'buffer-dequeue'}
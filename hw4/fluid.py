@@ -0,0 +1,278 @@
+"""A fluid approximation of the hw4 simulation, for quick parameter sweeps.
+
+Each connection is modeled as a constant rate of data (its generate rate times its mean
+message size) and the forward link as a fluid queue, advanced in fixed time steps. When the
+link is not overloaded, a fluid queue stays empty, so an M/G/1 estimate of the queueing
+caused by random arrivals and message sizes is added to the latency and buffer occupancy.
+
+With constant rates, the queues soon change by the same amount every step (staying empty or
+full, or growing or draining at a constant rate), so FluidSimulator skips over such stretches
+in one jump instead of taking every step.
+
+The approximation holds (errors of about 10% or less against the packet-level simulation, see
+--validate-fluid) for loads up to about 0.8. Up to a load of 0.95 it needs a buffer much larger
+than the M/G/1 mean queue (about 10 packets at 0.95 with the default message sizes): that
+estimate ignores the buffer limit, so with a 10-packet buffer latencies come out about 50% too
+high there. When overloaded, throughputs are still within a few percent, but with priority or
+WFQ the latency of each class can be off by 30-80%, since the fluid classes do not share the
+buffer the way packets do. A class that gets no throughput at all has latency_mean None.
+"""
+
+import math
+
+"""Fluid model of each buffer class in buffer.py, and the weight or priority of each connection."""
+FLUID_DISCIPLINES = {
+    'DropTailBuffer': ('fifo', {}),
+    'PriorityQueueBuffer': ('priority', {'c1': 0, 'c2': 1}),
+    'WeightedFairQueuingBuffer': ('wfq', {'c1': 2, 'c2': 1}),
+}
+
+class FluidClass:
+    """The traffic of one connection at the forward link."""
+    def __init__(self, label, rate, mean_size, weight):
+        self.label = label
+        self.rate = rate * mean_size
+        self.packet_rate = rate
+        self.mean_size = mean_size
+        self.weight = weight
+        self.queue = 0.0
+        self.served = 0.0
+        self.queue_integral = 0.0
+
+class FluidLink:
+    def __init__(self, bandwidth, capacity, discipline, delay, delay_variance, drop):
+        self.bandwidth = bandwidth
+        self.capacity = capacity
+        self.discipline = discipline
+        self.delay = delay
+        self.delay_variance = delay_variance
+        self.drop = drop
+
+    def _serve(self, classes, demands, available):
+        if self.discipline == 'priority':
+            served = {}
+            for item in sorted(classes, key=lambda item: item.weight):
+                served[item.label] = min(demands[item.label], available)
+                available -= served[item.label]
+            return served
+        elif self.discipline == 'wfq':
+            # Generalized processor sharing: split by weight, giving unused shares to the others
+            served = {}
+            remaining = list(classes)
+            while len(remaining) > 0:
+                total_weight = sum(item.weight for item in remaining)
+                satisfied = [item for item in remaining
+                             if demands[item.label] <= available * item.weight / total_weight]
+                if len(satisfied) == 0:
+                    for item in remaining:
+                        served[item.label] = available * item.weight / total_weight
+                    break
+                for item in satisfied:
+                    served[item.label] = demands[item.label]
+                    available -= demands[item.label]
+                    remaining.remove(item)
+            return served
+        else:
+            total_demand = sum(demands.values())
+            if total_demand <= available:
+                return dict(demands)
+            return {label: available * demand / total_demand for label, demand in demands.items()}
+
+    def _drop_excess(self, classes, arrivals):
+        excess = sum(item.queue for item in classes) - self.capacity
+        if excess <= 0:
+            return
+        if self.discipline == 'priority':
+            # Higher priority arrivals push out lower priority packets
+            for item in sorted(classes, key=lambda item: -item.weight):
+                removed = min(item.queue, excess)
+                item.queue -= removed
+                excess -= removed
+        elif self.discipline == 'wfq':
+            # Drop from whichever class has the latest virtual finish time, i.e. the most queued per weight
+            level = _water_level([(item.queue, item.weight) for item in classes], self.capacity)
+            for item in classes:
+                item.queue = min(item.queue, level * item.weight)
+        else:
+            total_arrivals = sum(arrivals.values())
+            for item in classes:
+                item.queue -= excess * arrivals[item.label] / total_arrivals
+
+    def step(self, classes, dt):
+        demands = {item.label: item.queue + item.rate * dt for item in classes}
+        served = self._serve(classes, demands, self.bandwidth * dt)
+        for item in classes:
+            item.queue = demands[item.label] - served[item.label]
+            item.served += served[item.label]
+        self._drop_excess(classes, {item.label: item.rate * dt for item in classes})
+
+    def queueing_delays(self, classes) -> dict[str, float]:
+        """M/G/1 mean waiting time of each class, or 0 if the link is overloaded.
+
+        Message sizes are uniform over [mean_size / 2, 3 * mean_size / 2], so the second moment of the
+        transmission time is (13 / 12) (mean_size / bandwidth)^2.
+        """
+        load = sum(item.rate for item in classes) / self.bandwidth
+        if load >= 1.0 or self.bandwidth == float('inf'):
+            return {item.label: 0.0 for item in classes}
+        residual = sum(item.packet_rate * (13 / 12) * (item.mean_size / self.bandwidth) ** 2
+                       for item in classes) / 2
+        if self.discipline in ('priority', 'wfq'):
+            # Below their fair share, WFQ serves the class with the least traffic per weight
+            # almost as if it had priority.
+            if self.discipline == 'priority':
+                order = sorted(classes, key=lambda item: item.weight)
+            else:
+                order = sorted(classes, key=lambda item: item.rate / item.weight)
+            result = {}
+            higher_load = 0.0
+            for item in order:
+                own_load = higher_load + item.rate / self.bandwidth
+                result[item.label] = residual / ((1 - higher_load) * (1 - own_load))
+                higher_load = own_load
+            return result
+        return {item.label: residual / (1 - load) for item in classes}
+
+def _water_level(queues_and_weights, capacity) -> float:
+    """The level L such that sum(min(queue, L * weight)) == capacity."""
+    items = sorted(queues_and_weights, key=lambda item: item[0] / item[1])
+    used = 0.0
+    remaining_weight = sum(weight for _, weight in items)
+    for queue, weight in items:
+        level = (capacity - used) / remaining_weight
+        if queue <= level * weight:
+            used += queue
+            remaining_weight -= weight
+        else:
+            return level
+    return float('inf')
+
+class FluidSimulator:
+    """Approximates the connection and forward link statistics reported by main.py's --json output."""
+    def __init__(self, args, step=0.1):
+        buffer_class = args.buffer_class.rsplit('.', maxsplit=1)[-1]
+        if buffer_class not in FLUID_DISCIPLINES:
+            raise ValueError(f'no fluid model for {args.buffer_class}; expected one of {", ".join(FLUID_DISCIPLINES)}')
+        discipline, weights = FLUID_DISCIPLINES[buffer_class]
+        for label in ('c1', 'c2'):
+            if getattr(args, f'{label}_trace', None) or getattr(args, f'{label}_source', 'poisson') != 'poisson':
+                raise ValueError(f'the fluid model assumes Poisson arrivals with uniform sizes; {label} uses another message source')
+        if discipline == 'wfq' and getattr(args, 'buffer_weights', None) != None:
+            weights = args.buffer_weights
+        self._args = args
+        self._step = step
+        self._classes = [
+            FluidClass('c1', args.c1_rate, args.c1_size, weights.get('c1', 1)),
+            FluidClass('c2', args.c2_rate, args.c2_size, weights.get('c2', 1)),
+        ]
+        mean_size = sum(item.rate for item in self._classes) / sum(item.packet_rate for item in self._classes)
+        self._link = FluidLink(
+            bandwidth=args.bandwidth_forward,
+            capacity=args.buffer_size * mean_size if getattr(args, 'buffer_bytes', None) == None else args.buffer_bytes,
+            discipline=discipline,
+            delay=args.delay,
+            delay_variance=args.delay_variance,
+            drop=args.drop_forward,
+        )
+        self._time = 0.0
+
+    def _take_step(self, measure) -> list[float]:
+        """Take one step, adding to the queue integrals if `measure` is set. Returns the change in
+        the queue and served amount of each class."""
+        before = [value for item in self._classes for value in (item.queue, item.served)]
+        self._link.step(self._classes, self._step)
+        if measure:
+            for item in self._classes:
+                item.queue_integral += item.queue * self._step
+        return [after - value for after, value
+                in zip((value for item in self._classes for value in (item.queue, item.served)), before)]
+
+    def _same_changes(self, changes, other) -> bool:
+        tolerance = 1e-9 * sum(item.rate for item in self._classes) * self._step
+        return all(abs(change - other_change) <= tolerance for change, other_change in zip(changes, other))
+
+    def _linear_steps(self, changes, limit) -> int:
+        """How many more steps, up to `limit`, the queues can keep changing by `changes` without
+        one running empty or the buffer filling."""
+        result = limit
+        total_change = 0.0
+        for item, change in zip(self._classes, changes[::2]):
+            total_change += change
+            if change < 0:
+                result = min(result, math.floor(item.queue / -change) - 1)
+        if total_change > 0:
+            total_queue = sum(item.queue for item in self._classes)
+            result = min(result, math.floor((self._link.capacity - total_queue) / total_change) - 1)
+        return max(result, 0)
+
+    def _jump(self, changes, count, measure):
+        """Apply `count` steps that each change the queues and served amounts by `changes`."""
+        for item, queue_change, served_change in zip(self._classes, changes[::2], changes[1::2]):
+            if measure:
+                # The queue after each of the steps, summed
+                item.queue_integral += (count * item.queue + queue_change * count * (count + 1) / 2) * self._step
+            item.queue += queue_change * count
+            item.served += served_change * count
+
+    def _advance(self, steps, measure):
+        """Take `steps` steps, adding to the queue integrals if `measure` is set.
+
+        Once two steps in a row change the queues and served amounts the same way, jump over
+        the following steps, up to when a queue would run empty or the buffer fill. Other
+        changes in how the link serves or drops (like WFQ's per-class limits in a full buffer)
+        are caught by taking one real step after the jump: if it changes things differently,
+        the jump is undone and retried with half as many steps.
+        """
+        previous_changes = None
+        while steps > 0:
+            changes = self._take_step(measure)
+            steps -= 1
+            if previous_changes != None and self._same_changes(changes, previous_changes):
+                count = self._linear_steps(changes, steps - 1)
+                saved = [(item.queue, item.served, item.queue_integral) for item in self._classes]
+                while count > 0:
+                    self._jump(changes, count, measure)
+                    if self._same_changes(self._take_step(measure), changes):
+                        steps -= count + 1
+                        break
+                    for item, (queue, served, queue_integral) in zip(self._classes, saved):
+                        item.queue, item.served, item.queue_integral = queue, served, queue_integral
+                    count //= 2
+            previous_changes = changes
+
+    def run(self):
+        warmup = getattr(self._args, 'warmup', 0.0)
+        steps = max(1, round((self._args.time_limit - warmup) / self._step))
+        self._advance(round(warmup / self._step), measure=False)
+        for item in self._classes:
+            item.served = 0.0
+        self._advance(steps, measure=True)
+        self._time = steps * self._step
+
+    def json_info(self) -> dict:
+        link = self._link
+        waiting = link.queueing_delays(self._classes)
+        extra_delay = link.delay + (1 / link.delay_variance if link.delay_variance > 0 else 0.0)
+        result = {}
+        mean_buffer_used = 0.0
+        for item in self._classes:
+            throughput = item.served / self._time
+            mean_queue = item.queue_integral / self._time
+            if throughput > 0:
+                fluid_wait = mean_queue / throughput
+                latency_mean = fluid_wait + waiting[item.label] + item.mean_size / link.bandwidth + extra_delay
+            else:
+                # Starved: nothing gets through, so there is no latency to report (null in JSON)
+                latency_mean = None
+            mean_buffer_used += mean_queue / item.mean_size + waiting[item.label] * item.packet_rate
+            result[item.label] = {
+                'generate_rate': item.packet_rate,
+                'generate_mean_size': item.mean_size,
+                'received_rate_packets': throughput * (1 - link.drop) / item.mean_size,
+                'received_rate_size': throughput * (1 - link.drop),
+                'latency_mean': latency_mean,
+            }
+        result['forward_link'] = {
+            'mean_buffer_used': min(mean_buffer_used, self._args.buffer_size),
+        }
+        return result
@@ -1,11 +1,19 @@
 import argparse
 import config
+import copy
+import cProfile
+import fluid
 import json
+import math
+import random
 import re
+import replications
+import sources
+import time
 import util
 import sys
 
-from util import Message
+from util import Message, Packet, jain_index
 from simulator import Simulator, Event
 from importlib import import_module
 
@@ -21,27 +29,72 @@ def get_class(name, default_module):
 def get_buffer_class(args):
     return get_class(args.buffer_class, 'buffer')
 
+def get_buffer_options(args) -> dict:
+    """Extra keyword arguments for the buffer class constructor."""
+    options = {}
+    if args.buffer_weights != None:
+        options['weights'] = args.buffer_weights
+    if args.buffer_quantum != None:
+        options['quantum'] = args.buffer_quantum
+    if args.buffer_bytes != None:
+        options['byte_capacity'] = args.buffer_bytes
+    if args.htb_classes != None:
+        options['classes'] = args.htb_classes
+    if args.htb_burst != None:
+        options['burst'] = args.htb_burst
+    for name in ('min_threshold', 'max_threshold', 'max_probability'):
+        if getattr(args, f'red_{name}') != None:
+            options[name] = getattr(args, f'red_{name}')
+    if args.codel_target != None:
+        options['target'] = args.codel_target
+    if args.codel_interval != None:
+        options['interval'] = args.codel_interval
+    return options
+
+def describe_buffer(args) -> str:
+    if args.buffer_bytes != None:
+        return f'{args.buffer_bytes}-size-unit {args.buffer_class}'
+    return f'{args.buffer_size}-entry {args.buffer_class}'
+
+def get_source(args, label):
+    """The message source for connection `label` ('c1' or 'c2') selected by the command-line options."""
+    return sources.new_source(
+        getattr(args, f'{label}_source'),
+        label=label,
+        rate=getattr(args, f'{label}_rate'),
+        mean_size=getattr(args, f'{label}_size'),
+        trace_path=getattr(args, f'{label}_trace'),
+        shape=args.pareto_shape,
+        on_time=args.on_time,
+        off_time=args.off_time,
+    )
+
 def get_receiver_class(args):
     return get_class(args.receiver_class, 'ends')
 
 def get_sender_class(args):
     return get_class(args.sender_class, 'ends')
 
-def run(args):
+def setup(args):
     _simulator = util._simulator = Simulator(args)
     _simulator.new_link(
         bandwidth=args.bandwidth_forward,
         buffer_size=args.buffer_size,
         buffer_cls=get_buffer_class(args),
+        buffer_options=get_buffer_options(args),
         delay=args.delay,
         delay_variance=args.delay_variance,
         drop=args.drop_forward,
-        label='forward'
+        label='forward',
+        queues=args.link_queues,
+        steering=args.link_steering,
+        queue_bandwidth=args.link_queue_bandwidth,
     )
     _simulator.new_link(
         bandwidth=args.bandwidth_backward,
         buffer_size=args.buffer_size,
         buffer_cls=get_buffer_class(args),
+        buffer_options=get_buffer_options(args),
         delay=args.delay,
         delay_variance=args.delay_variance,
         drop=args.drop_backward,
@@ -55,7 +108,8 @@ def run(args):
         backward_link_name='backward',
         missing_is_error=False,
     )
-    c1.generate_messages(rate=args.c1_rate, total_messages=args.c1_count, mean_size=args.c1_size)
+    c1.generate_messages(rate=args.c1_rate, total_messages=args.c1_count, mean_size=args.c1_size,
+                             source=get_source(args, 'c1'))
     c2= _simulator.new_connection(
         label='c2',
         sender=get_sender_class(args)(),
@@ -64,22 +118,233 @@ def run(args):
         backward_link_name='backward',
         missing_is_error=False,
     )
-    c2.generate_messages(rate=args.c2_rate, total_messages=args.c2_count, mean_size=args.c2_size)
+    c2.generate_messages(rate=args.c2_rate, total_messages=args.c2_count, mean_size=args.c2_size,
+                             source=get_source(args, 'c2'))
+    _simulator.set_measurement(
+        warmup=args.warmup,
+        interval=args.measure_interval,
+        steady_state_tolerance=args.steady_state_tolerance,
+        steady_state_intervals=args.steady_state_intervals,
+    )
+    return _simulator
+
+def json_results(args, _simulator):
+    json_data = {
+        'bandwidth_forward': args.bandwidth_forward,
+        'delay': args.delay,
+        'delay_variance':args.delay_variance,
+        'buffer_class': args.buffer_class,
+        'c1': _simulator._connections['c1'].json_info(),
+        'c2': _simulator._connections['c2'].json_info(),
+        'forward_link': _simulator._links['forward'].json_info(),
+        'backward_link': _simulator._links['backward'].json_info(),
+        'fairness': _simulator.fairness_info(),
+    }
+    if args.warmup > 0.0 or args.measure_interval != None:
+        json_data['warmup'] = args.warmup
+    if args.steady_state_tolerance != None:
+        json_data['steady_state_time'] = _simulator._steady_state_time
+    return json_data
+
+def run_replication(args):
+    _simulator = setup(args)
     _simulator.run(time_limit = args.time_limit)
+    return json_results(args, _simulator)
+
+def run_replications(args):
+    seeds, summary = replications.run_replications(
+        run_replication, args, args.replications,
+        ci_metric=args.ci_metric, ci_target=args.ci_target,
+    )
     if args.json:
-        json_data = {
+        json.dump({
+            'replications': len(seeds),
+            'seeds': seeds,
+            'buffer_class': args.buffer_class,
+            'metrics': summary,
+        }, fp=sys.stdout, indent=2)
+    else:
+        print(f'forward link: {args.bandwidth_forward:.1f} size units/sec; link delay {args.delay} +/- {args.delay_variance}; {describe_buffer(args)}')
+        replications.print_summary(seeds, summary)
+
+def run_fluid(args):
+    fluid_simulator = fluid.FluidSimulator(args, step=args.fluid_step)
+    fluid_simulator.run()
+    results = fluid_simulator.json_info()
+    if args.json:
+        json.dump({
             'bandwidth_forward': args.bandwidth_forward,
             'delay': args.delay,
             'delay_variance':args.delay_variance,
             'buffer_class': args.buffer_class,
-            'c1': c1.json_info(),
-            'c2': c2.json_info()
-        }
+            'engine': 'fluid',
+            **results,
+        }, fp=sys.stdout, indent=2)
+    else:
+        print(f'forward link: {args.bandwidth_forward:.1f} size units/sec; link delay {args.delay} +/- {args.delay_variance}; {describe_buffer(args)} (fluid approximation)')
+        for label in ('c1', 'c2'):
+            info = results[label]
+            latency = f"mean {info['latency_mean']:.2f}" if info['latency_mean'] is not None else 'none (starved)'
+            print(f"{label}: {info['received_rate_size']:.1f} size units/time unit; {info['received_rate_packets']:.1f} messages/time unit; latency: {latency}")
+        print(f"forward link: mean buffer used {results['forward_link']['mean_buffer_used']:.2f}")
+
+"""Metrics compared by --validate-fluid."""
+FLUID_VALIDATION_METRICS = [
+    ('c1', 'received_rate_size'),
+    ('c2', 'received_rate_size'),
+    ('c1', 'latency_mean'),
+    ('c2', 'latency_mean'),
+    ('forward_link', 'mean_buffer_used'),
+]
+
+def validate_fluid(args):
+    """Compare the fluid approximation to the packet-level simulation for each buffer class
+    in fluid.FLUID_DISCIPLINES, with the forward bandwidth at several multiples of the offered load."""
+    offered_load = args.c1_rate * args.c1_size + args.c2_rate * args.c2_size
+    rows = []
+    for buffer_class in fluid.FLUID_DISCIPLINES:
+        for load_factor in (0.5, 0.8, 0.95, 1.25, 2.0):
+            grid_args = copy.copy(args)
+            grid_args.buffer_class = f'buffer.{buffer_class}'
+            grid_args.bandwidth_forward = offered_load / load_factor
+            grid_args.warmup = max(args.warmup, args.time_limit / 10)
+            packet_results = run_replication(grid_args)
+            fluid_simulator = fluid.FluidSimulator(grid_args, step=args.fluid_step)
+            fluid_simulator.run()
+            fluid_results = fluid_simulator.json_info()
+            for owner, name in FLUID_VALIDATION_METRICS:
+                packet_value = packet_results[owner][name]
+                if math.isnan(packet_value):
+                    packet_value = None
+                fluid_value = fluid_results[owner][name]
+                if fluid_value is not None and packet_value:
+                    relative_error = abs(fluid_value - packet_value) / abs(packet_value)
+                else:
+                    relative_error = None
+                rows.append({
+                    'buffer_class': buffer_class,
+                    'load': load_factor,
+                    'metric': f'{owner}.{name}',
+                    'packet': packet_value,
+                    'fluid': fluid_value,
+                    'relative_error': relative_error,
+                })
+    if args.json:
+        json.dump(rows, fp=sys.stdout, indent=2)
+    else:
+        print(f'{"buffer class":26s} {"load":>5s} {"metric":28s} {"packet":>10s} {"fluid":>10s} {"error":>7s}')
+        for row in rows:
+            packet_value = f"{row['packet']:10.2f}" if row['packet'] is not None else f'{"-":>10s}'
+            fluid_value = f"{row['fluid']:10.2f}" if row['fluid'] is not None else f'{"-":>10s}'
+            relative_error = f"{row['relative_error']:7.1%}" if row['relative_error'] is not None else f'{"-":>7s}'
+            print(f"{row['buffer_class']:26s} {row['load']:5.2f} {row['metric']:28s} {packet_value} {fluid_value} {relative_error}")
+        print('The fluid approximation is meant for loads up to about 0.8, or 0.95 with a buffer much larger')
+        print('than the mean queue; when overloaded, only throughputs are accurate (see fluid.py).')
+
+"""Buffer classes compared by --benchmark-buffers."""
+BENCHMARK_BUFFER_CLASSES = ['DropTailBuffer', 'WeightedFairQueuingBuffer', 'DeficitRoundRobinBuffer']
+
+def _benchmark_buffer_only(args, buffer_class, flows, operations=100000):
+    """Feed a buffer packets from `flows` classes at twice the rate it is emptied, so every class
+    is backlogged; returns (Jain's index of weight-normalized service, CPU microseconds per operation)."""
+    weights = {f'f{i}': 1 + i % 3 for i in range(flows)}
+    buffer_obj = get_class(buffer_class, 'buffer')(args.buffer_size * 10, args.bandwidth_forward, 'benchmark',
+                                                   **({} if buffer_class == 'DropTailBuffer' else {'weights': weights}))
+    rng = random.Random(args.seed)
+    packets = []
+    for _ in range(operations):
+        packet = Packet(data=bytes(rng.randrange(32, 152)))
+        packet.label = f'f{rng.randrange(flows)}'
+        packets.append(packet)
+    served = {label: 0 for label in weights}
+    start = time.process_time()
+    for index, packet in enumerate(packets):
+        buffer_obj.enqueue(packet)
+        if index % 2 == 1:
+            packet = buffer_obj.dequeue()
+            served[packet.label] += packet.size
+    elapsed = time.process_time() - start
+    return jain_index(served[label] / weights[label] for label in weights), elapsed / (operations * 1.5) * 1e6
+
+def benchmark_buffers(args):
+    """Compare buffer classes on fairness and simulator CPU time, both in a full simulation
+    and on the buffer alone with many classes."""
+    saved_trace = config.TRACE
+    config.TRACE = set()
+    weights = args.buffer_weights or get_class('WeightedFairQueuingBuffer', 'buffer').DEFAULT_WEIGHTS
+    rows = []
+    for buffer_class in BENCHMARK_BUFFER_CLASSES:
+        run_args = copy.copy(args)
+        run_args.buffer_class = f'buffer.{buffer_class}'
+        start = time.process_time()
+        results = run_replication(run_args)
+        elapsed = time.process_time() - start
+        packets = results['forward_link']['total_sent'] + results['backward_link']['total_sent']
+        flow_jain, flow_microseconds = _benchmark_buffer_only(args, buffer_class, args.benchmark_flows)
+        rows.append({
+            'buffer_class': buffer_class,
+            'jain_index': jain_index(results[label]['received_rate_size'] / weights.get(label, 1) for label in ('c1', 'c2')),
+            'microseconds_per_packet': elapsed / packets * 1e6,
+            'flows': args.benchmark_flows,
+            'flows_jain_index': flow_jain,
+            'flows_microseconds_per_operation': flow_microseconds,
+        })
+    config.TRACE = saved_trace
+    if args.json:
+        json.dump(rows, fp=sys.stdout, indent=2)
+    else:
+        print(f'{"":26s} {"simulation (c1, c2)":>22s} {f"buffer only ({args.benchmark_flows} classes)":>30s}')
+        print(f'{"buffer class":26s} {"Jain":>8s} {"us/packet":>13s} {"Jain":>12s} {"us/operation":>17s}')
+        for row in rows:
+            print(f"{row['buffer_class']:26s} {row['jain_index']:8.4f} {row['microseconds_per_packet']:13.2f} "
+                  f"{row['flows_jain_index']:12.4f} {row['flows_microseconds_per_operation']:17.2f}")
+
+def run(args):
+    if args.restore:
+        with open(args.restore, 'rb') as f:
+            _simulator = Simulator.restore(f.read())
+        # Keep the restored settings, except let the run branch off with different drop rates
+        restored_args = _simulator._args
+        for item in ('drop_forward', 'drop_backward', 'time_limit', 'checkpoint', 'checkpoint_time', 'json'):
+            setattr(restored_args, item, getattr(args, item))
+        args = restored_args
+        _simulator._links['forward']._drop = args.drop_forward
+        _simulator._links['backward']._drop = args.drop_backward
+    else:
+        _simulator = setup(args)
+    if args.profile_events:
+        _simulator.enable_profiling()
+    profiler = cProfile.Profile() if args.cprofile else None
+    if args.checkpoint:
+        _simulator.run(time_limit = args.checkpoint_time, profiler=profiler)
+        with open(args.checkpoint, 'wb') as f:
+            f.write(_simulator.checkpoint())
+        _simulator.done = False
+    _simulator.run(time_limit = args.time_limit, profiler=profiler)
+    if profiler != None:
+        profiler.dump_stats(args.cprofile)
+    c1 = _simulator._connections['c1']
+    c2 = _simulator._connections['c2']
+    if args.json:
+        json_data = json_results(args, _simulator)
+        if args.profile_events:
+            json_data['event_profile'] = _simulator.profile_summary()
         json.dump(json_data, fp=sys.stdout, indent=2)
     else:
-        print(f'forward link: {args.bandwidth_forward:.1f} size units/sec; link delay {args.delay} +/- {args.delay_variance}; {args.buffer_size}-entry {args.buffer_class}')
+        print(f'forward link: {args.bandwidth_forward:.1f} size units/sec; link delay {args.delay} +/- {args.delay_variance}; {describe_buffer(args)}')
+        if args.warmup > 0.0:
+            print(f'statistics exclude warm-up period of {args.warmup} time units')
+        if args.steady_state_tolerance != None:
+            if _simulator._steady_state_time != None:
+                print(f'reached steady state at time {_simulator._steady_state_time:.1f}')
+            else:
+                print('did not reach steady state')
         c1.print_statistics()
         c2.print_statistics()
+        _simulator.print_fairness()
+        _simulator._links['forward'].print_statistics()
+        if args.profile_events:
+            _simulator.print_profile_summary()
 
 def _convert_bool(s: str) -> bool:
     if s == 'true' or s == 'True':
@@ -99,6 +364,26 @@ def _convert_set(s: str) -> [str]:
 
 _convert_set.__name__ = 'comma-separted set of strings'
 
+def _convert_weights(s: str) -> dict[str, float]:
+    result = {}
+    for item in s.split(','):
+        label, weight = item.split('=')
+        result[label.strip()] = float(weight)
+    return result
+
+_convert_weights.__name__ = 'comma-separated LABEL=WEIGHT list'
+
+def _convert_htb_classes(s: str) -> dict[str, dict]:
+    result = {}
+    for item in s.split(','):
+        name, rates = item.split('=')
+        name, _, parent = name.strip().partition('@')
+        rate, _, ceil = rates.strip().partition(':')
+        result[name] = {'parent': parent or 'root', 'rate': rate, 'ceil': ceil or rate}
+    return result
+
+_convert_htb_classes.__name__ = 'comma-separated NAME[@PARENT]=RATE[:CEIL] list'
+
 class SetBothBandwidth(argparse.Action):
     def __call__(self, parser, args, values, option_string):
         setattr(args, 'bandwidth_forward', values)
@@ -120,12 +405,54 @@ if __name__ == '__main__':
         help='end simulation after UNITS time units (default: 5000)',
         default=5000
     )
+    input_group.add_argument('--checkpoint', metavar='FILE', type=str,
+        help='save the simulation state to FILE at --checkpoint-time, then continue', default=None)
+    input_group.add_argument('--checkpoint-time', metavar='UNITS', type=float,
+        help='time at which to save --checkpoint', default=None)
+    input_group.add_argument('--restore', metavar='FILE', type=str,
+        help='continue the simulation saved in FILE instead of starting a new one; '
+             'connection and buffer settings come from FILE, drop rates from the command line',
+        default=None)
+    input_group.add_argument('--seed', type=int, help='random seed (default: 42)', default=42)
+    input_group.add_argument('--replications', metavar='N', type=int,
+        help='run up to N replications with seeds --seed, --seed + 1, ... in parallel and report '
+             'the mean and 95%% confidence interval of each statistic', default=None)
+    input_group.add_argument('--ci-target', metavar='FRACTION', type=float,
+        help='stop --replications early once the 95%% confidence interval half-width of --ci-metric '
+             'is at most FRACTION of its mean', default=None)
+    input_group.add_argument('--ci-metric', metavar='NAME', type=str,
+        help='statistic checked by --ci-target (default: c1.received_rate_size)',
+        default='c1.received_rate_size')
+    input_group.add_argument('--warmup', metavar='UNITS', type=float,
+        help='exclude the first UNITS time units from statistics (default: 0)', default=0.0)
+    input_group.add_argument('--measure-interval', metavar='UNITS', type=float,
+        help='also report statistics, including fairness, for each UNITS time units after warm-up', default=None)
+    input_group.add_argument('--steady-state-tolerance', metavar='FRACTION', type=float,
+        help='end the simulation once each connection\'s received rate over the last '
+             '--steady-state-intervals intervals varies by at most FRACTION of its mean '
+             '(requires --measure-interval)', default=None)
+    input_group.add_argument('--steady-state-intervals', metavar='N', type=int,
+        help='number of intervals checked by --steady-state-tolerance (default: 5)', default=5)
     input_group.add_argument('--c1-rate', type=float, help='average input rate (messages/time unit) of connection c1', default=5)
     input_group.add_argument('--c1-size', type=float, help='average message size of connection c1 (default: 100; must be at least 40)', default=100)
     input_group.add_argument('--c1-count', type=int, help='number of messages to generate for connection c1 (default: infinite)', default=None)
     input_group.add_argument('--c2-rate', type=float, help='average input rate (messages/time unit) of connection c2', default=5)
     input_group.add_argument('--c2-size', type=float, help='average message size of connection c2 (defualt: 100; must be at least 40)', default=100)
     input_group.add_argument('--c2-count', type=int, help='number of messages to generate for connection c2 (default: infinite)', default=None)
+    for label in ('c1', 'c2'):
+        input_group.add_argument(f'--{label}-source', choices=list(sources.SOURCES), default='poisson',
+            help=f'how connection {label} generates messages: Poisson arrivals with uniform sizes, Pareto '
+                 f'(heavy-tailed) sizes, or on-off bursts, all at the --{label}-rate and --{label}-size '
+                 f'averages (default: poisson)')
+        input_group.add_argument(f'--{label}-trace', metavar='FILE', type=str, default=None,
+            help=f'replay the message arrival times and sizes of connection {label} from FILE, either CSV '
+                 f'(time,size lines) or binary (see sources.py), instead of using --{label}-source')
+    input_group.add_argument('--pareto-shape', metavar='SHAPE', type=float,
+        help='shape of --cN-source pareto message sizes; must be greater than 1 (default: 1.5)', default=1.5)
+    input_group.add_argument('--on-time', metavar='UNITS', type=float,
+        help='mean length of the bursts of --cN-source on-off (default: 1)', default=1.0)
+    input_group.add_argument('--off-time', metavar='UNITS', type=float,
+        help='mean gap between the bursts of --cN-source on-off (default: 1)', default=1.0)
 
     sim_group = parser.add_argument_group('simulated link+buffers settings')
     sim_group.add_argument('--drop', metavar='DROP-RATE',
@@ -145,10 +472,40 @@ if __name__ == '__main__':
         default=1000.0, type=float)
     sim_group.add_argument('--bandwidth-backward', help='simulated link bandwidth to sender in size per time unit (default: infinite)',
         default=float('inf'), type=float)
+    sim_group.add_argument('--link-queues', metavar='K', type=int, default=1,
+        help='give the forward link K parallel transmitters, each with its own --buffer-size buffer (default: 1)')
+    sim_group.add_argument('--link-steering', choices=('hash', 'round-robin', 'shortest'), default='hash',
+        help='how --link-queues spreads packets: by a hash of the connection, in turn, or to the shortest queue (default: hash)')
+    sim_group.add_argument('--link-queue-bandwidth', metavar='BANDWIDTH', type=float, default=None,
+        help='bandwidth of each of the --link-queues transmitters (default: --bandwidth-forward / K)')
     sim_group.add_argument('--buffer-size', help='simulated link buffer size in packets (default: 60)',
         default=60, type=int)
+    sim_group.add_argument('--buffer-bytes', metavar='SIZE', type=int, default=None,
+        help='limit link buffers to SIZE total packet size instead of --buffer-size packets')
     sim_group.add_argument('--buffer-class', help='link buffer implementation (default: DropTailBuffer))',
         default='buffer.DropTailBuffer', type=str)
+    sim_group.add_argument('--buffer-quantum', metavar='SIZE', type=float,
+        help='size units each class may send per round (times its weight) in DeficitRoundRobinBuffer (default: 200)',
+        default=None)
+    sim_group.add_argument('--buffer-weights', metavar='LABEL=WEIGHT,...', type=_convert_weights,
+        help='per-connection weights for WeightedFairQueuingBuffer (default: c1=2,c2=1)', default=None)
+    sim_group.add_argument('--red-min-threshold', metavar='PACKETS', type=float, default=None,
+        help='average queue length at which REDBuffer starts dropping early (default: 5)')
+    sim_group.add_argument('--red-max-threshold', metavar='PACKETS', type=float, default=None,
+        help='average queue length at which REDBuffer drops every arriving packet (default: 15)')
+    sim_group.add_argument('--red-max-probability', metavar='P', type=float, default=None,
+        help='REDBuffer drop probability just below --red-max-threshold (default: 0.1)')
+    sim_group.add_argument('--htb-classes', metavar='NAME[@PARENT]=RATE[:CEIL],...', type=_convert_htb_classes, default=None,
+        help='HTBBuffer class tree: each class (a connection label for leaves) gets a guaranteed RATE and may borrow '
+             'from its PARENT (default: root, which has the link bandwidth) up to CEIL; rates are in size units per time '
+             'unit or a percentage of the link bandwidth like 25%%, and apply to every link '
+             '(default: c1=50%%:100%%,c2=50%%:100%%)')
+    sim_group.add_argument('--htb-burst', metavar='SIZE', type=float, default=None,
+        help='tokens each HTBBuffer class may save up, in size units (default: 500)')
+    sim_group.add_argument('--codel-target', metavar='TIME', type=float, default=None,
+        help='queueing delay CoDelBuffer tries to stay below (default: 0.5)')
+    sim_group.add_argument('--codel-interval', metavar='TIME', type=float, default=None,
+        help='how long queueing delay must stay above --codel-target before CoDelBuffer drops (default: 5)')
     
     config_group = parser.add_argument_group('config.py settings')
     config_items = []
@@ -170,6 +527,27 @@ if __name__ == '__main__':
             config_items.append(item)
 
 
+    engine_group = parser.add_argument_group('simulation engine')
+    engine_group.add_argument('--engine', choices=['packet', 'fluid'], default='packet',
+        help='packet: packet-level simulation (default); fluid: fast fluid approximation '
+             '(see fluid.py; ignores --sender-class and --receiver-class)')
+    engine_group.add_argument('--fluid-step', metavar='UNITS', type=float, default=0.1,
+        help='time step of the fluid approximation (default: 0.1)')
+    engine_group.add_argument('--validate-fluid', default=False, action='store_true',
+        help='compare the fluid approximation to the packet-level simulation for each buffer class '
+             'and several forward bandwidths')
+
+    profile_group = parser.add_argument_group('profiling')
+    profile_group.add_argument('--benchmark-buffers', default=False, action='store_true',
+        help='compare fairness (Jain\'s index of weight-normalized throughput) and CPU time per packet of '
+             + ', '.join(BENCHMARK_BUFFER_CLASSES))
+    profile_group.add_argument('--benchmark-flows', metavar='N', type=int, default=200,
+        help='number of classes for the buffer-only part of --benchmark-buffers (default: 200)')
+    profile_group.add_argument('--profile-events', default=False, action='store_true',
+        help='report the time spent on each kind of event, buffer operation and trace output')
+    profile_group.add_argument('--cprofile', metavar='FILE', type=str, default=None,
+        help='run the event loop under cProfile and save the statistics to FILE (read with pstats)')
+
     ends_group = parser.add_argument_group('implementation of connection ends')
     ends_group.add_argument('--sender-class', default='trivial_ends.TrivialSender',
         help='class to implement sending end (default: trivial_ends.TrivialSender)')
@@ -179,7 +557,31 @@ if __name__ == '__main__':
     args = parser.parse_args()
     for item in config_items:
         config.__dict__[item] = args.__dict__[item]
+    if args.checkpoint and args.checkpoint_time == None:
+        print("--checkpoint requires --checkpoint-time")
+        sys.exit(1)
+    if args.measure_interval != None and args.measure_interval <= 0:
+        print("--measure-interval must be positive")
+        sys.exit(1)
+    if args.steady_state_tolerance != None and args.measure_interval == None:
+        print("--steady-state-tolerance requires --measure-interval")
+        sys.exit(1)
+    if args.replications != None and (args.checkpoint or args.restore):
+        print("--replications cannot be used with --checkpoint or --restore")
+        sys.exit(1)
+    if config.EVENT_TRACE and (args.replications != None or args.checkpoint or args.restore):
+        print("--event-trace cannot be used with --replications, --checkpoint or --restore")
+        sys.exit(1)
     if args.c1_size < 40 or args.c2_size < 40:
         print("--c1-size and --c2-size must both be greater than 40")
         sys.exit(1)
-    run(args)
+    if args.validate_fluid:
+        validate_fluid(args)
+    elif args.benchmark_buffers:
+        benchmark_buffers(args)
+    elif args.engine == 'fluid':
+        run_fluid(args)
+    elif args.replications != None:
+        run_replications(args)
+    else:
+        run(args)
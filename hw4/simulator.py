@@ -1,14 +1,20 @@
 import config
-from util import Packet, Message, create_timer, cancel_timer, now, trace, error
+from util import Packet, Message, create_timer, cancel_timer, now, trace, error, fairness
 from buffer import DropTailBuffer
+from event_trace import new_event_trace_recorder, SEND, RANDOM_DROP, DELIVER
+import sources
 import util
 
 import argparse
+import hashlib
 import json
+import pickle
 import random
 import re
 import sys
 import math
+import time
+import zlib
 from collections import deque
 from dataclasses import dataclass
 from heapq import heappush, heappop
@@ -28,6 +34,52 @@ class Event:
         else:
             return self.time < other.time
 
+@dataclass
+class Action:
+    """A serializable event action, which calls `target.method(*args)`.
+
+    Unlike a lambda, this can be saved by Simulator.checkpoint().
+    """
+    target: object
+    method: str
+    args: tuple = ()
+
+    def __call__(self):
+        getattr(self.target, self.method)(*self.args)
+
+def event_kind(action) -> tuple[str, str]:
+    """Returns a (kind, component label) pair describing what an event action does,
+    like ('Link.transmit_next', 'forward'), for Simulator.enable_profiling()."""
+    if isinstance(action, Action):
+        target, method = action.target, action.method
+    elif hasattr(action, '__self__'):
+        target, method = action.__self__, action.__name__
+    else:
+        return getattr(action, '__qualname__', type(action).__name__), ''
+    return f'{type(target).__name__}.{method}', getattr(target, '_label', '')
+
+class _ProfiledBuffer:
+    """Wraps a link's buffer to time its enqueue() and dequeue() calls separately from the link."""
+    def __init__(self, simulator, buffer_obj, label):
+        self._simulator = simulator
+        self._buffer = buffer_obj
+        self._label = label
+        self._kind = type(buffer_obj).__name__
+
+    def enqueue(self, packet):
+        return self._simulator._profiled_call(f'{self._kind}.enqueue', self._label, self._buffer.enqueue, packet)
+
+    def dequeue(self):
+        return self._simulator._profiled_call(f'{self._kind}.dequeue', self._label, self._buffer.dequeue)
+
+    def __len__(self):
+        return len(self._buffer)
+
+    def __getattr__(self, name):
+        if name == '_buffer':
+            raise AttributeError(name)
+        return getattr(self._buffer, name)
+
 class Link:
     def __init__(self, simulator, buffer_obj, bandwidth, delay, delay_variance, drop, label):
         self._simulator = simulator
@@ -37,64 +89,389 @@ class Link:
         self._delay_variance = delay_variance
         self._drop = drop
         self._pending_transmit = None
+        # timer for when the buffer says it may send again, if it is holding packets back
+        self._wakeup = None
         self._label = label
+        self._drop_rng = simulator.new_rng(f'link/{label}/drop')
+        self._delay_rng = simulator.new_rng(f'link/{label}/delay')
         self._total_sent = 0
         self._total_sent_size = 0
-        self._maximum_buffer = 0
+        self._buffer_has_len = hasattr(type(buffer_obj), '__len__')
+        self._buffer_has_classes = hasattr(buffer_obj, 'occupancy_by_class')
+        self._buffer_has_class_integrals = hasattr(buffer_obj, 'class_occupancy_integrals')
+        self._buffer_has_bytes = hasattr(buffer_obj, 'bytes_in_buffer')
+        self._buffer_has_counters = hasattr(buffer_obj, 'counters')
+        self._buffer_has_ready_time = hasattr(buffer_obj, 'next_ready_time')
+        # the link's event trace code is looked up once here, not for every record; enqueues,
+        # drops and evictions are recorded by the buffer itself
+        self._event_trace = simulator.event_trace
+        if self._event_trace != None:
+            if not hasattr(buffer_obj, '_event_trace'):
+                raise ValueError(f'--event-trace needs a buffer derived from Buffer, not {type(buffer_obj).__name__}')
+            self._trace_link = self._event_trace.link_code(label)
+        self._reset_occupancy(0.0)
+        self._interval_snapshot = None
+        self._intervals = []
 
     def get_rng(self):
-        return self._simulator.get_rng()
+        return self._drop_rng
 
     def _transmit(self, packet):
-        if self.get_rng().uniform(0.0, 1.0) > self._drop:
+        # random() instead of uniform(0.0, 1.0) gives the same value without a Python-level call
+        if self._drop_rng.random() > self._drop:
             delay = self._delay
             if self._delay_variance > 0:
-                delay += self.get_rng().expovariate(self._delay_variance)
+                delay += self._delay_rng.expovariate(self._delay_variance)
             self._simulator.trace('link', f'sending {packet} on {self._label} link [{delay} transmission time]')
+            if self._event_trace != None:
+                self._event_trace.record(self._simulator._time, SEND, packet.label, self._trace_link, packet, self._buffer._size_in_buffer)
+                action = Action(self, '_deliver', (packet,))
+            else:
+                action = Action(packet._hidden_destination, 'from_network', (packet,))
             self._simulator.create_timer(
                 delay,
-                lambda: packet._hidden_destination.from_network(packet),
+                action,
                 f'receiving {packet} on {self._label} link'
             )
         else:
             self._simulator.trace('link', f'sending {packet} on {self._label} link [randomly dropped]')
+            if self._event_trace != None:
+                self._event_trace.record(self._simulator._time, RANDOM_DROP, packet.label, self._trace_link, packet, self._buffer._size_in_buffer)
+
+    def _deliver(self, packet):
+        self._event_trace.record(self._simulator._time, DELIVER, packet.label, self._trace_link, packet, self._buffer._size_in_buffer)
+        packet._hidden_destination.from_network(packet)
+
+    def _buffer_used(self) -> int:
+        if self._buffer_has_len:
+            return len(self._buffer)
+        return getattr(self._buffer, '_size_in_buffer', 0)
+
+    def _buffer_bytes(self) -> int:
+        return self._buffer.bytes_in_buffer if self._buffer_has_bytes else self._buffer_used()
+
+    def transmitters(self) -> list['Link']:
+        """The links with their own buffer and transmitter that make up this one."""
+        return [self]
+
+    def weight(self, label) -> float:
+        """The share of this link that the buffer is configured to give connection `label`
+        (1 for every connection if the buffer has no weights)."""
+        if hasattr(self._buffer, 'weight'):
+            return self._buffer.weight(label)
+        return 1.0
+
+    def _reset_occupancy(self, start_time):
+        self._occupancy_start_time = start_time
+        self._last_buffer_change_time = start_time
+        self._buffer_used_integral = 0.0
+        self._buffer_bytes_integral = 0.0
+        # time spent with each number of packets in the buffer
+        self._occupancy_histogram = {}
+        self._maximum_buffer = self._buffer_used()
+        self._maximum_buffer_bytes = self._buffer_bytes()
+        # Buffers that keep their own per-class integrals update them in O(1) as each class
+        # changes; for others, every class is visited on every change
+        if self._buffer_has_class_integrals:
+            self._buffer.reset_class_occupancy()
+        self._class_used_integrals = {}
+
+    def _update_buffer_used(self):
+        """Account for buffer occupancy since the last change; call before changing the buffer."""
+        current_time = now()
+        elapsed = current_time - self._last_buffer_change_time
+        if elapsed > 0.0:
+            used = self._buffer_used()
+            self._buffer_used_integral += elapsed * used
+            self._occupancy_histogram[used] = self._occupancy_histogram.get(used, 0.0) + elapsed
+            if self._buffer_has_bytes:
+                self._buffer_bytes_integral += elapsed * self._buffer.bytes_in_buffer
+            if self._buffer_has_classes and not self._buffer_has_class_integrals:
+                for label, count in self._buffer.occupancy_by_class().items():
+                    self._class_used_integrals[label] = self._class_used_integrals.get(label, 0.0) + elapsed * count
+            self._last_buffer_change_time = current_time
+
+    def _take_snapshot(self) -> tuple:
+        self._update_buffer_used()
+        return (now(), self._buffer_used_integral)
+
+    def _mean_buffer_used_since(self, snapshot) -> float:
+        start_time, start_integral = snapshot
+        self._update_buffer_used()
+        return (self._buffer_used_integral - start_integral) / max(now() - start_time, 1e-9)
+
+    def occupancy_info(self) -> dict:
+        """Time-weighted buffer occupancy since the start (or the end of warm-up)."""
+        self._update_buffer_used()
+        duration = max(now() - self._occupancy_start_time, 1e-9)
+        return {
+            'mean_buffer_used': self._buffer_used_integral / duration,
+            'mean_buffer_bytes_used': self._buffer_bytes_integral / duration,
+            'buffer_used_histogram': {
+                str(used): self._occupancy_histogram[used] / duration
+                for used in sorted(self._occupancy_histogram)
+            },
+            'mean_buffer_used_by_class': {
+                label: integral / duration for label, integral in (
+                    self._buffer.class_occupancy_integrals() if self._buffer_has_class_integrals
+                    else self._class_used_integrals).items()
+            },
+        }
+
+    def end_warmup(self):
+        self._update_buffer_used()
+        self._reset_occupancy(now())
+        self._interval_snapshot = self._take_snapshot()
+
+    def end_interval(self):
+        self._intervals.append({
+            'time': now(),
+            'mean_buffer_used': self._mean_buffer_used_since(self._interval_snapshot),
+        })
+        self._interval_snapshot = self._take_snapshot()
+
+    def _schedule_wakeup(self):
+        """Keep exactly one timer for the next time the buffer may send, if it holds packets
+        it may not send yet (e.g. while shaping traffic)."""
+        ready_time = self._buffer.next_ready_time() if self._buffer_has_ready_time else None
+        if self._wakeup != None:
+            if self._wakeup.time == ready_time:
+                return
+            cancel_timer(self._wakeup)
+            self._wakeup = None
+        if ready_time != None:
+            self._wakeup = self._simulator.create_timer(
+                max(0.0, ready_time - now()),
+                Action(self, '_wake_up'),
+                f'wake up {self._label} link when its buffer may send',
+            )
+
+    def _wake_up(self):
+        self._wakeup = None
+        self.transmit_next()
 
     def transmit_next(self):
+        self._update_buffer_used()
         packet = self._buffer.dequeue()
         if packet != None:
+            if self._wakeup != None:
+                cancel_timer(self._wakeup)
+                self._wakeup = None
             self._transmit(packet)
             self._pending_transmit = self._simulator.create_timer(
                 packet.size / self._bandwidth,
-                lambda: self.transmit_next(),
+                Action(self, 'transmit_next'),
                 f'dequeue from buffer on {self._label} link',
             )
         else:
             self._pending_transmit = None
+            self._schedule_wakeup()
 
     def enqueue(self, packet, destination):
         self._total_sent += 1
         self._total_sent_size += packet.size
         packet._hidden_destination = destination
+        self._update_buffer_used()
+        # with --event-trace, the buffer records the packet as enqueued or dropped
         self._buffer.enqueue(packet)
-        try:
-            self._maximum_buffer = max(len(self._buffer), self._maximum_buffer)
-        except TypeError:
-            self._maximum_buffer = -1
+        self._maximum_buffer = max(self._buffer_used(), self._maximum_buffer)
+        if self._buffer_has_bytes:
+            self._maximum_buffer_bytes = max(self._buffer.bytes_in_buffer, self._maximum_buffer_bytes)
         if self._pending_transmit == None:
             self.transmit_next()
 
+    def print_statistics(self):
+        info = self.occupancy_info()
+        print(f"{self._label} link: buffer used: maximum {self._maximum_buffer}, mean {info['mean_buffer_used']:.2f}", end='')
+        if self._buffer_has_classes:
+            print(' (' + ', '.join(f'{label} {used:.2f}' for label, used in info['mean_buffer_used_by_class'].items()) + ')', end='')
+        print()
+
     def json_info(self):
-        return {
+        result = {
             'label': self._label,
             'total_dropped': getattr(self._buffer, '_drop_count', -1),
             'total_sent': self._total_sent,
-            'total_sent_size': self._total_sent,
+            'total_sent_size': self._total_sent_size,
             'buffer_size': getattr(self._buffer, '_capacity', -1),
+            'buffer_bytes': getattr(self._buffer, '_byte_capacity', None),
             'maximum_buffer_used': self._maximum_buffer,
+            'maximum_buffer_bytes_used': self._maximum_buffer_bytes,
+            **self.occupancy_info(),
             'delay': self._delay,
             'delay_variance': self._delay_variance,
             'drop_rate': self._drop,
         }
+        if not self._buffer_has_classes:
+            del result['mean_buffer_used_by_class']
+        if result['buffer_bytes'] == None:
+            del result['buffer_bytes']
+        if not self._buffer_has_bytes:
+            del result['maximum_buffer_bytes_used']
+            del result['mean_buffer_bytes_used']
+        if self._buffer_has_counters:
+            counters = self._buffer.counters()
+            # packets lost in the buffer, whether turned away or pushed out later
+            result['total_dropped'] = counters['dropped'] + counters['evicted']
+            result['buffer_counters'] = counters
+        if len(self._intervals) > 0:
+            result['intervals'] = self._intervals
+        return result
+
+class _QueueLink(Link):
+    """One transmitter of a MultiQueueLink."""
+    def __init__(self, parent, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self._parent = parent
+        self._transmitted_size = 0
+
+    def _transmit(self, packet):
+        self._transmitted_size += packet.size
+        self._parent._record_transmit(packet)
+        super()._transmit(packet)
+
+class MultiQueueLink:
+    """A link with several parallel transmitters, each with its own buffer, like a bonded or
+    multi-queue interface. Each packet is steered to one of them:
+
+    - 'hash': by a hash of its connection label, so a flow stays on one queue (but queues may
+      be unevenly loaded);
+    - 'round-robin': to each queue in turn, regardless of flow;
+    - 'shortest': to the queue with the least queued size (including any packet being sent).
+
+    Besides the usual link statistics, it reports each queue's utilization and how many
+    packets left the link behind a later packet of the same connection (reordering).
+    """
+    STEERING_POLICIES = ('hash', 'round-robin', 'shortest')
+
+    def __init__(self, simulator, buffer_objs, bandwidth, delay, delay_variance, drop, label, steering='hash'):
+        if steering not in self.STEERING_POLICIES:
+            raise ValueError(f'unknown steering policy {steering!r}; expected one of {", ".join(self.STEERING_POLICIES)}')
+        self._simulator = simulator
+        self._label = label
+        self._steering = steering
+        self._queues = [
+            _QueueLink(self, simulator, buffer_obj, bandwidth, delay, delay_variance, drop, f'{label}/{index}')
+            for index, buffer_obj in enumerate(buffer_objs)
+        ]
+        self._next_queue = 0
+        self._total_sent = 0
+        self._total_sent_size = 0
+        self._maximum_buffer = 0
+        # next order number, and the largest one transmitted so far, of each connection
+        self._flow_next = {}
+        self._flow_transmitted = {}
+        self._reordered = 0
+        self._maximum_reorder_distance = 0
+        self._transmitted = 0
+        self._start_time = 0.0
+        self._start_transmitted_sizes = [0] * len(self._queues)
+
+    @property
+    def _drop(self) -> float:
+        return self._queues[0]._drop
+
+    @_drop.setter
+    def _drop(self, drop):
+        for queue in self._queues:
+            queue._drop = drop
+
+    def transmitters(self) -> list[Link]:
+        return list(self._queues)
+
+    def weight(self, label) -> float:
+        return self._queues[0].weight(label)
+
+    def _choose_queue(self, packet) -> Link:
+        if self._steering == 'hash':
+            return self._queues[zlib.crc32(packet.label.encode('UTF-8')) % len(self._queues)]
+        elif self._steering == 'round-robin':
+            queue = self._queues[self._next_queue]
+            self._next_queue = (self._next_queue + 1) % len(self._queues)
+            return queue
+        else:
+            return min(self._queues, key=lambda queue: queue._buffer_bytes() + (queue._pending_transmit != None))
+
+    def enqueue(self, packet, destination):
+        self._total_sent += 1
+        self._total_sent_size += packet.size
+        order = self._flow_next.get(packet.label, 0)
+        self._flow_next[packet.label] = order + 1
+        packet._hidden_flow_order = order
+        self._choose_queue(packet).enqueue(packet, destination)
+        self._maximum_buffer = max(self._maximum_buffer, sum(queue._buffer_used() for queue in self._queues))
+
+    def _record_transmit(self, packet):
+        self._transmitted += 1
+        latest = self._flow_transmitted.get(packet.label, -1)
+        if packet._hidden_flow_order < latest:
+            self._reordered += 1
+            self._maximum_reorder_distance = max(self._maximum_reorder_distance, latest - packet._hidden_flow_order)
+        else:
+            self._flow_transmitted[packet.label] = packet._hidden_flow_order
+
+    def end_warmup(self):
+        for queue in self._queues:
+            queue.end_warmup()
+        self._reordered = 0
+        self._maximum_reorder_distance = 0
+        self._transmitted = 0
+        self._maximum_buffer = sum(queue._buffer_used() for queue in self._queues)
+        self._start_time = now()
+        self._start_transmitted_sizes = [queue._transmitted_size for queue in self._queues]
+
+    def end_interval(self):
+        for queue in self._queues:
+            queue.end_interval()
+
+    def utilizations(self) -> list[float]:
+        """Fraction of the time since the start (or the end of warm-up) each transmitter was busy."""
+        duration = max(now() - self._start_time, 1e-9)
+        return [
+            (queue._transmitted_size - start_size) / queue._bandwidth / duration
+            for queue, start_size in zip(self._queues, self._start_transmitted_sizes)
+        ]
+
+    def _imbalance(self, utilizations) -> float:
+        """Busiest transmitter's utilization over the average (1 if perfectly balanced)."""
+        mean = sum(utilizations) / len(utilizations)
+        return max(utilizations) / mean if mean > 0 else float('nan')
+
+    def print_statistics(self):
+        utilizations = self.utilizations()
+        print(f"{self._label} link: {len(self._queues)} queues ({self._steering}); "
+              f"buffer used: maximum {self._maximum_buffer}, "
+              f"mean {sum(queue.occupancy_info()['mean_buffer_used'] for queue in self._queues):.2f}; "
+              f"utilization imbalance {self._imbalance(utilizations):.2f}; "
+              f"{self._reordered} of {self._transmitted} packets reordered")
+        for queue, utilization in zip(self._queues, utilizations):
+            print(f"  {queue._label}: utilization {utilization:.3f}, ", end='')
+            queue.print_statistics()
+
+    def json_info(self):
+        queue_infos = [queue.json_info() for queue in self._queues]
+        utilizations = self.utilizations()
+        for info, utilization in zip(queue_infos, utilizations):
+            info['utilization'] = utilization
+        return {
+            'label': self._label,
+            'queues': len(self._queues),
+            'steering': self._steering,
+            'total_dropped': sum(info['total_dropped'] for info in queue_infos),
+            'total_sent': self._total_sent,
+            'total_sent_size': self._total_sent_size,
+            'buffer_size': sum(info['buffer_size'] for info in queue_infos),
+            'maximum_buffer_used': self._maximum_buffer,
+            'mean_buffer_used': sum(info['mean_buffer_used'] for info in queue_infos),
+            'utilization_imbalance': self._imbalance(utilizations),
+            'reordered': self._reordered,
+            'reordered_fraction': self._reordered / self._transmitted if self._transmitted > 0 else 0.0,
+            'maximum_reorder_distance': self._maximum_reorder_distance,
+            'delay': queue_infos[0]['delay'],
+            'delay_variance': queue_infos[0]['delay_variance'],
+            'drop_rate': queue_infos[0]['drop_rate'],
+            'by_queue': {str(index): info for index, info in enumerate(queue_infos)},
+        }
 
 class Connection:
     def __init__(self, simulator, label, sender, receiver, forward_link, backward_link, missing_is_error):
@@ -106,55 +483,73 @@ class Connection:
         self._total_received_size = 0
         self._total_received_latency = 0.0
         self._total_received_latency_squared = 0.0
+        self._latencies = []
+        # index of the first latency after warm-up in _latencies
+        self._latencies_start = 0
         self._pending_messages = deque()
         self._in_flight_messages = deque()
         self._corrupt_message_count = 0
         self._skip_message_count = 0
+        # send times of skipped messages by data, in case they arrive later (out of order)
+        self._skipped_messages = {}
+        self._late_message_count = 0
         self._sender = sender
-        self._sender.ready_for_more_from_application = lambda: self.send_pending()
-        self._sender.to_network = lambda packet: self._enqueue_forward(packet)
+        self._sender.ready_for_more_from_application = self.send_pending
+        self._sender.to_network = self._enqueue_forward
         self._sender._label = label
         self._receiver = receiver
-        self._receiver.to_application = lambda m: self.record_received(m)
-        self._receiver.to_network = lambda packet: self._enqueue_backward(packet)
+        self._receiver.to_application = self.record_received
+        self._receiver.to_network = self._enqueue_backward
         self._receiver._label = label
         self._start_time = float('inf')
         self._finish_time = None
         self._forward_link = forward_link
         self._backward_link = backward_link
-        self._generate_rate = 0
+        self._generate_source = None
         self._generate_max = 0
         self._generate_count = 0
+        self._warmup_snapshot = None
+        self._interval_snapshot = None
+        self._intervals = []
 
-    """generate messages at an exponentially distributed rate instead of using pending message logic"""
-    def generate_messages(self, rate, total_messages, mean_size):
+    """generate messages at an exponentially distributed rate instead of using pending message logic;
+    `source` (see sources.py) replaces the exponential arrivals and uniform sizes"""
+    def generate_messages(self, rate, total_messages, mean_size, source=None):
         self._generate_max = total_messages
-        self._generate_rate = rate
-        self._generate_mean_size = mean_size
-        self._generate_next()
+        self._generate_source = source if source != None else sources.PoissonSource(self._label, rate, mean_size)
+        start_delay = self._generate_source.start_delay()
+        if start_delay > 0:
+            create_timer(start_delay, Action(self, '_generate_next'), f'generate first message for {self._label}')
+        else:
+            self._generate_next()
 
     """internal function for generate_messages()"""
     def _generate_next(self)-> None:
-        if self._generate_max == None or self._generate_count < self._generate_max:
+        if self._generate_source != None and (self._generate_max == None or self._generate_count < self._generate_max):
             self._generate_count += 1
             data = f'C{self._label:4s}M{self._generate_count:#08x}'
-            data = data.encode('UTF-8')
             HEADER_SIZE = 8
-            target_length = self._simulator.get_rng().uniform(self._generate_mean_size / 2, self._generate_mean_size * 3 / 2) - HEADER_SIZE
-            while len(data) < target_length:
-                data += b'X'
+            target_length = math.ceil(self._generate_source.size() - HEADER_SIZE)
+            gap = None if self._generate_count == self._generate_max else self._generate_source.gap()
             msg = Message(
-                data=data,
-                is_end=self._generate_count == self._generate_max
+                data=data.encode('UTF-8').ljust(target_length, b'X'),
+                is_end=gap == None
             )
             trace('generate-next', f'data = {msg.data}')
             self.send_messages([msg])
-            if not msg.is_end:
+            if gap != None:
                 create_timer(
-                    self._simulator.get_rng().expovariate(self._generate_rate),
-                    lambda: self._generate_next(),
+                    gap,
+                    Action(self, '_generate_next'),
                     f'generate message for {self._label} (after {self._generate_count})',
                 )
+            else:
+                self._generate_source.close()
+
+    def close_source(self):
+        """Close any file the message source has open (it reopens it if it is used again)."""
+        if self._generate_source != None:
+            self._generate_source.close()
 
     def _enqueue_forward(self, packet: Packet) -> None:
         packet.label = self._label
@@ -183,7 +578,27 @@ class Connection:
             else:
                 break
 
+    def _receive_late(self, actual_message: Message) -> bool:
+        """Account for a message that was skipped earlier because a later one arrived first."""
+        timestamps = self._skipped_messages.get(actual_message.data)
+        if timestamps == None:
+            return False
+        time_delta = now() - timestamps.popleft()
+        if len(timestamps) == 0:
+            del self._skipped_messages[actual_message.data]
+        self._skip_message_count -= 1
+        self._late_message_count += 1
+        self._total_received += 1
+        self._total_received_size += len(actual_message.data) + 8
+        self._total_received_latency += time_delta
+        self._total_received_latency_squared += time_delta * time_delta
+        self._latencies.append(time_delta)
+        trace('link', f'received message #{self._total_received} ({actual_message}) out of order')
+        return True
+
     def record_received(self, actual_message: Message) -> None:
+        if len(self._skipped_messages) > 0 and self._receive_late(actual_message):
+            return
         if len(self._in_flight_messages) == 0:
             self._corrupt_message_count += 1
             error(f'received excess message when none expected')
@@ -195,16 +610,20 @@ class Connection:
         if expect_message == actual_message:
             time_delta = now() - timestamp
         else:
+            skipped = [(timestamp, expect_message)]
             skip = 1
             found = False
             for timestamp, item in self._in_flight_messages:
                 if actual_message == item:
                     found = True
                     break
+                skipped.append((timestamp, item))
                 skip += 1
             if found:
                 for _ in range(skip):
                     self._in_flight_messages.popleft()
+                for skipped_timestamp, item in skipped:
+                    self._skipped_messages.setdefault(item.data, deque()).append(skipped_timestamp)
                 if self._missing_is_error:
                     error(f'missing {skip} messages before received message #{self._total_received}')
                 self._skip_message_count += skip
@@ -217,81 +636,154 @@ class Connection:
         if time_delta != None:
             self._total_received_latency += time_delta
             self._total_received_latency_squared += time_delta * time_delta
+            self._latencies.append(time_delta)
         trace('link', f'received message #{self._total_received} ({actual_message})')
 
-    def _latency_mean_and_variance(self):
-        if self._total_received > 0:
-            latency_mean = self._total_received_latency / self._total_received
-            latency_variance = (self._total_received_latency_squared / self._total_received) - \
-                latency_mean * latency_mean
-        else:
-            latency_mean = float('nan')
-            latency_variance = float('nan')
-        return latency_mean, latency_variance
+    def _take_snapshot(self) -> tuple:
+        return (now(), self._total_received, self._total_received_size,
+                self._total_received_latency, self._total_received_latency_squared)
 
-    def print_statistics(self):
+    def end_warmup(self):
+        """Discard everything received so far from the reported statistics."""
+        self._warmup_snapshot = self._interval_snapshot = self._take_snapshot()
+        self._latencies_start = len(self._latencies)
+
+    def end_interval(self):
+        start_time, received, received_size, latency, _ = self._interval_snapshot
+        end_time, end_received, end_received_size, end_latency, _ = self._interval_snapshot = self._take_snapshot()
+        count = end_received - received
+        self._intervals.append({
+            'time': end_time,
+            'received_rate_packets': count / (end_time - start_time),
+            'received_rate_size': (end_received_size - received_size) / (end_time - start_time),
+            'latency_mean': (end_latency - latency) / count if count > 0 else float('nan'),
+        })
+
+    def _measured(self):
+        """Returns (start time, end time, received, received size, latency sum, latency squared sum)
+        for the measured part of the run (after warm-up, if any)."""
         unfinished = (self._finish_time == None)
         if unfinished:
             end_time = now()
         else:
             end_time = self._finish_time
-        if self._generate_rate:
-            print(f'{self._label}: generated {self._generate_rate:.1f} packets/sec with average size {self._generate_mean_size:.0f}')
-        print(f"{self._label}: received {self._total_received} packets ({self._total_received_size} total size) in {end_time - self._start_time:.1f} ({self._total_received_size / (end_time - self._start_time):.1f} size units/time unit; {self._total_received / (end_time - self._start_time):.1f} messages/time unit)")
-        latency_mean, latency_variance = self._latency_mean_and_variance()
+        _, received, received_size, latency, latency_squared = self._take_snapshot()
+        start_time = self._start_time
+        if self._warmup_snapshot != None:
+            warmup_time, warmup_received, warmup_received_size, warmup_latency, warmup_latency_squared = self._warmup_snapshot
+            start_time = max(start_time, warmup_time)
+            received -= warmup_received
+            received_size -= warmup_received_size
+            latency -= warmup_latency
+            latency_squared -= warmup_latency_squared
+        return start_time, end_time, received, received_size, latency, latency_squared
+
+    def _latency_mean_and_variance(self, received, latency, latency_squared):
+        if received > 0:
+            latency_mean = latency / received
+            latency_variance = max(0.0, (latency_squared / received) - latency_mean * latency_mean)
+        else:
+            latency_mean = float('nan')
+            latency_variance = float('nan')
+        return latency_mean, latency_variance
+
+    def _latency_percentiles(self, *fractions) -> list[float]:
+        """Nearest-rank percentiles of the latencies measured after warm-up."""
+        latencies = sorted(self._latencies[self._latencies_start:])
+        if len(latencies) == 0:
+            return [float('nan')] * len(fractions)
+        return [latencies[max(0, math.ceil(fraction * len(latencies)) - 1)] for fraction in fractions]
+
+    def print_statistics(self):
+        start_time, end_time, received, received_size, latency, latency_squared = self._measured()
+        if self._generate_source != None:
+            print(f'{self._label}: generated {self._generate_source.rate:.1f} packets/sec with average size {self._generate_source.mean_size:.0f}')
+        print(f"{self._label}: received {received} packets ({received_size} total size) in {end_time - start_time:.1f} ({received_size / (end_time - start_time):.1f} size units/time unit; {received / (end_time - start_time):.1f} messages/time unit)")
+        latency_mean, latency_variance = self._latency_mean_and_variance(received, latency, latency_squared)
+        latency_p50, latency_p99 = self._latency_percentiles(0.5, 0.99)
         print(f"{self._label}: latency: mean {latency_mean:.2f} "
-              f" +/- sd {math.sqrt(latency_variance):.2f}")
+              f" +/- sd {math.sqrt(latency_variance):.2f}; median {latency_p50:.2f}, 99th percentile {latency_p99:.2f}")
         if len(self._in_flight_messages) > 0 or self._skip_message_count > 0 or \
-                self._corrupt_message_count > 0:
-            print(f"{self._label}: {self._skip_message_count} messages skipped, {len(self._in_flight_messages)} not received at end, {self._corrupt_message_count} corrupt or received out-of-order")
+                self._corrupt_message_count > 0 or self._late_message_count > 0:
+            print(f"{self._label}: {self._skip_message_count} messages skipped, {len(self._in_flight_messages)} not received at end, {self._corrupt_message_count} corrupt or received out-of-order"
+                  + (f", {self._late_message_count} received late after later messages" if self._late_message_count > 0 else ''))
 
     def json_info(self):
-        unfinished = (self._finish_time == None)
-        if unfinished:
-            end_time = now()
-        else:
-            end_time = self._finish_time
-        latency_mean, latency_variance = self._latency_mean_and_variance()
-        return {
-            'generate_rate': self._generate_rate,
-            'generate_mean_size': self._generate_mean_size,
-            'received': self._total_received,
-            'time': end_time - self._start_time,
-            'received_rate_packets': self._total_received / (end_time - self._start_time),
-            'received_rate_size': self._total_received_size / (end_time - self._start_time),
+        start_time, end_time, received, received_size, latency, latency_squared = self._measured()
+        latency_mean, latency_variance = self._latency_mean_and_variance(received, latency, latency_squared)
+        latency_p50, latency_p99 = self._latency_percentiles(0.5, 0.99)
+        result = {
+            'generate_rate': self._generate_source.rate if self._generate_source != None else 0,
+            'generate_mean_size': self._generate_source.mean_size if self._generate_source != None else float('nan'),
+            'received': received,
+            'time': end_time - start_time,
+            'received_rate_packets': received / (end_time - start_time),
+            'received_rate_size': received_size / (end_time - start_time),
             'skipped': self._skip_message_count,
+            'out_of_order': self._late_message_count,
             'corrupt': self._corrupt_message_count,
             'in_flight': len(self._in_flight_messages),
             'latency_mean': latency_mean,
             'latency_sd': math.sqrt(latency_variance),
+            'latency_p50': latency_p50,
+            'latency_p99': latency_p99,
         }
+        if len(self._intervals) > 0:
+            result['intervals'] = self._intervals
+        return result
 
 class Simulator:
     def __init__(self, args):
         self._args = args
-        self._rng = random.Random(42)
+        self._rng = random.Random(args.seed)
         self._event_list = []
+        # Events for the current time, in index order; all have larger indices than any
+        # event for the current time in _event_list, so they can bypass the heap.
+        self._now_events = deque()
         self._connections = {}
         self._links = {}
         self._next_index = 0
         self._time = 0.0
         self._in_run_event = False
+        self.event_trace = new_event_trace_recorder()
         self.done = False
+        self._measure_interval = None
+        self._steady_state_tolerance = None
+        self._steady_state_intervals = 0
+        self._steady_state_time = None
+        self._fairness_intervals = []
+        self._profile = None
+        self._profile_nested_time = 0.0
 
     def get_rng(self):
         return self._rng
 
+    def new_rng(self, name: str) -> random.Random:
+        """Create the random number generator for the stream called `name` (like 'link/forward/drop').
+
+        Its seed depends only on the --seed setting and `name`, so two runs with the same seed
+        use the same random numbers for each stream (common random numbers), even if they
+        differ in how many links or connections there are or how many draws other streams make.
+        """
+        digest = hashlib.sha256(f'{self._args.seed}/{name}'.encode('UTF-8')).digest()
+        return random.Random(int.from_bytes(digest[:8], 'little'))
+
     def time(self) -> float:
         return self._time
 
     def add_event(self, event: Event) -> None:
         event.index = self._next_index
         self._next_index += 1
-        heappush(self._event_list, event)
+        if event.time == self._time:
+            self._now_events.append(event)
+        else:
+            heappush(self._event_list, event)
 
     def _pop_event(self) -> Optional[Event]:
-        if len(self._event_list) > 0:
+        if len(self._event_list) > 0 and (len(self._now_events) == 0 or self._event_list[0].time <= self._time):
             return heappop(self._event_list)
+        elif len(self._now_events) > 0:
+            return self._now_events.popleft()
         else:
             return None
  
@@ -305,9 +797,27 @@ class Simulator:
         if label in config.TRACE or 'all' in config.TRACE:
             print(f"at time={self._time:9.1f}: [{label}] {description}")
 
-    def new_link(self, label, bandwidth, buffer_size, delay, delay_variance, drop, buffer_cls=DropTailBuffer):
-        buffer_obj = buffer_cls(buffer_size, bandwidth, label)
-        link = self._links[link._label] = Link(
+    def new_link(self, label, bandwidth, buffer_size, delay, delay_variance, drop, buffer_cls=DropTailBuffer,
+                 buffer_options=None, queues=1, steering='hash', queue_bandwidth=None):
+        """Create a link. With queues > 1, it is a MultiQueueLink with that many transmitters
+        of queue_bandwidth (default: bandwidth / queues) each, and each its own buffer."""
+        if queues > 1:
+            if queue_bandwidth == None:
+                queue_bandwidth = bandwidth / queues
+            link = self._links[label] = MultiQueueLink(
+                simulator=self,
+                buffer_objs=[buffer_cls(buffer_size, queue_bandwidth, f'{label}/{index}', **(buffer_options or {}))
+                             for index in range(queues)],
+                bandwidth=queue_bandwidth,
+                delay=delay,
+                delay_variance=delay_variance,
+                drop=drop,
+                label=label,
+                steering=steering,
+            )
+            return link
+        buffer_obj = buffer_cls(buffer_size, bandwidth, label, **(buffer_options or {}))
+        link = self._links[label] = Link(
             simulator=self,
             bandwidth=bandwidth,
             buffer_obj=buffer_obj,
@@ -333,6 +843,124 @@ class Simulator:
         result._generate_next()
         return result
 
+    def set_measurement(self, warmup=0.0, interval=None, steady_state_tolerance=None, steady_state_intervals=5):
+        """Exclude the first `warmup` time units from connection and link statistics, and
+        optionally also record statistics for each `interval` time units after that.
+
+        If `steady_state_tolerance` is set, the simulation stops once the received rate of every
+        connection has varied by at most that fraction of its mean over the last
+        `steady_state_intervals` intervals.
+        """
+        if interval != None and interval <= 0:
+            raise ValueError(f'measurement interval must be positive, not {interval}')
+        self._measure_interval = interval
+        self._steady_state_tolerance = steady_state_tolerance
+        self._steady_state_intervals = steady_state_intervals
+        if warmup > 0.0 or interval != None:
+            self.create_timer(max(warmup - self._time, 0.0), Action(self, '_end_warmup'), 'end of warm-up')
+
+    def _end_warmup(self):
+        trace('measure', 'end of warm-up')
+        for item in list(self._links.values()) + list(self._connections.values()):
+            item.end_warmup()
+        if self._measure_interval != None:
+            self.create_timer(self._measure_interval, Action(self, '_end_interval'), 'end of measurement interval')
+
+    def _end_interval(self):
+        for item in list(self._links.values()) + list(self._connections.values()):
+            item.end_interval()
+        self._fairness_intervals.append({
+            'time': self._time,
+            **fairness({label: connection._intervals[-1]['received_rate_size']
+                        for label, connection in self._connections.items()}, self._weights()),
+        })
+        if self._steady_state_tolerance != None and self._is_steady_state():
+            trace('measure', 'reached steady state')
+            self._steady_state_time = self._time
+            self.done = True
+            return
+        self.create_timer(self._measure_interval, Action(self, '_end_interval'), 'end of measurement interval')
+
+    def _is_steady_state(self) -> bool:
+        for connection in self._connections.values():
+            if len(connection._intervals) < self._steady_state_intervals:
+                return False
+            rates = [item['received_rate_size'] for item in connection._intervals[-self._steady_state_intervals:]]
+            mean_rate = sum(rates) / len(rates)
+            if mean_rate == 0.0 or (max(rates) - min(rates)) / mean_rate > self._steady_state_tolerance:
+                return False
+        return True
+
+    def _weights(self) -> dict[str, float]:
+        return {label: connection._forward_link.weight(label) for label, connection in self._connections.items()}
+
+    def fairness_info(self) -> dict:
+        """How the connections' received rates (after warm-up) compare to the weights their forward
+        link's buffer gives them (see util.fairness()), overall and for each measurement interval."""
+        rates = {}
+        for label, connection in self._connections.items():
+            start_time, end_time, _, received_size, _, _ = connection._measured()
+            rates[label] = received_size / (end_time - start_time)
+        weights = self._weights()
+        result = {'weights': weights, **fairness(rates, weights)}
+        if len(self._fairness_intervals) > 0:
+            result['intervals'] = self._fairness_intervals
+        return result
+
+    def print_fairness(self):
+        info = self.fairness_info()
+        shares = ', '.join(
+            f'{label} {share:.1%} ({info["weight_ratios"][label]:.2f} of its weighted share)'
+            for label, share in info['shares'].items())
+        print(f'fairness: {shares}; Jain\'s index {info["jain_index"]:.4f}')
+
+    def enable_profiling(self):
+        """Measure the wall-clock time spent on each kind of event (see event_kind()), on each
+        link's buffer operations, and on trace output, for profile_summary().
+
+        Time spent in buffer operations and trace output is not counted toward the event that
+        caused it.
+        """
+        self._profile = {}
+        self.trace = self._profiled_trace
+        for link in self._links.values():
+            for transmitter in link.transmitters():
+                transmitter._buffer = _ProfiledBuffer(self, transmitter._buffer, transmitter._label)
+
+    def _profiled_call(self, kind, component, function, *args):
+        nested_before = self._profile_nested_time
+        start = time.perf_counter()
+        try:
+            return function(*args)
+        finally:
+            total = time.perf_counter() - start
+            own = total - (self._profile_nested_time - nested_before)
+            self._profile_nested_time = nested_before + total
+            entry = self._profile.get((kind, component))
+            if entry == None:
+                entry = self._profile[kind, component] = [0, 0.0]
+            entry[0] += 1
+            entry[1] += own
+
+    def _profiled_trace(self, label, description):
+        self._profiled_call('trace', label, Simulator.trace, self, label, description)
+
+    def profile_summary(self) -> list[dict]:
+        """The measurements from enable_profiling(), most expensive first."""
+        total = sum(seconds for _, seconds in self._profile.values()) or 1.0
+        return [
+            {'kind': kind, 'component': component, 'count': count, 'seconds': seconds,
+             'share': seconds / total, 'microseconds_each': seconds / count * 1e6}
+            for (kind, component), (count, seconds)
+            in sorted(self._profile.items(), key=lambda item: -item[1][1])
+        ]
+
+    def print_profile_summary(self, file=sys.stdout):
+        print(f'{"event kind":36s} {"component":16s} {"count":>9s} {"seconds":>9s} {"share":>6s} {"us each":>8s}', file=file)
+        for row in self.profile_summary():
+            print(f"{row['kind']:36s} {row['component']:16s} {row['count']:9d} {row['seconds']:9.3f} "
+                  f"{row['share']:6.1%} {row['microseconds_each']:8.2f}", file=file)
+
     def _run_next(self) -> bool:
         assert not self._in_run_event
         event = self._pop_event()
@@ -341,17 +969,49 @@ class Simulator:
             if not event.canceled:
                 self._in_run_event = True
                 trace('events', f"running {event.description}")
-                event.action()
+                if self._profile != None:
+                    kind, component = event_kind(event.action)
+                    self._profiled_call(kind, component, event.action)
+                else:
+                    event.action()
                 self._in_run_event = False
             return True
         else:
             return False
 
-    def run(self, time_limit=None):
+    def run(self, time_limit=None, profiler=None):
+        """Run events until done or past time_limit; if profiler (like a cProfile.Profile) is
+        given, it is enabled only while running events."""
         assert util._simulator == self
-        while not self.done and self._run_next():
-            if time_limit != None and self._time > time_limit:
-                self.done = True
+        if profiler != None:
+            profiler.enable()
+        try:
+            while not self.done and self._run_next():
+                if time_limit != None and self._time > time_limit:
+                    self.done = True
+        finally:
+            if profiler != None:
+                profiler.disable()
+        for connection in self._connections.values():
+            connection.close_source()
+        if self.event_trace != None:
+            self.event_trace.close()
+
+    def checkpoint(self) -> bytes:
+        """Serialize the whole simulation (pending events, links and their buffers, connections,
+        senders and receivers, and RNG state), so it can be continued later with restore()."""
+        assert not self._in_run_event
+        try:
+            return pickle.dumps(self)
+        except (pickle.PicklingError, AttributeError, TypeError) as e:
+            raise Exception(f'cannot checkpoint simulation (timer actions must be Actions, not lambdas): {e}')
+
+    @staticmethod
+    def restore(data: bytes) -> 'Simulator':
+        """Recreate a simulation saved with checkpoint() and make it the active simulator."""
+        simulator = util._simulator = pickle.loads(data)
+        simulator.done = False
+        return simulator
 
     def _finish_send_back(self, to, destination, packet):
         destination.from_network(packet)
@@ -0,0 +1,203 @@
+"""Message sources: the sizes and arrival times of the messages a Connection generates.
+
+A source's size() gives the size of the message to generate now, and gap() the time until the
+next one, or None if there are no more, and close() releases any file the source has open.
+Sources only hold Random objects and a little state (a trace source reopens its file where it
+left off when it next needs a record), so they can be checkpointed with the rest of the
+simulation.
+"""
+
+import argparse
+import csv
+import os
+import struct
+
+import util
+
+"""Magic number at the start of binary message trace files."""
+TRACE_MAGIC = b'MTR1'
+
+"""One record of a binary message trace: arrival time, message size (little-endian doubles)."""
+TRACE_RECORD = struct.Struct('<dd')
+
+class PoissonSource:
+    """Poisson arrivals at `rate`, with sizes uniform over [mean_size / 2, 3 * mean_size / 2]."""
+    def __init__(self, label, rate, mean_size):
+        self.rate = rate
+        self.mean_size = mean_size
+        self._size_rng = util._simulator.new_rng(f'connection/{label}/size')
+        self._arrival_rng = util._simulator.new_rng(f'connection/{label}/arrival')
+
+    def start_delay(self) -> float:
+        return 0.0
+
+    def size(self) -> float:
+        return self._size_rng.uniform(self.mean_size / 2, self.mean_size * 3 / 2)
+
+    def gap(self) -> float | None:
+        return self._arrival_rng.expovariate(self.rate)
+
+    def close(self):
+        pass
+
+class ParetoSource(PoissonSource):
+    """Poisson arrivals at `rate`, with heavy-tailed Pareto sizes of the given `shape` and mean
+    `mean_size` (the variance is infinite for shapes of at most 2; the shape must exceed 1)."""
+    def __init__(self, label, rate, mean_size, shape=1.5):
+        super().__init__(label, rate, mean_size)
+        if shape <= 1:
+            raise ValueError(f'Pareto shape must be greater than 1 for a finite mean, not {shape}')
+        self._shape = shape
+        self._minimum_size = mean_size * (shape - 1) / shape
+
+    def size(self) -> float:
+        return self._minimum_size * self._size_rng.paretovariate(self._shape)
+
+class OnOffSource(PoissonSource):
+    """Bursty arrivals: exponentially distributed on and off periods with means `on_time` and
+    `off_time`, and Poisson arrivals during on periods at the rate that makes the long-run
+    average `rate`. Sizes are uniform like PoissonSource's."""
+    def __init__(self, label, rate, mean_size, on_time=1.0, off_time=1.0):
+        super().__init__(label, rate, mean_size)
+        self._on_time = on_time
+        self._off_time = off_time
+        self._peak_rate = rate * (on_time + off_time) / on_time
+        self._period_rng = util._simulator.new_rng(f'connection/{label}/period')
+        self._on_remaining = self._period_rng.expovariate(1 / on_time)
+
+    def gap(self) -> float | None:
+        # Arrivals are memoryless, so one that would fall after the on period ends is redrawn
+        # from the start of the next on period.
+        result = 0.0
+        while True:
+            arrival = self._arrival_rng.expovariate(self._peak_rate)
+            if arrival < self._on_remaining:
+                self._on_remaining -= arrival
+                return result + arrival
+            result += self._on_remaining + self._period_rng.expovariate(1 / self._off_time)
+            self._on_remaining = self._period_rng.expovariate(1 / self._on_time)
+
+class TraceSource:
+    """Replays the (arrival time, size) records of a trace file, in nondecreasing time order.
+
+    The file is either CSV, one 'time,size' line per message (a first line that is not numeric
+    is taken as a header), or binary (see write_binary_trace()). Records are read one at a time
+    as messages are generated, so memory use does not depend on the length of the trace.
+    rate and mean_size are those of the messages generated so far.
+    """
+    def __init__(self, path):
+        self._path = path
+        with open(path, 'rb') as f:
+            self._binary = f.read(len(TRACE_MAGIC)) == TRACE_MAGIC
+        # generator of the records after the first _read_count, while the file is open
+        self._records = None
+        self._read_count = 0
+        self._next = None
+        self._time = 0.0
+        self._count = 0
+        self._total_size = 0.0
+        self._next = self._read()
+        if self._next == None:
+            raise ValueError(f'{path} has no message records')
+
+    def _read(self) -> tuple[float, float] | None:
+        if self._records == None:
+            if self._binary:
+                self._records = _read_binary_records(self._path, skip=self._read_count)
+            else:
+                self._records = _read_csv_records(self._path)
+                for _ in range(self._read_count):
+                    next(self._records)
+        record = next(self._records, None)
+        if record == None:
+            self.close()
+        else:
+            self._read_count += 1
+        return record
+
+    def close(self):
+        """Close the trace file; it is reopened where reading left off if more records are needed."""
+        if self._records != None:
+            self._records.close()
+            self._records = None
+
+    def __getstate__(self):
+        state = dict(self.__dict__)
+        state['_records'] = None
+        return state
+
+    @property
+    def rate(self) -> float:
+        return self._count / self._time if self._time > 0 else float('nan')
+
+    @property
+    def mean_size(self) -> float:
+        return self._total_size / self._count if self._count > 0 else float('nan')
+
+    def start_delay(self) -> float:
+        return max(self._next[0], 0.0)
+
+    def size(self) -> float:
+        self._time, size = self._next
+        self._count += 1
+        self._total_size += size
+        self._next = self._read()
+        return size
+
+    def gap(self) -> float | None:
+        if self._next == None:
+            return None
+        if self._next[0] < self._time:
+            raise ValueError(f'{self._path}: arrival time {self._next[0]} is before the previous one ({self._time})')
+        return self._next[0] - self._time
+
+SOURCES = {
+    'poisson': PoissonSource,
+    'pareto': ParetoSource,
+    'on-off': OnOffSource,
+}
+
+def new_source(kind, label, rate, mean_size, trace_path=None, **options):
+    """Create the source for connection `label`: a TraceSource if `trace_path` is set, otherwise
+    the generator called `kind` (see SOURCES), passing it the `options` it takes."""
+    if trace_path:
+        return TraceSource(trace_path)
+    if kind not in SOURCES:
+        raise ValueError(f'unknown message source {kind!r}; expected one of {", ".join(SOURCES)}')
+    if kind == 'pareto':
+        return ParetoSource(label, rate, mean_size, shape=options['shape'])
+    if kind == 'on-off':
+        return OnOffSource(label, rate, mean_size, on_time=options['on_time'], off_time=options['off_time'])
+    return PoissonSource(label, rate, mean_size)
+
+def write_binary_trace(path, records):
+    """Write (time, size) records as a binary trace file for TraceSource."""
+    with open(path, 'wb') as f:
+        f.write(TRACE_MAGIC)
+        for time, size in records:
+            f.write(TRACE_RECORD.pack(time, size))
+
+def _read_binary_records(path, skip=0):
+    with open(path, 'rb') as f:
+        f.seek(len(TRACE_MAGIC) + skip * TRACE_RECORD.size)
+        while len(data := f.read(TRACE_RECORD.size)) == TRACE_RECORD.size:
+            yield TRACE_RECORD.unpack(data)
+
+def _read_csv_records(path):
+    with open(path, newline='') as f:
+        for line_number, row in enumerate(csv.reader(f), start=1):
+            if len(row) == 0:
+                continue
+            try:
+                yield float(row[0]), float(row[1])
+            except (ValueError, IndexError):
+                if line_number != 1:
+                    raise ValueError(f'{path}:{line_number}: expected "time,size", got {row!r}')
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Convert a CSV message trace (time,size lines) to the binary format.')
+    parser.add_argument('csv', help='CSV trace to read')
+    parser.add_argument('binary', help='binary trace to write')
+    args = parser.parse_args()
+    write_binary_trace(args.binary, _read_csv_records(args.csv))
+    print(f'wrote {os.path.getsize(args.binary)} bytes to {args.binary}')
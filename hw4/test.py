@@ -0,0 +1,383 @@
+import argparse
+import json
+import math
+import os
+import pickle
+import random
+import re
+import sys
+import tempfile
+
+import config
+import util
+
+from simulator import Simulator
+from buffer import CoDelBuffer, DeficitRoundRobinBuffer, HTBBuffer, REDBuffer, WeightedFairQueuingBuffer
+from event_trace import read_event_trace
+from fluid import FluidSimulator
+from sources import TraceSource, write_binary_trace
+from util import Packet, fairness, jain_index
+
+def new_simulator():
+    config.TRACE = set()
+    util._simulator = Simulator(argparse.Namespace(seed=42))
+    return util._simulator
+
+def make_packet(label, size):
+    return Packet(data=bytes(size - 8), label=label)
+
+def enqueue_all(buffer_obj, packets):
+    for label, size in packets:
+        buffer_obj.enqueue(make_packet(label, size))
+
+def counts(buffer_obj, label) -> dict[str, int]:
+    return buffer_obj.counters()['by_class'].get(label, {'enqueued': 0, 'dropped': 0, 'evicted': 0})
+
+def send_until(simulator, buffer_obj, until) -> dict[str, int]:
+    """Dequeue from a shaping buffer whenever it allows, like a link of unlimited bandwidth,
+    until time `until`; returns the total size sent per label."""
+    sent = {}
+    while True:
+        ready = buffer_obj.next_ready_time()
+        if ready == None or ready > until:
+            return sent
+        simulator._time = max(simulator._time, ready)
+        packet = buffer_obj.dequeue()
+        if packet != None:
+            sent[packet.label] = sent.get(packet.label, 0) + packet.size
+
+def test_wfq_byte_capacity_no_wasted_evictions():
+    """A packet that cannot fit even after every eligible eviction is dropped without evicting anything."""
+    new_simulator()
+    buffer_obj = WeightedFairQueuingBuffer(100, 1000, 'test', byte_capacity=300)
+    enqueue_all(buffer_obj, [('c2', 100), ('c1', 50), ('c2', 100), ('c1', 50)])
+    buffer_obj.enqueue(make_packet('c1', 250))
+    assert counts(buffer_obj, 'c2')['evicted'] == 0, buffer_obj.counters()
+    assert counts(buffer_obj, 'c1')['dropped'] == 1, buffer_obj.counters()
+    assert buffer_obj.bytes_in_buffer == 300 and len(buffer_obj) == 4
+
+def test_wfq_byte_capacity_evicts_when_enough():
+    new_simulator()
+    buffer_obj = WeightedFairQueuingBuffer(100, 1000, 'test', byte_capacity=300)
+    enqueue_all(buffer_obj, [('c2', 100), ('c2', 100), ('c2', 100)])
+    buffer_obj.enqueue(make_packet('c1', 150))
+    assert counts(buffer_obj, 'c2')['evicted'] == 2, buffer_obj.counters()
+    assert counts(buffer_obj, 'c1') == {'enqueued': 1, 'dropped': 0, 'evicted': 0}, buffer_obj.counters()
+    assert buffer_obj.bytes_in_buffer == 250
+
+def test_wfq_byte_capacity_puts_back():
+    """Packets taken off to make room for an arrival that still does not fit are put back in place."""
+    packets = [('c2', 100), ('c1', 50), ('c2', 100), ('c1', 50), ('c3', 40)]
+    sent = []
+    for arrival in (None, ('c1', 200)):
+        new_simulator()
+        buffer_obj = WeightedFairQueuingBuffer(100, 1000, 'test', byte_capacity=340)
+        enqueue_all(buffer_obj, packets)
+        if arrival != None:
+            # c2's last packet would finish after it, but is not enough room on its own
+            enqueue_all(buffer_obj, [arrival])
+            assert buffer_obj.counters()['evicted'] == 0, buffer_obj.counters()
+            assert counts(buffer_obj, 'c1')['dropped'] == 1, buffer_obj.counters()
+        enqueue_all(buffer_obj, [('c3', 40)])
+        order = []
+        while len(buffer_obj) > 0:
+            packet = buffer_obj.dequeue()
+            order.append((packet.label, packet.size))
+        sent.append(order)
+    assert sent[0] == sent[1], sent
+
+def test_wfq_weighted_shares():
+    """Backlogged classes are sent bytes in proportion to their weights."""
+    new_simulator()
+    weights = {'c1': 1, 'c2': 2, 'c3': 3}
+    buffer_obj = WeightedFairQueuingBuffer(10000, 1000, 'test', weights=weights)
+    rng = random.Random(1)
+    for _ in range(300):
+        enqueue_all(buffer_obj, [(label, rng.randrange(48, 208)) for label in weights])
+    sent = dict.fromkeys(weights, 0)
+    for _ in range(300):
+        packet = buffer_obj.dequeue()
+        sent[packet.label] += packet.size
+    for label, weight in weights.items():
+        share = sent[label] / sum(sent.values())
+        assert abs(share - weight / 6) < 0.01, sent
+
+def test_wfq_late_class_does_not_jump_ahead():
+    """A class that becomes backlogged after another has been sending alone shares the link
+    from then on, instead of catching up on the service it missed."""
+    new_simulator()
+    buffer_obj = WeightedFairQueuingBuffer(10000, 1000, 'test', weights={'c1': 1, 'c2': 1})
+    enqueue_all(buffer_obj, [('c1', 100)] * 100)
+    for _ in range(50):
+        buffer_obj.dequeue()
+    enqueue_all(buffer_obj, [('c2', 100)] * 20)
+    labels = ''.join(buffer_obj.dequeue().label for _ in range(30))
+    assert 'c2c2' not in labels and 'c1c1' not in labels, labels
+
+def test_drr_weighted_shares():
+    """Backlogged classes are sent bytes in proportion to their weights, even when their packets
+    are larger than their quantum, since unused credit carries over to the next round."""
+    new_simulator()
+    buffer_obj = DeficitRoundRobinBuffer(100000, 1000, 'test', weights={'c1': 1, 'c2': 3}, quantum=200)
+    enqueue_all(buffer_obj, ([('c1', 500)] + [('c2', 100)] * 5) * 1000)
+    sent = {'c1': 0, 'c2': 0}
+    for _ in range(1000):
+        packet = buffer_obj.dequeue()
+        sent[packet.label] += packet.size
+    assert abs(sent['c2'] / sent['c1'] - 3) < 0.1, sent
+
+def test_drr_byte_capacity_no_wasted_evictions():
+    new_simulator()
+    buffer_obj = DeficitRoundRobinBuffer(100, 1000, 'test', byte_capacity=300)
+    enqueue_all(buffer_obj, [('c2', 60), ('c2', 60), ('c2', 60), ('c1', 60)])
+    buffer_obj.enqueue(make_packet('c1', 200))
+    assert counts(buffer_obj, 'c2')['evicted'] == 0, buffer_obj.counters()
+    assert counts(buffer_obj, 'c1')['dropped'] == 1, buffer_obj.counters()
+    assert buffer_obj.bytes_in_buffer == 240
+
+def test_oversized_packet_dropped():
+    for buffer_cls in (WeightedFairQueuingBuffer, DeficitRoundRobinBuffer):
+        new_simulator()
+        buffer_obj = buffer_cls(100, 1000, 'test', byte_capacity=300)
+        enqueue_all(buffer_obj, [('c2', 100), ('c2', 100)])
+        buffer_obj.enqueue(make_packet('c1', 301))
+        assert buffer_obj.counters()['evicted'] == 0, (buffer_cls.__name__, buffer_obj.counters())
+        assert counts(buffer_obj, 'c1')['dropped'] == 1, (buffer_cls.__name__, buffer_obj.counters())
+
+def test_htb_ceil_limits_rate():
+    """A class alone on the link borrows up to its ceil and no further."""
+    simulator = new_simulator()
+    buffer_obj = HTBBuffer(10000, 1000, 'test', classes={'c1': {'parent': 'root', 'rate': 100, 'ceil': 200}}, burst=500)
+    enqueue_all(buffer_obj, [('c1', 100)] * 1000)
+    sent = send_until(simulator, buffer_obj, 100.0)
+    # ceil times elapsed time, plus the initial burst and the packet that overdraws it
+    assert 200 * 100 <= sent['c1'] <= 200 * 100 + 500 + 100, sent
+
+def test_htb_borrowing_follows_rates():
+    """Backlogged siblings split the bandwidth they borrow in proportion to their rates."""
+    simulator = new_simulator()
+    classes = {
+        'c1': {'parent': 'root', 'rate': 100, 'ceil': 1000},
+        'c2': {'parent': 'root', 'rate': 300, 'ceil': 1000},
+    }
+    buffer_obj = HTBBuffer(10000, 1000, 'test', classes=classes)
+    enqueue_all(buffer_obj, [('c1', 100), ('c2', 100)] * 2000)
+    sent = send_until(simulator, buffer_obj, 100.0)
+    assert abs(sent['c2'] / sent['c1'] - 3) < 0.1, sent
+    assert sum(sent.values()) <= 1000 * 100 + 2 * 500 + 100, sent
+
+def test_htb_next_ready_time():
+    """Once a class has used up its tokens, next_ready_time() is when it will have them again."""
+    simulator = new_simulator()
+    buffer_obj = HTBBuffer(100, 1000, 'test', classes={'c1': {'parent': 'root', 'rate': 100}}, burst=500)
+    enqueue_all(buffer_obj, [('c1', 100)] * 10)
+    sent = 0
+    while buffer_obj.dequeue() != None:
+        sent += 1
+    # the burst, then one packet that overdraws the tokens to -100
+    assert sent == 6, sent
+    ready = buffer_obj.next_ready_time()
+    assert ready == 1.0, ready
+    simulator._time = ready
+    assert buffer_obj.dequeue() != None
+
+def test_htb_class_errors():
+    new_simulator()
+    for classes in (
+        {'c1': {'parent': 'missing', 'rate': 100}},
+        {'a': {'parent': 'b', 'rate': 100}, 'b': {'parent': 'a', 'rate': 100}},
+    ):
+        try:
+            HTBBuffer(100, 1000, 'test', classes=classes)
+        except ValueError:
+            continue
+        assert False, f'no ValueError for {classes}'
+
+class Sink:
+    """Stands in for a connection's receiver, keeping the packets a link delivers to it."""
+    def __init__(self):
+        self.received = []
+
+    def from_network(self, packet):
+        self.received.append(packet)
+
+def test_multi_queue_steering_and_reordering():
+    """Hash steering keeps each connection on one queue, so nothing is reordered; round robin
+    alternates queues, so a small packet overtakes a large one sent before it on the other."""
+    # crc32 sends c1 to queue 1 and c4 to queue 0
+    packets = [('c1', 1000), ('c1', 100), ('c1', 1000), ('c1', 100), ('c4', 100), ('c4', 100)]
+    results = {}
+    for steering in ('hash', 'round-robin'):
+        simulator = new_simulator()
+        link = simulator.new_link('forward', 2000, 100, 1.0, 0.0, 0.0, queues=2, steering=steering)
+        sink = Sink()
+        for label, size in packets:
+            link.enqueue(make_packet(label, size), sink)
+        simulator.run()
+        assert len(sink.received) == len(packets), (steering, sink.received)
+        info = link.json_info()
+        results[steering] = ([queue['total_sent'] for queue in info['by_queue'].values()],
+                             info['reordered'], info['maximum_reorder_distance'])
+    assert results['hash'] == ([2, 4], 0, 0), results
+    # c1's third packet starts after its fourth, and c4's first after its second
+    assert results['round-robin'] == ([3, 3], 2, 1), results
+
+def test_fairness_indices():
+    assert jain_index([5, 5, 5, 5]) == 1.0
+    assert jain_index([8, 0, 0, 0]) == 0.25
+    assert math.isnan(jain_index([0, 0]))
+    result = fairness({'c1': 200, 'c2': 100}, {'c1': 2, 'c2': 1})
+    assert all(math.isclose(ratio, 1.0) for ratio in result['weight_ratios'].values()), result
+    assert math.isclose(result['jain_index'], 1.0), result
+    # Equal rates with weights 2:1: c1 got 3/4 of its weighted share and c2 3/2 of its
+    result = fairness({'c1': 100, 'c2': 100}, {'c1': 2, 'c2': 1})
+    assert result['shares'] == {'c1': 0.5, 'c2': 0.5}, result
+    assert math.isclose(result['weight_ratios']['c1'], 0.75) and math.isclose(result['weight_ratios']['c2'], 1.5), result
+    assert math.isclose(result['jain_index'], 0.9), result
+
+def test_red_idle_decay_once():
+    """Arrivals to an empty RED queue that are dropped do not decay the average again for the same idle time."""
+    simulator = new_simulator()
+    buffer_obj = REDBuffer(100, 1000, 'test', min_threshold=5, max_threshold=15, queue_weight=0.1)
+    buffer_obj.enqueue(make_packet('c1', 100))
+    buffer_obj.dequeue()
+    buffer_obj._average = 100.0
+    simulator._time = 1.0
+    buffer_obj.enqueue(make_packet('c1', 100))
+    decayed = buffer_obj._average
+    assert 15 <= decayed < 100, decayed
+    for _ in range(3):
+        buffer_obj.enqueue(make_packet('c1', 100))
+        assert buffer_obj._average == decayed, (buffer_obj._average, decayed)
+    assert counts(buffer_obj, 'c1')['dropped'] == 4, buffer_obj.counters()
+
+def test_trace_source_close_and_resume():
+    """A trace source closes its file when asked or when it runs out, and picks up where it left off."""
+    new_simulator()
+    records = [(float(i), 100.0 + i) for i in range(5)]
+    with tempfile.TemporaryDirectory() as directory:
+        csv_path = os.path.join(directory, 'trace.csv')
+        with open(csv_path, 'w') as f:
+            f.write('time,size\n' + ''.join(f'{time},{size}\n' for time, size in records))
+        binary_path = os.path.join(directory, 'trace.bin')
+        write_binary_trace(binary_path, records)
+        for path in (csv_path, binary_path):
+            source = TraceSource(path)
+            sizes = [source.size(), source.size()]
+            source.close()
+            assert source._records == None, path
+            sizes.append(source.size())
+            source = pickle.loads(pickle.dumps(source))
+            sizes.append(source.size())
+            assert source.gap() == 1.0, path
+            sizes.append(source.size())
+            assert source.gap() == None and source._records == None, path
+            assert sizes == [size for _, size in records], (path, sizes)
+
+def test_codel_control_law():
+    """CoDel starts dropping once packets have waited over target for interval, then drops
+    at intervals shrinking with the square root of the number of drops, and stops once a
+    packet waits less than target."""
+    simulator = new_simulator()
+    buffer_obj = CoDelBuffer(1000, 1000, 'test', target=0.5, interval=5.0)
+    enqueue_all(buffer_obj, [('c1', 100)] * 100)
+    drop_times = []
+    for time in range(25):
+        simulator._time = float(time)
+        evicted = buffer_obj.counters()['evicted']
+        buffer_obj.dequeue()
+        drop_times += [time] * (buffer_obj.counters()['evicted'] - evicted)
+    # waiting over target from time 1, so the first drop is at 1 + 5; then the next drops are
+    # due at 6 + 5/sqrt(1) = 11, + 5/sqrt(2) = 14.5, + 5/sqrt(3) = 17.4, + 5/sqrt(4) = 19.9 and
+    # + 5/sqrt(5) = 22.2, and happen at the first dequeue after that
+    assert drop_times == [6, 11, 15, 18, 20, 23], drop_times
+    assert buffer_obj._dropping and buffer_obj._count == 6
+    while len(buffer_obj) > 0:
+        buffer_obj.dequeue()
+    enqueue_all(buffer_obj, [('c1', 100)] * 2)
+    assert buffer_obj.dequeue() != None and not buffer_obj._dropping
+
+def test_event_trace_codel_head_drops():
+    """Packets CoDel drops from the head of the queue inside dequeue() appear in the event trace."""
+    with tempfile.TemporaryDirectory() as directory:
+        path = os.path.join(directory, 'events.bin')
+        config.EVENT_TRACE = path
+        try:
+            simulator = new_simulator()
+        finally:
+            config.EVENT_TRACE = ''
+        buffer_obj = CoDelBuffer(100, 1000, 'test', target=0.5, interval=5.0)
+        enqueue_all(buffer_obj, [('c1', 100)] * 20)
+        for time in range(20):
+            simulator._time = float(time)
+            buffer_obj.dequeue()
+        simulator.event_trace.close()
+        names, records = read_event_trace(path)
+        kinds = [record[1] for record in records]
+    assert names['links'] == ['test'], names
+    assert kinds.count('enqueue') == 20, kinds
+    assert kinds.count('evict') == buffer_obj.counters()['evicted'] > 0, (kinds, buffer_obj.counters())
+
+def test_fluid_starved_class_latency():
+    """Under strict priority with c1 alone filling the link, c2 gets nothing through; its fluid
+    latency is None (null in JSON), not NaN."""
+    args = argparse.Namespace(
+        buffer_class='PriorityQueueBuffer', c1_rate=10, c1_size=100, c2_rate=10, c2_size=100,
+        bandwidth_forward=1000, buffer_size=60, delay=1.0, delay_variance=0.0, drop_forward=0.0,
+        time_limit=1000,
+    )
+    fluid_simulator = FluidSimulator(args)
+    fluid_simulator.run()
+    results = fluid_simulator.json_info()
+    assert results['c2']['received_rate_size'] == 0, results['c2']
+    assert results['c2']['latency_mean'] is None, results['c2']
+    assert results['c1']['latency_mean'] > 0, results['c1']
+    assert '"latency_mean": null' in json.dumps(results), json.dumps(results)
+
+TESTS = [
+    ('wfq-byte-capacity-no-wasted-evictions', test_wfq_byte_capacity_no_wasted_evictions),
+    ('wfq-byte-capacity-evicts-when-enough', test_wfq_byte_capacity_evicts_when_enough),
+    ('wfq-byte-capacity-puts-back', test_wfq_byte_capacity_puts_back),
+    ('wfq-weighted-shares', test_wfq_weighted_shares),
+    ('wfq-late-class-does-not-jump-ahead', test_wfq_late_class_does_not_jump_ahead),
+    ('drr-weighted-shares', test_drr_weighted_shares),
+    ('drr-byte-capacity-no-wasted-evictions', test_drr_byte_capacity_no_wasted_evictions),
+    ('oversized-packet-dropped', test_oversized_packet_dropped),
+    ('htb-ceil-limits-rate', test_htb_ceil_limits_rate),
+    ('htb-borrowing-follows-rates', test_htb_borrowing_follows_rates),
+    ('htb-next-ready-time', test_htb_next_ready_time),
+    ('htb-class-errors', test_htb_class_errors),
+    ('multi-queue-steering-and-reordering', test_multi_queue_steering_and_reordering),
+    ('fairness-indices', test_fairness_indices),
+    ('red-idle-decay-once', test_red_idle_decay_once),
+    ('trace-source-close-and-resume', test_trace_source_close_and_resume),
+    ('codel-control-law', test_codel_control_law),
+    ('event-trace-codel-head-drops', test_event_trace_codel_head_drops),
+    ('fluid-starved-class-latency', test_fluid_starved_class_latency),
+]
+
+def main():
+    parser = argparse.ArgumentParser(description='Run tests of the hw4 buffers and simulator.')
+    parser.add_argument('--only-test', metavar='REGEX', default=None, help='only run tests whose label matches REGEX')
+    parser.add_argument('--keep-going', action='store_true', default=False, help='keep going after a failed test')
+    args = parser.parse_args()
+    failed = False
+    for label, function in TESTS:
+        if args.only_test and not re.match(args.only_test, label):
+            continue
+        try:
+            function()
+            print(f'{label}: passed')
+        except AssertionError as e:
+            print(f'{label}: FAILED: {e}')
+            failed = True
+            if not args.keep_going:
+                break
+    if failed:
+        print('*** Failed at least one test')
+        sys.exit(1)
+    else:
+        print('*** All tests passed')
+
+if __name__ == '__main__':
+    main()
@@ -37,6 +37,7 @@ class Packet:
 
     # internal simulator use only, do not change
     _hidden_destination = None
+    _hidden_flow_order = None
 
 @dataclass
 class Message:
@@ -65,3 +66,24 @@ class ReceiverBase:
 
     def to_network(self, packet: Packet) -> None:
         self._simulator.send_packet(packet, to='sender')
+
+def jain_index(values) -> float:
+    """Jain's fairness index of `values`: 1 if all are equal, down to 1/n if one has everything."""
+    values = list(values)
+    total = sum(values)
+    squares = sum(value * value for value in values)
+    if squares == 0:
+        return float('nan')
+    return total * total / (len(values) * squares)
+
+def fairness(rates: dict[str, float], weights: dict[str, float]) -> dict:
+    """Each label's share of the total of `rates`, that share divided by its share of `weights`
+    (1 if it got exactly its weighted share), and Jain's index of the rates divided by weights."""
+    total_rate = sum(rates.values())
+    total_weight = sum(weights.values())
+    shares = {label: rate / total_rate if total_rate > 0 else float('nan') for label, rate in rates.items()}
+    return {
+        'shares': shares,
+        'weight_ratios': {label: share * total_weight / weights[label] for label, share in shares.items()},
+        'jain_index': jain_index(rates[label] / weights[label] for label in rates),
+    }